@@ -0,0 +1,81 @@
+import time
+from collections import OrderedDict
+from urllib.parse import quote_plus
+
+from constants import (ADHOC_GRID_SIZE, ADHOC_MAX_LOCATIONS, ADHOC_TTL,
+                       ADHOC_REGION)
+from location import APILocation
+from logger_config import logger
+
+
+class AdHocLocations():
+
+    def __init__(self,
+                 grid_size=ADHOC_GRID_SIZE,
+                 max_locations=ADHOC_MAX_LOCATIONS,
+                 ttl=ADHOC_TTL,
+                 on_evict=None,
+                 clock=time.monotonic):
+        self.grid_size = grid_size
+        self.max_locations = max_locations
+        self.ttl = ttl
+        self._on_evict = on_evict
+        self._clock = clock
+        # snapped (lat, lon) -> [location, last use], least recent first
+        self._locations = OrderedDict()
+
+    def __len__(self):
+        return len(self._locations)
+
+    def __contains__(self, name):
+        return any(location.name == name
+                   for location, _ in self._locations.values())
+
+    def snap(self, lat, lon):
+        # nearby requests share one grid cell and therefore one plot set
+        return (round(round(lat / self.grid_size) * self.grid_size, 4),
+                round(round(lon / self.grid_size) * self.grid_size, 4))
+
+    @staticmethod
+    def name_for(lat, lon):
+        return '{:.2f}{} {:.2f}{}'.format(abs(lat), 'N' if lat >= 0 else 'S',
+                                          abs(lon), 'E' if lon >= 0 else 'W')
+
+    def get(self, lat, lon, base_time) -> APILocation:
+        cell = self.snap(lat, lon)
+        entry = self._locations.get(cell)
+        if entry is None:
+            name = self.name_for(*cell)
+            location = APILocation(name=name,
+                                   lat=cell[0],
+                                   lon=cell[1],
+                                   region=ADHOC_REGION,
+                                   api_name=quote_plus(name))
+            location.base_time = base_time
+            entry = [location, None]
+            self._locations[cell] = entry
+            logger.debug('Ad hoc location {} created'.format(name))
+        entry[1] = self._clock()
+        self._locations.move_to_end(cell)
+
+        while len(self._locations) > self.max_locations:
+            self._evict(next(iter(self._locations)))
+        return entry[0]
+
+    def evict_expired(self):
+        now = self._clock()
+        for cell, (_, last_use) in list(self._locations.items()):
+            if now - last_use > self.ttl:
+                self._evict(cell)
+
+    def evict_stale(self, base_time):
+        # plots of an older run are never served again
+        for cell, (location, _) in list(self._locations.items()):
+            if location.base_time != base_time:
+                self._evict(cell)
+
+    def _evict(self, cell):
+        location, _ = self._locations.pop(cell)
+        logger.debug('Ad hoc location {} evicted'.format(location.name))
+        if self._on_evict is not None:
+            self._on_evict(location)
@@ -0,0 +1,245 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+from constants import (ARCHIVE_KEEP_RUNS, ARCHIVE_MAX_BYTES, ARCHIVE_INDEX,
+                       PLOT_OPTIMIZE_LEVEL, PLOT_OPTIMIZE_WORKERS)
+from logger_config import logger
+from metrics import ARCHIVE_BYTES
+from plot_optimizer import PlotOptimizer
+
+
+class PlotArchive():
+    """Plots of the previous runs of every station.
+
+    The content of a plot is stored once no matter how many runs it belongs
+    to. New content is recompressed by optimizer, None keeps it as it is,
+    e.g. if the plots were optimized at download already. An sqlite index
+    in the same directory maps station, epsgram type and base_time to the
+    content. Only the keep latest runs of a station are kept, and the oldest
+    runs of all stations go first while the archive is larger than
+    max_bytes.
+    """
+
+    def __init__(self,
+                 directory,
+                 keep=ARCHIVE_KEEP_RUNS,
+                 max_bytes=ARCHIVE_MAX_BYTES,
+                 optimizer=None,
+                 read_only=False):
+        if keep < 1:
+            raise ValueError(
+                'Number of runs to keep must be positive, got {}'.format(keep))
+        self.directory = directory
+        self._keep = keep
+        self._max_bytes = max_bytes
+        self._optimizer = optimizer
+        self._read_only = read_only
+        os.makedirs(directory, exist_ok=True)
+        # shared by the event loop and the fetch thread
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(os.path.join(
+            directory, ARCHIVE_INDEX),
+                                           check_same_thread=False)
+        # the bot of --mode frontend reads while the fetcher writes
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        with self._connection:
+            self._connection.executescript("""
+                CREATE TABLE IF NOT EXISTS blobs (
+                    sha256 TEXT PRIMARY KEY,
+                    size INTEGER NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS plots (
+                    station TEXT NOT NULL,
+                    eps_type TEXT NOT NULL,
+                    base_time TEXT NOT NULL,
+                    sha256 TEXT NOT NULL REFERENCES blobs (sha256),
+                    archived_at REAL NOT NULL,
+                    PRIMARY KEY (station, eps_type, base_time)
+                );
+                CREATE INDEX IF NOT EXISTS plots_by_sha256 ON plots (sha256);
+                CREATE INDEX IF NOT EXISTS plots_by_base_time ON plots (base_time);
+            """)
+
+    @classmethod
+    def from_config(cls, config, optimized=False, read_only=False):
+        # nothing is archived without config, optimized plots are stored
+        # as they are, readers never recompress
+        if not config:
+            return None
+        if 'dir' not in config:
+            raise ValueError('The archive needs a dir')
+        optimizer = None
+        if not optimized and not read_only:
+            optimizer = PlotOptimizer(
+                config.get('level', PLOT_OPTIMIZE_LEVEL),
+                config.get('workers', PLOT_OPTIMIZE_WORKERS))
+        return cls(config['dir'], config.get('keep', ARCHIVE_KEEP_RUNS),
+                   config.get('max_bytes', ARCHIVE_MAX_BYTES), optimizer,
+                   read_only)
+
+    @property
+    def size(self) -> int:
+        with self._lock:
+            return self._connection.execute(
+                'SELECT COALESCE(SUM(size), 0) FROM blobs').fetchone()[0]
+
+    def _blob_path(self, sha256):
+        # 256 subdirectories instead of one huge directory
+        return os.path.join(self.directory, sha256[:2],
+                            '{}.png'.format(sha256))
+
+    def add(self, station, eps_type, base_time, path):
+        """Archive the plot at path as it is. Returns the file its content
+        is stored in, None if the content was archived before."""
+        if self._read_only:
+            raise ValueError('The archive in {} is read-only'.format(
+                self.directory))
+        with open(path, 'rb') as file:
+            data = file.read()
+        sha256 = hashlib.sha256(data).hexdigest()
+        blob = self._blob_path(sha256)
+        # held throughout, prune must not remove the blob before it is used
+        with self._lock:
+            known = self._connection.execute(
+                'SELECT 1 FROM blobs WHERE sha256 = ?',
+                (sha256, )).fetchone() is not None
+            if not known:
+                os.makedirs(os.path.dirname(blob), exist_ok=True)
+                tmp_file = '{}.part'.format(blob)
+                with open(tmp_file, 'wb') as file:
+                    file.write(data)
+                os.replace(tmp_file, blob)
+            with self._connection:
+                if not known:
+                    self._connection.execute(
+                        'INSERT INTO blobs (sha256, size) VALUES (?, ?)',
+                        (sha256, len(data)))
+                self._connection.execute(
+                    """
+                    INSERT OR REPLACE INTO plots
+                    (station, eps_type, base_time, sha256, archived_at)
+                    VALUES (?, ?, ?, ?, ?)
+                """, (station, eps_type, base_time, sha256, time.time()))
+        return None if known else blob
+
+    def archive(self, station, base_time, plots) -> int:
+        """Archive the plots of a run, epsgram type -> path, and prune.
+
+        Returns the number of plots with new content. Errors are logged,
+        the plots themselves are not affected. Waits for the process pool of
+        the optimizer, call it from the fetch thread.
+        """
+        added = []
+        try:
+            for eps_type, path in plots.items():
+                blob = self.add(station, eps_type, base_time, path)
+                if blob is not None:
+                    added.append(blob)
+            if self._optimizer is not None and added:
+                # in place, the blobs are named after the content as added
+                self._optimizer.optimize(added)
+                self._update_sizes(added)
+            self.prune()
+        except (OSError, ValueError, sqlite3.Error) as e:
+            logger.warning('Could not archive plots of %s: %s',
+                           station,
+                           e,
+                           extra={
+                               'station': station,
+                               'base_time': base_time
+                           })
+        return len(added)
+
+    def _update_sizes(self, blobs):
+        sizes = [(os.path.getsize(blob), os.path.basename(blob).split('.')[0])
+                 for blob in blobs]
+        with self._lock, self._connection:
+            self._connection.executemany(
+                'UPDATE blobs SET size = ? WHERE sha256 = ?', sizes)
+
+    def runs(self, station) -> list[str]:
+        """base_times archived for station, latest first."""
+        with self._lock:
+            rows = self._connection.execute(
+                """
+                SELECT DISTINCT base_time FROM plots WHERE station = ?
+                ORDER BY base_time DESC
+            """, (station, )).fetchall()
+        return [base_time for base_time, in rows]
+
+    def get(self, station, base_time) -> dict:
+        """PNG of every archived epsgram type of a run, by type."""
+        with self._lock:
+            rows = self._connection.execute(
+                """
+                SELECT eps_type, sha256 FROM plots
+                WHERE station = ? AND base_time = ?
+            """, (station, base_time)).fetchall()
+        plots = {}
+        for eps_type, sha256 in rows:
+            try:
+                with open(self._blob_path(sha256), 'rb') as file:
+                    plots[eps_type] = file.read()
+            except FileNotFoundError:
+                # pruned by another process in the meantime
+                pass
+        return plots
+
+    def prune(self) -> int:
+        """Remove runs beyond keep, then the oldest runs until the archive
+        fits into max_bytes. Returns the number of plots removed."""
+        with self._lock:
+            with self._connection:
+                removed = self._connection.execute(
+                    """
+                    DELETE FROM plots WHERE (station, base_time) IN (
+                        SELECT station, base_time FROM (
+                            SELECT station, base_time, DENSE_RANK() OVER (
+                                PARTITION BY station ORDER BY base_time DESC
+                            ) AS age FROM plots
+                        ) WHERE age > ?
+                    )
+                """, (self._keep, )).rowcount
+                while self._used_bytes() > self._max_bytes:
+                    oldest = self._connection.execute(
+                        'SELECT MIN(base_time) FROM plots').fetchone()[0]
+                    if oldest is None:
+                        break
+                    removed += self._connection.execute(
+                        'DELETE FROM plots WHERE base_time = ?',
+                        (oldest, )).rowcount
+                orphans = self._connection.execute("""
+                    SELECT sha256 FROM blobs
+                    WHERE sha256 NOT IN (SELECT sha256 FROM plots)
+                """).fetchall()
+                self._connection.executemany(
+                    'DELETE FROM blobs WHERE sha256 = ?', orphans)
+            # files go once the index no longer refers to them
+            for sha256, in orphans:
+                try:
+                    os.remove(self._blob_path(sha256))
+                except FileNotFoundError:
+                    pass
+            size = self._used_bytes()
+
+        ARCHIVE_BYTES.set(size)
+        if removed:
+            logger.debug('Pruned %d plots from the archive, %d bytes left',
+                         removed, size)
+        return removed
+
+    def _used_bytes(self):
+        # blobs still referred to, shared content counts once
+        return self._connection.execute("""
+            SELECT COALESCE(SUM(size), 0) FROM blobs
+            WHERE sha256 IN (SELECT sha256 FROM plots)
+        """).fetchone()[0]
+
+    def close(self):
+        if self._optimizer is not None:
+            self._optimizer.close()
+        with self._lock:
+            self._connection.close()
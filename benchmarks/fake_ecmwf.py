@@ -0,0 +1,216 @@
+import datetime
+import hashlib
+import json
+import random
+import struct
+import threading
+import time
+import zlib
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, quote, unquote, urlparse
+
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+API_PATH = '/opencharts-api/v1/'
+IMAGE_PATH = '/images/'
+
+
+def _chunk(chunk_type, data):
+    return (struct.pack('>I', len(data)) + chunk_type + data +
+            struct.pack('>I', zlib.crc32(chunk_type + data)))
+
+
+def make_png(size, seed=0):
+    """Grayscale PNG of roughly size bytes, the pixels do not compress."""
+    width = 256
+    height = max(1, size // (width + 1))
+    rows = random.Random(seed).randbytes(height * width)
+    raw = b''.join(b'\x00' + rows[row * width:(row + 1) * width]
+                   for row in range(height))
+    return [
+        _chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 0, 0, 0, 0)),
+        _chunk(b'IDAT', zlib.compress(raw, 0)),
+        _chunk(b'IEND', b''),
+    ]
+
+
+class FakeEcmwfServer():
+    """Local stand-in for the opencharts API of ECMWF.
+
+    Serves the schema with the latest run, the opencharts_meteogram product
+    links and PNG images on 127.0.0.1. Latency and the share of requests
+    answered with 503 are configurable, flip_run publishes a new run the way
+    ECMWF does twice a day. Every request is counted by endpoint.
+    """
+
+    def __init__(self,
+                 host='127.0.0.1',
+                 port=0,
+                 latency=0.0,
+                 error_rate=0.0,
+                 image_size=64 * 1024,
+                 base_time=None,
+                 seed=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.counts = Counter()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        if base_time is None:
+            now = datetime.datetime.now(datetime.timezone.utc)
+            base_time = now.replace(hour=0 if now.hour < 12 else 12,
+                                    minute=0,
+                                    second=0,
+                                    microsecond=0).strftime(TIME_FORMAT)
+        # runs with plots, the last one is announced in the schema
+        self.runs = [base_time]
+        self._png = make_png(image_size, seed)
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                status, headers, body = server._dispatch(self)
+                try:
+                    self.send_response(status)
+                    for name, value in headers.items():
+                        self.send_header(name, value)
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+
+            def log_message(self, format, *args):
+                pass
+
+        self._httpd = ThreadingHTTPServer((host, port), Handler)
+        self._httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def _origin(self):
+        host, port = self._httpd.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+    @property
+    def api_url(self):
+        return self._origin + API_PATH
+
+    @property
+    def base_time(self):
+        with self._lock:
+            return self.runs[-1]
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever,
+                                        daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def flip_run(self):
+        """Publish the run 12 hours after the latest one."""
+        with self._lock:
+            latest = datetime.datetime.strptime(self.runs[-1], TIME_FORMAT)
+            self.runs.append(
+                (latest + datetime.timedelta(hours=12)).strftime(TIME_FORMAT))
+            return self.runs[-1]
+
+    def reset_counts(self):
+        with self._lock:
+            self.counts.clear()
+
+    # --- API ------------------------------------------------------------
+
+    def _count(self, key):
+        with self._lock:
+            self.counts[key] += 1
+
+    def _dispatch(self, request):
+        if self.latency:
+            time.sleep(self.latency)
+        url = urlparse(request.path)
+        params = dict(parse_qsl(url.query))
+
+        if url.path.startswith(API_PATH):
+            endpoint = url.path[len(API_PATH):].strip('/')
+        elif url.path.startswith(IMAGE_PATH):
+            endpoint = 'image'
+        else:
+            endpoint = 'unknown'
+        self._count(endpoint)
+
+        with self._lock:
+            failed = self._random.random() < self.error_rate
+        if failed:
+            self._count('error')
+            return 503, {}, b'Service Unavailable'
+
+        if endpoint == 'schema':
+            return self._json(self._schema())
+        if endpoint == 'products/opencharts_meteogram':
+            return self._meteogram(params)
+        if endpoint == 'image':
+            return self._image(url.path, request.headers)
+        return 404, {}, b'Not Found'
+
+    def _json(self, data, status=200):
+        return status, {
+            'Content-Type': 'application/json'
+        }, json.dumps(data).encode()
+
+    def _schema(self):
+        return {
+            'paths': {
+                '/products/opencharts_meteogram/': {
+                    'get': {
+                        'parameters': [
+                            {
+                                'name': 'epsgram'
+                            },
+                            {
+                                'name': 'base_time',
+                                'schema': {
+                                    'default': self.base_time
+                                }
+                            },
+                        ]
+                    }
+                }
+            }
+        }
+
+    def _meteogram(self, params):
+        with self._lock:
+            available = params.get('base_time') in self.runs
+        if not available or 'epsgram' not in params:
+            return self._json({'error': 'No data'}, status=404)
+        href = '{}{}{}/{}/{}.png'.format(self._origin, IMAGE_PATH,
+                                         params['epsgram'],
+                                         params['base_time'],
+                                         quote(params.get('station_name', '')))
+        return self._json({'data': {'link': {'href': href}}})
+
+    def _image(self, path, headers):
+        # every plot has its own content, a new run changes it
+        key = unquote(path[len(IMAGE_PATH):])
+        etag = '"{}"'.format(hashlib.sha256(key.encode()).hexdigest()[:16])
+        if headers.get('If-None-Match') == etag:
+            self._count('not_modified')
+            return 304, {'ETag': etag}, b''
+        body = b''.join([
+            b'\x89PNG\r\n\x1a\n', self._png[0],
+            _chunk(b'tEXt', b'Title\x00' + key.encode())
+        ] + self._png[1:])
+        return 200, {'Content-Type': 'image/png', 'ETag': etag}, body
@@ -0,0 +1,349 @@
+import itertools
+import json
+import threading
+import time
+import urllib.error
+import urllib.request
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlparse
+
+BOT_USER = {
+    'id': 1,
+    'is_bot': True,
+    'first_name': 'OpenEns',
+    'username': 'openens_test_bot',
+    'can_join_groups': False,
+    'can_read_all_group_messages': False,
+    'supports_inline_queries': False,
+}
+
+SEND_METHODS = {
+    'sendMessage', 'sendPhoto', 'sendMediaGroup', 'editMessageText',
+    'editMessageReplyMarkup', 'sendDocument'
+}
+
+
+class FakeTelegramServer():
+    """Local stand-in for the Telegram Bot API.
+
+    Serves the methods the bot uses on 127.0.0.1, records every call and
+    lets benchmarks and tests inject updates that are delivered through
+    getUpdates or, once the bot called setWebhook, posted to its webhook.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0):
+        self.latency = latency
+        self.calls = []
+        self._updates = []
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._condition = threading.Condition()
+        # url and secret_token registered through setWebhook
+        self._webhook = None
+        self._stopped = False
+        # called with every recorded call, from the thread of the request
+        self._listeners = []
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                self._handle()
+
+            def do_POST(self):
+                self._handle()
+
+            def _handle(self):
+                url = urlparse(self.path)
+                length = int(self.headers.get('Content-Length', 0))
+                body = self.rfile.read(length) if length else b''
+                params = dict(parse_qsl(url.query))
+                params.update(
+                    _parse_body(self.headers.get('Content-Type', ''), body))
+                method = url.path.rstrip('/').rsplit('/', 1)[-1]
+                status, result = server._dispatch(method, params)
+                payload = json.dumps(result).encode()
+                try:
+                    self.send_response(status)
+                    self.send_header('Content-Type', 'application/json')
+                    self.send_header('Content-Length', str(len(payload)))
+                    self.end_headers()
+                    self.wfile.write(payload)
+                except (BrokenPipeError, ConnectionResetError):
+                    # client went away during a long poll
+                    pass
+
+            def log_message(self, format, *args):
+                pass
+
+        self._httpd = ThreadingHTTPServer((host, port), Handler)
+        self._httpd.daemon_threads = True
+        self._thread = None
+        self._webhook_thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._httpd.server_address[:2]
+        return 'http://{}:{}/bot'.format(host, port)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever,
+                                        daemon=True)
+        self._thread.start()
+        self._webhook_thread = threading.Thread(target=self._post_updates,
+                                                daemon=True)
+        self._webhook_thread.start()
+        return self
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    # --- updates --------------------------------------------------------
+
+    def make_message(self, chat_id, text=None, **fields):
+        message = {
+            'message_id': next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {
+                'id': chat_id,
+                'type': 'private',
+                'first_name': 'User{}'.format(chat_id)
+            },
+            'from': {
+                'id': chat_id,
+                'is_bot': False,
+                'first_name': 'User{}'.format(chat_id)
+            },
+        }
+        if text is not None:
+            message['text'] = text
+            if text.startswith('/'):
+                command = text.split()[0]
+                message['entities'] = [{
+                    'type': 'bot_command',
+                    'offset': 0,
+                    'length': len(command)
+                }]
+        message.update(fields)
+        return message
+
+    def make_update(self, chat_id, text=None, **fields):
+        return {
+            'update_id': next(self._update_ids),
+            'message': self.make_message(chat_id, text, **fields),
+        }
+
+    def make_callback_query(self, chat_id, data, message_id=None):
+        # a button of an inline keyboard sent earlier was pressed
+        message = self.make_message(chat_id, 'Choose a region')
+        if message_id is not None:
+            message['message_id'] = message_id
+        message['from'] = dict(BOT_USER)
+        return {
+            'update_id': next(self._update_ids),
+            'callback_query': {
+                'id': str(next(self._message_ids)),
+                'from': self.make_message(chat_id)['from'],
+                'chat_instance': str(chat_id),
+                'message': message,
+                'data': data,
+            },
+        }
+
+    def push_callback_query(self, chat_id, data, message_id=None):
+        return self.push_update(
+            self.make_callback_query(chat_id, data, message_id))
+
+    def push_update(self, update):
+        with self._condition:
+            self._updates.append(update)
+            self._condition.notify_all()
+        return update
+
+    def push_message(self, chat_id, text=None, **fields):
+        return self.push_update(self.make_update(chat_id, text, **fields))
+
+    # --- inspection -----------------------------------------------------
+
+    def sent(self, chat_id=None, method=None):
+        with self._condition:
+            calls = list(self.calls)
+        return [
+            call for call in calls if call['method'] in SEND_METHODS and
+            (method is None or call['method'] == method) and (
+                chat_id is None or call['params'].get('chat_id') == chat_id)
+        ]
+
+    def add_listener(self, listener):
+        self._listeners.append(listener)
+
+    def wait_for(self, predicate, timeout=10.0):
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while not predicate():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+        return True
+
+    # --- Bot API --------------------------------------------------------
+
+    def _dispatch(self, method, params):
+        if self.latency:
+            time.sleep(self.latency)
+
+        call = {
+            'time': time.monotonic(),
+            'method': method,
+            'params': params,
+        }
+        with self._condition:
+            self.calls.append(call)
+            self._condition.notify_all()
+        for listener in self._listeners:
+            listener(call)
+
+        if method == 'getMe':
+            return 200, _ok(BOT_USER)
+        if method == 'getUpdates':
+            return 200, _ok(self._get_updates(params))
+        if method in SEND_METHODS:
+            return 200, _ok(self._sent_message(method, params))
+        if method in {'setWebhook', 'deleteWebhook'}:
+            with self._condition:
+                self._webhook = params if method == 'setWebhook' else None
+                self._condition.notify_all()
+            return 200, _ok(True)
+        if method in {
+                'setMyCommands', 'answerCallbackQuery', 'close', 'logOut'
+        }:
+            return 200, _ok(True)
+        return 404, {
+            'ok': False,
+            'error_code': 404,
+            'description': 'Not Found: method {}'.format(method)
+        }
+
+    def _get_updates(self, params):
+        offset = int(params.get('offset', 0) or 0)
+        timeout = min(float(params.get('timeout', 0) or 0), 1.0)
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            self._updates = [
+                u for u in self._updates if u['update_id'] >= offset
+            ]
+            while not self._updates and time.monotonic() < deadline:
+                self._condition.wait(deadline - time.monotonic())
+            limit = int(params.get('limit', 100) or 100)
+            return self._updates[:limit]
+
+    @property
+    def webhook_url(self):
+        with self._condition:
+            return self._webhook['url'] if self._webhook else None
+
+    def _post_updates(self):
+        # same order and at-least-once semantics as the real webhook
+        while True:
+            with self._condition:
+                while not self._stopped and not (self._webhook
+                                                 and self._updates):
+                    self._condition.wait()
+                if self._stopped:
+                    return
+                webhook = self._webhook
+                update = self._updates[0]
+            if self._post_update(webhook, update):
+                with self._condition:
+                    if self._updates and self._updates[0] is update:
+                        self._updates.pop(0)
+            else:
+                time.sleep(0.05)
+
+    def _post_update(self, webhook, update):
+        request = urllib.request.Request(
+            webhook['url'],
+            data=json.dumps(update).encode(),
+            headers={'Content-Type': 'application/json'})
+        if webhook.get('secret_token'):
+            request.add_header('X-Telegram-Bot-Api-Secret-Token',
+                               webhook['secret_token'])
+        try:
+            with urllib.request.urlopen(request, timeout=5) as response:
+                return response.status == 200
+        except (urllib.error.URLError, OSError):
+            return False
+
+    def _sent_message(self, method, params):
+        chat_id = params.get('chat_id', 0)
+        message_id = int(params.get('message_id', 0)) or next(
+            self._message_ids)
+        message = {
+            'message_id': message_id,
+            'date': int(time.time()),
+            'chat': {
+                'id': chat_id,
+                'type': 'private'
+            },
+        }
+        if 'text' in params:
+            message['text'] = params['text']
+        if method == 'sendPhoto':
+            file_id = 'photo{}'.format(message_id)
+            message['photo'] = [{
+                'file_id': file_id,
+                'file_unique_id': file_id,
+                'width': 1,
+                'height': 1,
+            }]
+        if method == 'sendMediaGroup':
+            return [
+                dict(message, message_id=next(self._message_ids))
+                for _ in json.loads(params.get('media', '[]'))
+            ]
+        return message
+
+
+def _ok(result):
+    return {'ok': True, 'result': result}
+
+
+def _parse_body(content_type, body):
+    if not body:
+        return {}
+    if content_type.startswith('application/json'):
+        params = json.loads(body)
+    elif content_type.startswith('multipart/form-data'):
+        message = BytesParser().parsebytes(b'Content-Type: ' +
+                                           content_type.encode() +
+                                           b'\r\n\r\n' + body)
+        params = {}
+        for part in message.get_payload():
+            name = part.get_param('name', header='content-disposition')
+            payload = part.get_payload(decode=True)
+            if part.get_filename():
+                params[name] = '<{} bytes>'.format(len(payload))
+            else:
+                params[name] = payload.decode()
+    else:
+        params = dict(parse_qsl(body.decode()))
+
+    if 'chat_id' in params:
+        try:
+            params['chat_id'] = int(params['chat_id'])
+        except (TypeError, ValueError):
+            pass
+    return params
@@ -0,0 +1,313 @@
+"""Load benchmark: handler latency of many concurrent chats.
+
+Simulated chats walk the /plots, /subscribe and /unsubscribe flows of
+PlotBot: they press inline keyboard buttons, cancel, or walk away from an
+open conversation. Their updates go straight into the update queue of the
+Application, replies are answered by a local fake Telegram Bot API,
+storage is in memory and plots come from a local fake opencharts API. Run
+from the repository root:
+
+    python benchmarks/load.py --chats 2000 --scenario mixed
+    python benchmarks/load.py --chats 2000 --scenario storm
+
+The storm scenario publishes a new run right before all chats ask for
+plots within a second, while the broadcast of the new run to all chats
+competes with the handlers for the event loop. Reported are the reply latency percentiles per step,
+updates per second and the lag of the event loop.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+import yaml
+from telegram import Update
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(ROOT)
+
+from fake_ecmwf import FakeEcmwfServer
+from fake_telegram import FakeTelegramServer, SEND_METHODS
+from memory_db import MemoryDatabase
+
+# share of chats per walk and seconds over which the chats start
+SCENARIOS = {
+    'mixed': ({
+        'plots': 0.45,
+        'subscribe': 0.25,
+        'cancel': 0.1,
+        'unsubscribe': 0.1,
+        'abandon': 0.1,
+    }, 10.0),
+    'storm': ({
+        'plots': 0.9,
+        'subscribe': 0.1,
+    }, 1.0),
+}
+
+
+def is_reply(call):
+    # replies carry a keyboard or edit one, deliveries do neither
+    return call['method'] == 'editMessageText' or (
+        call['method'] in SEND_METHODS and 'reply_markup' in call['params'])
+
+
+def make_walk(kind, registry, subscribed, product_count, rng):
+    """Steps of a chat as (label, text or callback data) pairs."""
+    region_index = rng.randrange(len(registry.regions))
+    names = registry.names_for_region(registry.regions[region_index])
+    station_index = rng.randrange(len(names))
+    version = registry.version
+    if kind == 'plots':
+        return [('/plots', '/plots'), ('p:r', f'p:r:{version}:{region_index}'),
+                ('p:s', f'p:s:{version}:{region_index}:{station_index}')]
+    if kind == 'subscribe':
+        steps = [('/subscribe', '/subscribe'),
+                 ('s:r', f's:r:{version}:{region_index}'),
+                 ('s:s', f's:s:{version}:{region_index}:{station_index}')]
+        if product_count > 1:
+            # a single product or, with an empty selection, all of them
+            product_index = rng.randrange(product_count + 1)
+            selected = 1 << product_index if product_index < product_count else 0
+            prefix = f'{version}:{region_index}:{station_index}'
+            if selected:
+                steps.append(('s:p', f's:p:{prefix}:{selected}'))
+            steps.append(('s:c', f's:c:{prefix}:{selected}'))
+        return steps
+    if kind == 'cancel':
+        return [('/plots', '/plots'), ('p:r', f'p:r:{version}:{region_index}'),
+                ('p:x', 'p:x')]
+    if kind == 'unsubscribe':
+        return [('/unsubscribe', '/unsubscribe'), ('station', subscribed)]
+    # opens a conversation that only ends with its timeout
+    return [('/unsubscribe', '/unsubscribe')]
+
+
+class LoadGenerator():
+
+    def __init__(self, app, server, timeout):
+        self._app = app
+        self._server = server
+        self._timeout = timeout
+        self._loop = asyncio.get_running_loop()
+        # chat_id -> future of the reply the chat waits for
+        self._waiting = {}
+        self.latencies = {}
+        self.timeouts = 0
+        server.add_listener(self._on_call)
+
+    def _on_call(self, call):
+        # runs in a thread of the fake server
+        if is_reply(call):
+            self._loop.call_soon_threadsafe(self._resolve,
+                                            call['params'].get('chat_id'),
+                                            call['time'])
+
+    def _resolve(self, chat_id, replied):
+        future = self._waiting.pop(chat_id, None)
+        if future is not None and not future.done():
+            future.set_result(replied)
+
+    async def send(self, chat_id, label, data, due):
+        if data.startswith('/') or label == 'station':
+            update = self._server.make_update(chat_id, data)
+        else:
+            update = self._server.make_callback_query(chat_id, data)
+        future = self._loop.create_future()
+        self._waiting[chat_id] = future
+        await self._app.update_queue.put(Update.de_json(update, self._app.bot))
+        try:
+            replied = await asyncio.wait_for(future, self._timeout)
+        except asyncio.TimeoutError:
+            self._waiting.pop(chat_id, None)
+            self.timeouts += 1
+            return None
+        # from when the user pressed, a blocked event loop delays sending
+        self.latencies.setdefault(label, []).append(replied - due)
+        return replied
+
+    async def run_chat(self, chat_id, steps, delay, think_time):
+        due = time.monotonic() + delay
+        for label, data in steps:
+            await asyncio.sleep(max(0.0, due - time.monotonic()))
+            replied = await self.send(chat_id, label, data, due)
+            if replied is None:
+                return
+            due = replied + think_time
+
+
+async def monitor_lag(samples, interval=0.05):
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        samples.append(loop.time() - start - interval)
+
+
+async def post_run(bot, db):
+    # the jobs after a run flip: fetch and queue the new run for all
+    # subscribers, then work off the outbox
+    await bot._broadcast(None)
+    while any(delivery['status'] in ('pending', 'claimed')
+              for delivery in db.outbox.values()):
+        await bot._deliver(None)
+        await asyncio.sleep(0)
+
+
+def seed(db, registry, chats, rng):
+    # every chat has one subscription to leave with /unsubscribe
+    subscribed = {}
+    for chat_id in chats:
+        subscribed[chat_id] = rng.choice(registry.names)
+        db.add_subscription(subscribed[chat_id], chat_id)
+    return subscribed
+
+
+async def benchmark(args, workdir):
+    from ecmwf import EcmwfApi
+    from bot import PlotBot
+    from logger_config import logger
+    from registry import StationRegistry
+
+    # one log line per update would dominate the timings
+    logger.setLevel(logging.WARNING)
+    walks, ramp = SCENARIOS[args.scenario]
+    ramp = args.ramp if args.ramp is not None else ramp
+    rng = random.Random(args.seed)
+    with open(os.path.join(ROOT, 'stations.yaml')) as file:
+        station_config = yaml.safe_load(file)
+    registry = StationRegistry.from_config(station_config)
+
+    with FakeEcmwfServer(image_size=args.image_kb * 1024) as ecmwf_server, \
+            FakeTelegramServer(latency=args.telegram_latency) as telegram:
+        config_file = os.path.join(workdir, 'config.yml')
+        ecmwf_config = {'api_url': ecmwf_server.api_url}
+        with open(config_file, 'w') as file:
+            yaml.dump(
+                {
+                    'bot': {
+                        'token': '123456:BENCHMARK',
+                        'base_url': telegram.base_url,
+                        'concurrent_updates': args.concurrent_updates,
+                    },
+                    'ecmwf': ecmwf_config
+                }, file)
+        ecmwf = EcmwfApi(station_config, ecmwf_config)
+        db = MemoryDatabase()
+        chats = list(range(10000, 10000 + args.chats))
+        subscribed = seed(db, registry, chats, rng)
+        bot = PlotBot(config_file, station_config, db=db, ecmwf=ecmwf)
+
+        async with bot.app:
+            await bot.app.start()
+            load = LoadGenerator(bot.app, telegram, args.timeout)
+            lag = []
+            monitor = asyncio.create_task(monitor_lag(lag))
+            kinds = rng.choices(list(walks),
+                                weights=list(walks.values()),
+                                k=len(chats))
+            walks = [
+                make_walk(kind, registry, subscribed[chat_id],
+                          len(ecmwf.products), rng)
+                for chat_id, kind in zip(chats, kinds)
+            ]
+            tasks = [
+                load.run_chat(chat_id, steps, rng.uniform(0, ramp),
+                              args.think_time)
+                for chat_id, steps in zip(chats, walks)
+            ]
+            if args.scenario == 'storm':
+                # nothing of the new run is cached yet
+                ecmwf_server.flip_run()
+                await bot._update_basetime(None)
+                tasks.append(post_run(bot, db))
+
+            start = time.monotonic()
+            await asyncio.gather(*tasks)
+            duration = time.monotonic() - start
+            monitor.cancel()
+            await bot.app.stop()
+
+        delivered = sum(delivery['status'] == 'sent'
+                        for delivery in db.outbox.values())
+        return {
+            'duration': duration,
+            'latencies': load.latencies,
+            'timeouts': load.timeouts,
+            'lag': lag,
+            'delivered': delivered,
+        }
+
+
+def percentiles(values):
+    if len(values) < 2:
+        return [values[0]] * 3 if values else [float('nan')] * 3
+    cuts = statistics.quantiles(values, n=100, method='inclusive')
+    return [cuts[49], cuts[89], cuts[98]]
+
+
+def report(args, result):
+    updates = sum(len(values) for values in result['latencies'].values())
+    print(f'\n{args.scenario}: {args.chats} chats, {updates} updates in '
+          f'{result["duration"]:.2f} s, '
+          f'{updates / result["duration"]:.1f} updates/s, '
+          f'{result["timeouts"]} timeouts, '
+          f'{result["delivered"]} plot sets delivered')
+    print(f'  {"latency [ms]":<14} {"n":>6} {"p50":>8} {"p90":>8} '
+          f'{"p99":>8} {"max":>8}')
+    rows = sorted(result['latencies'].items())
+    rows.append(('all', [
+        value for values in result['latencies'].values() for value in values
+    ]))
+    for label, values in rows:
+        cuts = ''.join(f' {value * 1000:8.1f}'
+                       for value in percentiles(values) + [max(values)])
+        print(f'  {label:<14} {len(values):>6}{cuts}')
+    cuts = ''.join(f' {value * 1000:8.1f}'
+                   for value in percentiles(result['lag']) +
+                   [max(result['lag'], default=float('nan'))])
+    print(f'  {"loop lag":<14} {len(result["lag"]):>6}{cuts}')
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--chats', type=int, default=1000)
+    parser.add_argument('--scenario', choices=SCENARIOS, default='mixed')
+    parser.add_argument('--ramp',
+                        type=float,
+                        help='[s] over which the chats start, '
+                        'default depends on the scenario')
+    parser.add_argument('--think_time',
+                        type=float,
+                        default=0.5,
+                        help='[s] a chat waits before its next step')
+    parser.add_argument('--concurrent_updates', type=int, default=8)
+    parser.add_argument('--telegram_latency',
+                        type=float,
+                        default=0.0,
+                        help='[s] added to every Bot API request')
+    parser.add_argument('--image_kb', type=int, default=64)
+    parser.add_argument('--timeout',
+                        type=float,
+                        default=30,
+                        help='[s] a chat waits for a reply')
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args(argv)
+
+
+def main():
+    args = parse_args()
+    with tempfile.TemporaryDirectory() as workdir:
+        # plots are written to the working directory
+        os.chdir(workdir)
+        result = asyncio.run(benchmark(args, workdir))
+    report(args, result)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,178 @@
+import itertools
+import time
+from collections import Counter
+
+
+class MemoryDatabase():
+    """In-memory stand-in for db.Database used by benchmarks."""
+
+    def __init__(self):
+        # (station, user_id) -> products, None for all
+        self._subscriptions = {}
+        self.activities = []
+        # id -> delivery, same columns as the outbox table
+        self.outbox = {}
+        self._outbox_ids = itertools.count(1)
+        self.digest_users = set()
+
+    def add_subscription(self, station, user_id, products=None):
+        if products is not None:
+            products = list(products)
+        self._subscriptions[(station, user_id)] = products
+
+    def remove_subscription(self, station, user_id):
+        self._subscriptions.pop((station, user_id), None)
+
+    def get_subscriptions_by_user(self, user_id) -> list[str]:
+        return sorted(station for station, user in self._subscriptions
+                      if user == user_id)
+
+    def stations_with_subscribers(self):
+        return sorted({station for station, _ in self._subscriptions})
+
+    def get_subscriptions_by_station(self, station) -> list[int]:
+        return sorted(user for name, user in self._subscriptions
+                      if name == station)
+
+    def get_products_by_station(self, station) -> dict[int, list[str]]:
+        return {
+            user: products
+            for (name, user), products in sorted(self._subscriptions.items())
+            if name == station
+        }
+
+    def get_demanded_products(self) -> dict[str, list[str]]:
+        demand = {}
+        for (station, _), products in sorted(self._subscriptions.items()):
+            if products is None or demand.get(station, []) is None:
+                demand[station] = None
+            else:
+                demand[station] = sorted(
+                    set(demand.get(station, [])).union(products))
+        return demand
+
+    def count_unique_subscribers(self):
+        return len({user for _, user in self._subscriptions})
+
+    def get_subscription_summary(self) -> list[str]:
+        return [
+            f"{station}: {len(self.get_subscriptions_by_station(station))}"
+            for station in self.stations_with_subscribers()
+        ]
+
+    def log_activity(self, activity_type, user_id, station):
+        self.activities.append((activity_type, user_id, station))
+
+    def get_activity_summary(self, interval: str) -> list[str]:
+        counts = Counter(activity for activity, _, _ in self.activities)
+        return [
+            f'{activity}: {count}' for activity, count in counts.most_common()
+        ]
+
+    def enqueue_deliveries(self, deliveries):
+        queued = {(d['chat_id'], d['station'], d['base_time'])
+                  for d in self.outbox.values()}
+        for chat_id, station, base_time, products in deliveries:
+            if base_time is not None and (chat_id, station,
+                                          base_time) in queued:
+                continue
+            queued.add((chat_id, station, base_time))
+            delivery_id = next(self._outbox_ids)
+            self.outbox[delivery_id] = {
+                'id': delivery_id,
+                'chat_id': chat_id,
+                'station': station,
+                'base_time': base_time,
+                'products': products,
+                'status': 'pending',
+                'attempts': 0,
+                'created_at': time.time(),
+                'next_attempt_at': time.time(),
+            }
+
+    def enqueue_request(self, chat_id, station, products=None) -> bool:
+        if any(d['chat_id'] == chat_id and d['station'] == station and
+               d['base_time'] is None and d['status'] in ('pending', 'claimed')
+               for d in self.outbox.values()):
+            return False
+        self.enqueue_deliveries([(chat_id, station, None, products)])
+        return True
+
+    def claim_deliveries(self, limit, lease, max_age) -> list[dict]:
+        now = time.time()
+        claimed = []
+        for delivery in self.outbox.values():
+            if delivery['status'] not in ('pending', 'claimed'):
+                continue
+            if (delivery['base_time'] is None
+                    and delivery['created_at'] < now - max_age):
+                delivery['status'] = 'expired'
+            elif delivery['next_attempt_at'] <= now and len(claimed) < limit:
+                delivery['status'] = 'claimed'
+                delivery['next_attempt_at'] = now + lease
+                claimed.append({
+                    key: delivery[key]
+                    for key in ('id', 'chat_id', 'station', 'base_time',
+                                'products')
+                })
+        return claimed
+
+    def ack_deliveries(self, ids, status='sent'):
+        for delivery_id in ids:
+            self.outbox[delivery_id]['status'] = status
+
+    def retry_deliveries(self, ids, delay):
+        next_attempt_at = time.time() + delay
+        for delivery_id in ids:
+            delivery = self.outbox[delivery_id]
+            delivery['status'] = 'pending'
+            delivery['next_attempt_at'] = next_attempt_at
+
+    def reschedule_deliveries(self, station):
+        now = time.time()
+        for delivery in self.outbox.values():
+            if (delivery['station'] == station
+                    and delivery['status'] == 'pending'):
+                delivery['next_attempt_at'] = now
+
+    def claim_digest(self, chat_id, base_time, lease, deadline) -> list[dict]:
+        now = time.time()
+        claimed = []
+        for delivery in self.outbox.values():
+            if (delivery['chat_id'] == chat_id
+                    and delivery['base_time'] == base_time
+                    and delivery['status'] in ('pending', 'claimed')):
+                delivery['status'] = 'claimed'
+                delivery['next_attempt_at'] = now + lease
+                claimed.append(
+                    dict(
+                        {
+                            key: delivery[key]
+                            for key in ('id', 'chat_id', 'station',
+                                        'base_time', 'products')
+                        },
+                        overdue=delivery['created_at'] < now - deadline))
+        return claimed
+
+    def hold_deliveries(self, ids, deadline):
+        for delivery_id in ids:
+            delivery = self.outbox[delivery_id]
+            delivery['status'] = 'pending'
+            delivery['next_attempt_at'] = delivery['created_at'] + deadline
+
+    def set_digest(self, user_id, enabled):
+        if enabled:
+            self.digest_users.add(user_id)
+        else:
+            self.digest_users.discard(user_id)
+
+    def get_digest_users(self, user_ids) -> set[int]:
+        return self.digest_users.intersection(user_ids)
+
+    def fail_deliveries(self, ids, delay, max_attempts):
+        for delivery_id in ids:
+            delivery = self.outbox[delivery_id]
+            delivery['attempts'] += 1
+            failed = delivery['attempts'] >= max_attempts
+            delivery['status'] = 'failed' if failed else 'pending'
+            delivery['next_attempt_at'] = time.time() + delay
@@ -0,0 +1,229 @@
+"""Pipeline benchmark: from a run flip to the last subscriber's plots.
+
+Runs EcmwfApi and PlotBot in one process against a local fake opencharts
+API and a local fake Telegram Bot API. After all plots of the current run
+are cached, the fake API publishes a new run and the bot jobs run back to
+back: run detection, broadcast, delivery of the outbox and caching of the
+remaining stations. Run from the repository root:
+
+    python benchmarks/pipeline.py --stations 50 --subscribers 200
+
+The waits between two job runs of the job queue are not included, the
+timings are the work the jobs do. All times are seconds since the flip.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import Counter
+
+import yaml
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(ROOT)
+
+from fake_ecmwf import FakeEcmwfServer
+from fake_telegram import FakeTelegramServer
+from memory_db import MemoryDatabase
+
+
+def make_stations(count, seed=0):
+    rng = random.Random(seed)
+    return [{
+        'name': 'Station {}'.format(i),
+        'region': 'Region {}'.format(i % 10),
+        'lat': round(rng.uniform(36.0, 60.0), 4),
+        'lon': round(rng.uniform(-8.0, 25.0), 4),
+    } for i in range(count)]
+
+
+def subscribe(db, stations, subscribers, stations_per_user, products, seed=0):
+    rng = random.Random(seed)
+    names = [station['name'] for station in stations]
+    for chat_id in range(1000, 1000 + subscribers):
+        for name in rng.sample(names, min(stations_per_user, len(names))):
+            # a quarter of the users only wants the first product
+            wanted = products[:1] if chat_id % 4 == 0 else None
+            db.add_subscription(name, chat_id, wanted)
+
+
+def write_config(workdir, telegram, ecmwf_server, args):
+    ecmwf_config = {'api_url': ecmwf_server.api_url}
+    if args.unthrottled:
+        ecmwf_config['rate_limit'] = {
+            budget: {
+                'rate': 1e6,
+                'burst': 1e6
+            }
+            for budget in ('metadata', 'image')
+        }
+    config_file = os.path.join(workdir, 'config.yml')
+    with open(config_file, 'w') as file:
+        yaml.dump(
+            {
+                'bot': {
+                    'token': '123456:BENCHMARK',
+                    'base_url': telegram.base_url
+                },
+                'ecmwf': ecmwf_config
+            }, file)
+    return config_file, ecmwf_config
+
+
+def pending(db):
+    return sum(delivery['status'] in ('pending', 'claimed')
+               for delivery in db.outbox.values())
+
+
+async def run_cycle(bot, ecmwf, db, ecmwf_server, telegram, deadline):
+    ecmwf_server.reset_counts()
+    first_call = len(telegram.calls)
+    if tracemalloc.is_tracing():
+        tracemalloc.reset_peak()
+
+    ecmwf_server.flip_run()
+    t_flip = time.monotonic()
+    timings = {}
+
+    await bot._update_basetime(None)
+    timings['detect'] = time.monotonic() - t_flip
+
+    await bot._broadcast(None)
+    timings['broadcast'] = time.monotonic() - t_flip
+
+    while pending(db) and time.monotonic() - t_flip < deadline:
+        await bot._deliver(None)
+    photos = [
+        call['time'] for call in telegram.calls[first_call:]
+        if call['method'] == 'sendPhoto'
+    ]
+    timings['last_delivery'] = (max(photos) -
+                                t_flip if photos else float('nan'))
+
+    # stations nobody subscribed to stay uncached
+    demand = db.get_demanded_products()
+    while (ecmwf._next_to_cache(demand)[0] is not None
+           and time.monotonic() - t_flip < deadline):
+        await bot._cache_plots(None)
+    timings['all_cached'] = time.monotonic() - t_flip
+
+    telegram_calls = Counter(call['method']
+                             for call in telegram.calls[first_call:])
+    traced_peak = None
+    if tracemalloc.is_tracing():
+        traced_peak = tracemalloc.get_traced_memory()[1] / 2**20
+    return {
+        'timings': timings,
+        'ecmwf_calls': dict(ecmwf_server.counts),
+        'telegram_calls': dict(telegram_calls),
+        'undelivered': pending(db),
+        'traced_peak': traced_peak,
+    }
+
+
+async def benchmark(args, workdir):
+    from ecmwf import EcmwfApi
+    from bot import PlotBot
+    from logger_config import logger
+
+    # one log line per plot would dominate the timings
+    logger.setLevel(logging.WARNING)
+
+    with FakeEcmwfServer(latency=args.ecmwf_latency,
+                         error_rate=args.error_rate,
+                         image_size=args.image_kb * 1024) as ecmwf_server, \
+            FakeTelegramServer(latency=args.telegram_latency) as telegram:
+        config_file, ecmwf_config = write_config(workdir, telegram,
+                                                 ecmwf_server, args)
+        stations = make_stations(args.stations)
+        ecmwf = EcmwfApi(stations, ecmwf_config)
+        db = MemoryDatabase()
+        subscribe(db, stations, args.subscribers, args.stations_per_user,
+                  list(ecmwf.products))
+        bot = PlotBot(config_file, stations, db=db, ecmwf=ecmwf)
+
+        # start from a warm cache of the current run
+        t_start = time.monotonic()
+        while not all(Station.plots_cached for Station in ecmwf._registry):
+            ecmwf.cache_plots()
+        print('warm-up: cached {} stations in {:.2f} s'.format(
+            args.stations,
+            time.monotonic() - t_start))
+
+        results = []
+        async with bot.app:
+            for _ in range(args.cycles):
+                results.append(await run_cycle(bot, ecmwf, db, ecmwf_server,
+                                               telegram, args.deadline))
+        return results
+
+
+def report(results):
+    for cycle, result in enumerate(results, start=1):
+        print(f'\ncycle {cycle}')
+        for key, value in result['timings'].items():
+            print(f'  {key:<14} {value:8.3f} s')
+        for source in ('ecmwf_calls', 'telegram_calls'):
+            calls = ', '.join(
+                f'{method} {count}'
+                for method, count in sorted(result[source].items()))
+            print(f'  {source:<14} {calls}')
+        print(f'  {"undelivered":<14} {result["undelivered"]}')
+        if result['traced_peak'] is not None:
+            print(f'  {"traced_peak":<14} {result["traced_peak"]:8.1f} MiB')
+    # ru_maxrss is reported in kilobytes on Linux
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f'\nmax_rss {max_rss:.1f} MiB (including the fake servers)')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--stations', type=int, default=20)
+    parser.add_argument('--subscribers', type=int, default=100)
+    parser.add_argument('--stations_per_user', type=int, default=3)
+    parser.add_argument('--cycles',
+                        type=int,
+                        default=2,
+                        help='run flips to measure')
+    parser.add_argument('--image_kb', type=int, default=64)
+    parser.add_argument('--ecmwf_latency',
+                        type=float,
+                        default=0.0,
+                        help='[s] added to every opencharts request')
+    parser.add_argument('--telegram_latency',
+                        type=float,
+                        default=0.0,
+                        help='[s] added to every Bot API request')
+    parser.add_argument('--error_rate',
+                        type=float,
+                        default=0.0,
+                        help='share of opencharts requests answered with 503')
+    parser.add_argument('--unthrottled',
+                        action='store_true',
+                        help='lift the client-side rate limits')
+    parser.add_argument('--deadline',
+                        type=float,
+                        default=600,
+                        help='[s] per cycle before giving up')
+    parser.add_argument('--tracemalloc',
+                        action='store_true',
+                        help='report the traced Python heap peak, slower')
+    args = parser.parse_args()
+
+    if args.tracemalloc:
+        tracemalloc.start()
+    with tempfile.TemporaryDirectory() as workdir:
+        # plots are written to the working directory
+        os.chdir(workdir)
+        results = asyncio.run(benchmark(args, workdir))
+    report(results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+"""Startup benchmark: time-to-first-reply and resident memory of the bot.
+
+Starts the bot in a child process against a local fake Telegram Bot API,
+sends /help right away and measures how long it takes until the reply
+arrives. Run from the repository root:
+
+    python benchmarks/startup.py --repeat 5
+
+Add --webhook to receive updates through a local webhook instead of
+long polling.
+"""
+import argparse
+import json
+import os
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import yaml
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(ROOT)
+
+from fake_telegram import FakeTelegramServer
+from memory_db import MemoryDatabase
+
+
+def child(config_file, fast_start):
+    t_start = time.perf_counter()
+    from ecmwf import EcmwfApi
+    from bot import PlotBot
+    t_import = time.perf_counter()
+
+    with open(config_file) as file:
+        config = yaml.safe_load(file)
+    with open(os.path.join(ROOT, 'stations.yaml')) as file:
+        station_config = yaml.safe_load(file)
+
+    ecmwf = EcmwfApi(station_config,
+                     config.get('ecmwf'),
+                     discover_base_time=not fast_start)
+    t_ecmwf = time.perf_counter()
+    bot = PlotBot(config_file,
+                  station_config,
+                  db=MemoryDatabase(),
+                  ecmwf=ecmwf)
+    t_bot = time.perf_counter()
+
+    print(json.dumps({
+        'import': t_import - t_start,
+        'ecmwf_init': t_ecmwf - t_import,
+        'bot_init': t_bot - t_ecmwf,
+    }),
+          flush=True)
+    bot.start()
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def measure(server, workdir, api_url, fast_start, chat_id, webhook=False):
+    config_file = os.path.join(workdir, 'config.yml')
+    bot_config = {'token': '123456:BENCHMARK', 'base_url': server.base_url}
+    if webhook:
+        port = free_port()
+        bot_config['webhook'] = {
+            'port': port,
+            'url_path': 'webhook',
+            'url': 'http://127.0.0.1:{}/webhook'.format(port),
+        }
+    with open(config_file, 'w') as file:
+        yaml.dump({'bot': bot_config, 'ecmwf': {'api_url': api_url}}, file)
+
+    server.push_message(chat_id, '/help')
+    t_start = time.monotonic()
+    command = [
+        sys.executable,
+        os.path.abspath(__file__), '--child', config_file
+    ]
+    if fast_start:
+        command.append('--fast_start')
+    process = subprocess.Popen(command,
+                               cwd=workdir,
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.DEVNULL)
+
+    replied = server.wait_for(lambda: server.sent(chat_id=chat_id), timeout=60)
+    reply = server.sent(chat_id=chat_id)[0]['time'] if replied else None
+
+    process.send_signal(signal.SIGINT)
+    _, status, rusage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    timings = json.loads(process.stdout.readline() or '{}')
+    process.stdout.close()
+
+    return dict(
+        timings,
+        first_reply=reply - t_start if reply is not None else float('nan'),
+        # ru_maxrss is reported in kilobytes on Linux
+        max_rss=rusage.ru_maxrss / 1024,
+    )
+
+
+def report(mode, results):
+    print(f'\n{mode}')
+    for key, unit in [('import', 's'), ('ecmwf_init', 's'), ('bot_init', 's'),
+                      ('first_reply', 's'), ('max_rss', 'MiB')]:
+        values = [result.get(key, float('nan')) for result in results]
+        print(f'  {key:<12} median {statistics.median(values):8.3f} {unit}'
+              f'   max {max(values):8.3f} {unit}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--api_url',
+                        default='https://charts.ecmwf.int/opencharts-api/v1/',
+                        help='ECMWF opencharts API used for base_time lookup')
+    parser.add_argument('--webhook',
+                        action='store_true',
+                        help='receive updates through a webhook')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    parser.add_argument('--fast_start',
+                        action='store_true',
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child, args.fast_start)
+        return
+
+    with FakeTelegramServer() as server, tempfile.TemporaryDirectory(
+    ) as workdir:
+        chat_ids = iter(range(1000, 100000))
+        for mode, fast_start in [('blocking start', False),
+                                 ('fast start', True)]:
+            results = [
+                measure(server, workdir, args.api_url, fast_start,
+                        next(chat_ids), args.webhook)
+                for _ in range(args.repeat)
+            ]
+            report(mode, results)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,48 +1,103 @@
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 import yaml
-from telegram import ReplyKeyboardMarkup, Update, ReplyKeyboardRemove
+from telegram import (ReplyKeyboardMarkup, Update, ReplyKeyboardRemove,
+                      InlineKeyboardButton, InlineKeyboardMarkup,
+                      InputMediaPhoto)
 from telegram.ext import (CommandHandler, MessageHandler, Application, filters,
-                          ConversationHandler, CallbackContext, ContextTypes)
+                          ConversationHandler, CallbackContext, ContextTypes,
+                          CallbackQueryHandler)
 
 from logger_config import logger
-
-from constants import (TIMEOUT_IN_SEC, STATION_SELECT_ONE_TIME,
-                       STATION_SELECT_SUBSCRIBE, ONE_TIME, SUBSCRIBE,
-                       UNSUBSCRIBE, VALID_SUMMARY_INTERVALS,
-                       BOT_JOBQUEUE_DELAY, BOT_DEFAULT_USER_ID,
-                       BOT_MAX_RESCHEDULE_TIME)
+from archive import PlotArchive
+from registry import StationRegistry, StationFileWatcher, load_station_config
+from message_filters import NameFilter
+from workers import queue_broadcast
+from profiling import Sampler, CallbackStats, format_summary
+from ratelimit import ChatRateLimiter
+from update_processor import ChatUpdateProcessor
+from metrics import (TELEGRAM_SENDS, DELIVERIES, SUPPRESSED_REQUESTS,
+                     JOB_LAG_SECONDS, EVENT_LOOP_LAG_SECONDS, LagProbe,
+                     event_loop_lag)
+
+from constants import (
+    TIMEOUT_IN_SEC, UNSUBSCRIBE, CALLBACK_PLOTS, CALLBACK_SUBSCRIBE,
+    VALID_SUMMARY_INTERVALS, EPSGRAM_LABELS, ALL_PRODUCTS, BOT_JOBQUEUE_DELAY,
+    BOT_DEFAULT_USER_ID, BOT_MAX_RESCHEDULE_TIME, BOT_COMMANDS,
+    BOT_NEAREST_STATIONS, BOT_MAX_STATION_DISTANCE, OUTBOX_INTERVAL,
+    OUTBOX_BATCH_SIZE, OUTBOX_LEASE, OUTBOX_RETRY_DELAY, OUTBOX_MAX_ATTEMPTS,
+    BOT_CONCURRENT_UPDATES, BOT_WEBHOOK_LISTEN, BOT_WEBHOOK_PORT,
+    METRICS_PROBE_INTERVAL, PROFILE_DEFAULT_SECONDS, PROFILE_MAX_SECONDS,
+    DIGEST_DEADLINE, MEDIA_GROUP_SIZE, STATIONS_WATCH_INTERVAL,
+    CHAT_RATE_LIMIT_RATE, CHAT_RATE_LIMIT_BURST, CHAT_RATE_LIMIT_MAX_CHATS,
+    CALLBACK_HISTORY)
+
+
+def run_label(base_time) -> str:
+    # 2025-01-31T12:00:00Z -> 2025-01-31 12 UTC
+    return '{} UTC'.format(base_time[:13].replace('T', ' '))
 
 
 class PlotBot:
 
-    def __init__(self, config_file, station_config, db=None, ecmwf=None):
+    def __init__(self,
+                 config_file,
+                 station_config,
+                 db=None,
+                 ecmwf=None,
+                 fetch=True,
+                 stations_file=None):
 
         self._config = yaml.safe_load(open(config_file))
         self._admin_ids = self._config['bot'].get('admin_ids', [])
-        self.app = Application.builder().token(
-            self._config['bot']['token']).build()
+        self._profile_dir = self._config['bot'].get('profile_dir', '.')
+        self._digest_deadline = self._config['bot'].get(
+            'digest_deadline', DIGEST_DEADLINE)
+        self._sampler = None
+        self._callback_stats = CallbackStats()
+        self._chat_limiter = ChatRateLimiter.from_config(
+            self._config['bot'].get('rate_limit'), CHAT_RATE_LIMIT_RATE,
+            CHAT_RATE_LIMIT_BURST, CHAT_RATE_LIMIT_MAX_CHATS)
+        builder = Application.builder().token(self._config['bot']['token'])
+        if 'base_url' in self._config['bot']:
+            builder = builder.base_url(self._config['bot']['base_url'])
+        # handle updates of different chats in parallel, of a chat in order
+        builder = builder.concurrent_updates(
+            ChatUpdateProcessor(self._config['bot'].get(
+                'concurrent_updates', BOT_CONCURRENT_UPDATES)))
+        self.app = builder.build()
         self._db = db
         self._ecmwf = ecmwf
-        self._station_names = sorted(
-            [station["name"] for station in station_config])
-        self._region_of_stations = {
-            station["name"]: station["region"]
-            for station in station_config
+        # EcmwfApi blocks on HTTP, rate limits, retries and zlib. A single
+        # thread runs all its calls one after the other, off the event loop
+        self._fetch_executor = ThreadPoolExecutor(max_workers=1,
+                                                  thread_name_prefix='fetch')
+        # EcmwfApi in this process, the fetcher worker reloads its own
+        self._fetch = fetch
+        # epsgram types offered for subscriptions, same config as EcmwfApi
+        products = (self._config.get('ecmwf')
+                    or {}).get('products', EPSGRAM_LABELS)
+        self._products_by_label = {
+            label: product
+            for product, label in products.items()
         }
-        self._station_regions = sorted(
-            {station["region"]
-             for station in station_config})
+        # previous runs, written by EcmwfApi with the same config and only
+        # read here, without a process pool of its own
+        self._archive = PlotArchive.from_config((self._config.get('ecmwf')
+                                                 or {}).get('archive'),
+                                                read_only=True)
+
         # filter for stations
-        self._filter_stations = filters.Regex("^(" +
-                                              "|".join(self._station_names) +
-                                              ")$")
+        self._filter_stations = NameFilter([], name='stations')
         # filter for regions
-        self._filter_regions = filters.Regex("^(" +
-                                             "|".join(self._station_regions) +
-                                             ")$")
+        self._filter_regions = NameFilter([], name='regions')
+        self._set_stations(StationRegistry.from_config(station_config))
+        self._stations_watcher = StationFileWatcher(
+            stations_file) if stations_file is not None else None
         # filter for all commands of bot
-        self._filter_all_commands = filters.Regex(
-            "^(/locations|/subscribe|/unsubscribe|/plots|/help|/cancel|/start|/stats)$"
-        )
+        self._filter_all_commands = NameFilter(BOT_COMMANDS, name='commands')
 
         # filter for meaningful messages that are explicitly handled by the bot
         # inverse of all filters above
@@ -52,44 +107,34 @@ class PlotBot:
         self.app.add_handler(CommandHandler('help', self._help))
         self.app.add_handler(CommandHandler('cancel', self._cancel))
         self.app.add_handler(CommandHandler('stats', self._stats))
+        self.app.add_handler(CommandHandler('profile', self._profile))
+        self.app.add_handler(CommandHandler('digest', self._digest))
+        self.app.add_handler(CommandHandler('reload', self._reload))
         self.app.add_handler(
             CommandHandler('locations', self._overview_locations))
+        self.app.add_handler(
+            CommandHandler('coordinates', self._request_forecast_for_point))
+
+        # shared locations carry no text, handle them before the help fallback
+        self.app.add_handler(
+            MessageHandler(filters.LOCATION,
+                           self._request_forecast_for_location))
 
         # add help handler for all other messages
         self.app.add_handler(
             MessageHandler(self._filter_meaningful_messages, self._help))
 
-        subscription_handler = ConversationHandler(
-            entry_points=[
-                CommandHandler('subscribe', self._choose_all_region)
-            ],
-            states={
-                STATION_SELECT_SUBSCRIBE:
-                [MessageHandler(self._filter_regions, self._choose_station)],
-                SUBSCRIBE: [
-                    MessageHandler(self._filter_stations,
-                                   self._subscribe_for_station)
-                ],
-            },
-            fallbacks=[CommandHandler('cancel', self._cancel)],
-            conversation_timeout=TIMEOUT_IN_SEC,
-        )
-
-        one_time_forecast_handler = ConversationHandler(
-            entry_points=[CommandHandler('plots', self._choose_all_region)],
-            states={
-                STATION_SELECT_ONE_TIME: [
-                    MessageHandler(self._filter_regions,
-                                   self._choose_all_station)
-                ],
-                ONE_TIME: [
-                    MessageHandler(self._filter_stations,
-                                   self._request_one_time_forecast_for_station)
-                ],
-            },
-            fallbacks=[CommandHandler('cancel', self._cancel)],
-            conversation_timeout=TIMEOUT_IN_SEC,
-        )
+        # /plots and /subscribe edit a single message with inline keyboards
+        self.app.add_handler(CommandHandler('plots', self._start_plots))
+        self.app.add_handler(CommandHandler('subscribe',
+                                            self._start_subscribe))
+        self.app.add_handler(CommandHandler('history', self._start_history))
+        self.app.add_handler(
+            CallbackQueryHandler(
+                self._handle_inline_keyboard,
+                pattern=
+                f'^({CALLBACK_PLOTS}|{CALLBACK_SUBSCRIBE}|{CALLBACK_HISTORY}):'
+            ))
 
         unsubscription_handler = ConversationHandler(
             entry_points=[CommandHandler('unsubscribe', self._revoke_station)],
@@ -103,64 +148,117 @@ class PlotBot:
             conversation_timeout=TIMEOUT_IN_SEC,
         )
 
-        self.app.add_handler(subscription_handler)
         self.app.add_handler(unsubscription_handler)
-        self.app.add_handler(one_time_forecast_handler)
         self.app.add_error_handler(self._error)
 
         # schedule jobs
-        self.app.job_queue.run_once(
-            self._override_basetime,
-            when=0,
-            name='override basetime',
-        )
-        self.app.job_queue.run_repeating(
-            self._update_basetime,
-            first=120,
-            interval=60,
-            name='update basetime',
-        )
+        self._job_lag = LagProbe(JOB_LAG_SECONDS, METRICS_PROBE_INTERVAL)
         self.app.job_queue.run_repeating(
-            self._cache_plots,
-            interval=30,
-            name='cache plots',
+            self._probe_lag,
+            interval=METRICS_PROBE_INTERVAL,
+            name='probe lag',
         )
         self.app.job_queue.run_repeating(
-            self._broadcast,
-            interval=30,
-            name='broadcast',
+            self._deliver,
+            interval=OUTBOX_INTERVAL,
+            name='deliver',
         )
+        if self._stations_watcher is not None:
+            self.app.job_queue.run_repeating(
+                self._watch_stations,
+                interval=STATIONS_WATCH_INTERVAL,
+                name='watch stations',
+            )
+        if fetch:
+            self.app.job_queue.run_once(
+                self._override_basetime,
+                when=0,
+                name='override basetime',
+            )
+            self.app.job_queue.run_repeating(
+                self._update_basetime,
+                first=120,
+                interval=60,
+                name='update basetime',
+            )
+            self.app.job_queue.run_repeating(
+                self._cache_plots,
+                interval=30,
+                name='cache plots',
+            )
+            self.app.job_queue.run_repeating(
+                self._broadcast,
+                interval=30,
+                name='broadcast',
+            )
+        else:
+            # a separate fetcher worker runs the jobs above
+            self.app.job_queue.run_repeating(
+                self._poll_fetcher,
+                interval=1,
+                name='poll fetcher',
+            )
+
+        self._time_callbacks()
+
+    def _time_callbacks(self):
+        # wall and CPU time of every handler and job, see /profile
+        for handlers in self.app.handlers.values():
+            for handler in handlers:
+                if isinstance(handler, ConversationHandler):
+                    nested = handler.entry_points + handler.fallbacks + [
+                        state_handler
+                        for state_handlers in handler.states.values()
+                        for state_handler in state_handlers
+                    ]
+                else:
+                    nested = [handler]
+                for callback_handler in nested:
+                    callback_handler.callback = self._callback_stats.wrap(
+                        callback_handler.callback,
+                        callback_handler.callback.__name__)
+        for job in self.app.job_queue.jobs():
+            job.callback = self._callback_stats.wrap(job.callback, job.name)
+
+    async def _run_fetch(self, func, *args):
+        # func may use EcmwfApi, handlers keep running while it waits
+        return await asyncio.get_running_loop().run_in_executor(
+            self._fetch_executor, func, *args)
 
     async def _override_basetime(self, context: CallbackContext):
-        self._ecmwf.override_base_time_from_init()
+        if not self._ecmwf.base_time_discovered:
+            # fast start: the bot is already polling, keep it responsive
+            await self._run_fetch(self._ecmwf.discover_base_time)
+        await self._run_fetch(self._ecmwf.override_base_time_from_init)
 
     async def _update_basetime(self, context: CallbackContext):
+        await self._run_fetch(self._upgrade_basetime)
+
+    def _upgrade_basetime(self):
         self._ecmwf.upgrade_basetime_global()
         self._ecmwf.upgrade_basetime_stations()
 
-    async def _process_request(self, context: CallbackContext):
-        job = context.job
-        user_id, station_name = job.data
-
-        plots = self._ecmwf.download_plots([station_name
-                                            ]).get(station_name, None)
-
-        # plots are available
-        if plots and len(plots) > 0:
-            await self._send_plots_to_user(plots, station_name, user_id)
-            job.schedule_removal()
+    def start(self, **kwargs):
+        webhook = self._config['bot'].get('webhook')
+        if webhook:
+            logger.info('Starting bot with webhook {}'.format(webhook['url']))
+            self.app.run_webhook(listen=webhook.get('listen',
+                                                    BOT_WEBHOOK_LISTEN),
+                                 port=webhook.get('port', BOT_WEBHOOK_PORT),
+                                 url_path=webhook.get('url_path', ''),
+                                 webhook_url=webhook['url'],
+                                 secret_token=webhook.get('secret_token'),
+                                 allowed_updates=Update.ALL_TYPES,
+                                 **kwargs)
         else:
-            logger.info(
-                f"Plots not available for {station_name}, rescheduling job.")
-
-    def start(self):
-        logger.info('Starting bot')
-        self.app.run_polling(allowed_updates=Update.ALL_TYPES)
+            logger.info('Starting bot')
+            self.app.run_polling(allowed_updates=Update.ALL_TYPES, **kwargs)
 
     async def _error(self, update: Update, context: CallbackContext):
 
-        if update:
-            user_id = update.message.chat_id
+        if update and update.effective_chat:
+            # callback queries carry no message of the user
+            user_id = update.effective_chat.id
         else:
             user_id = BOT_DEFAULT_USER_ID
         logger.error(f"Exception while handling an update: {context.error}")
@@ -201,9 +299,161 @@ class PlotBot:
             f"_Unique subscribers: {unique_subscribers}_")
         activity_summary_text.append('')
 
+        # Client-side throttling of ECMWF requests, the front-end has no
+        # limiter of its own
+        rate_limits = (self._ecmwf.rate_limit_stats()
+                       if self._ecmwf is not None else {})
+        if rate_limits:
+            activity_summary_text.append('*ECMWF rate limits*')
+            for budget, stats in rate_limits.items():
+                activity_summary_text.append(
+                    f"- {budget}: {stats['acquired']} requests, "
+                    f"{stats['throttled']} throttled, "
+                    f"max wait {stats['max_wait']:.1f}s")
+            activity_summary_text.append('')
+
         activity_summary_text = "\n".join(activity_summary_text)
         await update.message.reply_markdown(activity_summary_text)
 
+    async def _profile(self, update: Update, context: CallbackContext):
+        user_id = update.message.chat_id
+        if user_id not in self._admin_ids:
+            await update.message.reply_text(
+                "You are not authorized to profile the bot.")
+            return
+
+        try:
+            seconds = int(
+                context.args[0]) if context.args else PROFILE_DEFAULT_SECONDS
+        except ValueError:
+            seconds = 0
+        if not 0 < seconds <= PROFILE_MAX_SECONDS:
+            await update.message.reply_text(
+                f"Usage: /profile <seconds>, at most {PROFILE_MAX_SECONDS}")
+            return
+        if self._sampler is not None and self._sampler.running:
+            await update.message.reply_text("A profile is already running.")
+            return
+
+        self._sampler = Sampler().start()
+        self.app.job_queue.run_once(
+            self._callback_stats.wrap(self._finish_profile, 'profile'),
+            when=seconds,
+            chat_id=user_id,
+            data=self._callback_stats.snapshot(),
+            name='profile',
+        )
+        logger.info(f'Profiling for {seconds}s requested by {user_id}')
+        await update.message.reply_text(f"Profiling for {seconds}s...")
+
+    async def _finish_profile(self, context: CallbackContext):
+        self._sampler.stop()
+        path = os.path.join(self._profile_dir,
+                            time.strftime('profile_%Y%m%d_%H%M%S.txt'))
+        self._sampler.write(path)
+        summary = format_summary(self._sampler,
+                                 self._callback_stats.since(context.job.data))
+        await context.bot.send_message(
+            chat_id=context.job.chat_id,
+            text=f'{summary}\n\nFull profile: {os.path.abspath(path)}')
+
+    async def _digest(self, update: Update, context: CallbackContext):
+        user_id = update.message.chat_id
+        if context.args and context.args[0] in ('on', 'off'):
+            enabled = context.args[0] == 'on'
+            self._db.set_digest(user_id, enabled)
+            self._db.log_activity(
+                activity_type=f"digest-{context.args[0]}",
+                user_id=user_id,
+                station=None,
+            )
+        elif context.args:
+            await update.message.reply_text("Usage: /digest on|off")
+            return
+        else:
+            enabled = user_id in self._db.get_digest_users([user_id])
+
+        if enabled:
+            await update.message.reply_text(
+                "Digest is on: the plots of all your subscriptions arrive "
+                "together once a new run is ready for all of them, a "
+                "station lagging behind follows on its own. "
+                "Turn it off with /digest off.")
+        else:
+            await update.message.reply_text(
+                "Digest is off: the plots of every subscription arrive as "
+                "soon as they are available. Turn it on with /digest on.")
+
+    def _set_stations(self, registry):
+        # no await in here, handlers never see a half updated catalog
+        self._registry = registry
+        self._station_names = registry.names
+        self._station_regions = registry.regions
+        # inline keyboards are immutable, build the unfiltered ones once
+        inline_keyboards = {}
+        for flow in (CALLBACK_PLOTS, CALLBACK_SUBSCRIBE, CALLBACK_HISTORY):
+            inline_keyboards[flow] = self._region_inline_keyboard(flow)
+        for flow in (CALLBACK_PLOTS, CALLBACK_HISTORY):
+            for region_index, _ in enumerate(self._station_regions):
+                key = (flow, region_index)
+                inline_keyboards[key] = self._station_inline_keyboard(*key)
+        self._inline_keyboards = inline_keyboards
+        self._filter_stations.set_names(self._station_names)
+        self._filter_regions.set_names(self._station_regions)
+
+    async def reload_stations(self, station_config):
+        """Switch to a new station list without a restart, returns the
+        names of the stations added, removed and changed."""
+        registry = StationRegistry.from_config(station_config)
+        if self._fetch:
+            # not while a download walks the stations
+            diff = await self._run_fetch(self._ecmwf.reload_stations,
+                                         station_config)
+        else:
+            diff = self._registry.diff(registry)
+        self._set_stations(registry)
+        added, removed, changed = diff
+        logger.info('Stations reloaded: %d added, %d removed, %d changed',
+                    len(added), len(removed), len(changed))
+        return diff
+
+    async def _reload_stations_file(self):
+        # a broken file keeps the current stations
+        try:
+            station_config = load_station_config(self._stations_watcher.path)
+        except (OSError, ValueError) as e:
+            logger.error('Stations not reloaded: %s', e)
+            return None
+        return await self.reload_stations(station_config)
+
+    async def _watch_stations(self, context: CallbackContext):
+        if self._stations_watcher.changed():
+            await self._reload_stations_file()
+
+    async def _reload(self, update: Update, context: CallbackContext):
+        user_id = update.message.chat_id
+        if user_id not in self._admin_ids:
+            await update.message.reply_text(
+                "You are not authorized to reload the stations.")
+            return
+        if self._stations_watcher is None:
+            await update.message.reply_text(
+                "Stations are not read from a file.")
+            return
+
+        # the watcher would reload the same file again
+        self._stations_watcher.changed()
+        diff = await self._reload_stations_file()
+        if diff is None:
+            await update.message.reply_text(
+                "Stations not reloaded, see the log for the error.")
+            return
+        lines = [f'{len(self._registry)} stations']
+        for label, names in zip(('Added', 'Removed', 'Changed'), diff):
+            if names:
+                lines.append(f'{label}: {", ".join(names)}')
+        await update.message.reply_text('\n'.join(lines))
+
     async def _overview_locations(self, update: Update,
                                   context: CallbackContext):
         await update.message.reply_markdown("\n".join(
@@ -228,7 +478,11 @@ class PlotBot:
                     \n- To get a list of available locations type /locations. \
                     \n- To subscribe type /subscribe. \
                     \n- To request a forecast type /plots. \
+                    \n- To get a forecast for the nearest location, share your location. \
+                    \n- To get a forecast for any place type /coordinates followed by latitude and longitude, e.g. /coordinates 46.55 7.98. \
                     \n- To unsubscribe type /unsubscribe. \
+                    \n- To get all your subscriptions of a run at once type /digest on. \
+                    \n- To get the plots of a previous run type /history. \
                     \n- To get this message type /help. \
                     \n- To cancel any operation type /cancel. \
                     \n\nAll available commands are also shown in the menu at the bottom of the chat. \
@@ -238,55 +492,8 @@ class PlotBot:
 
         await update.message.reply_markdown(greetings)
 
-    async def _choose_station(self, update: Update,
-                              context: CallbackContext) -> int:
-        region = update.message.text
-        station_of_region = self._get_station_names_for_region(region)
-
-        user_id = update.message.chat_id
-
-        # Get the stations that the user has already subscribed to
-        subscribed_stations = self._db.get_subscriptions_by_user(user_id)
-
-        # Only include stations that the user has not already subscribed to
-        not_subscribed_for_all_stations = await self._send_station_keyboard(
-            update, [
-                name for name in station_of_region
-                if name not in subscribed_stations
-            ])
-
-        return SUBSCRIBE if not_subscribed_for_all_stations else ConversationHandler.END
-
-    async def _choose_all_region(self, update: Update,
-                                 context: CallbackContext) -> int:
-
-        entry_point = update.message.text
-
-        await self._send_region_keyboard(
-            update, [name for name in self._station_regions])
-
-        # check that entry point is valid
-        if entry_point == '/subscribe':
-            return STATION_SELECT_SUBSCRIBE
-        elif entry_point == '/plots':
-            return STATION_SELECT_ONE_TIME
-        else:
-            raise ValueError(f'Invalid entry point: {entry_point}')
-
     def _get_station_names_for_region(self, region) -> list[str]:
-        return sorted([
-            name for name in sorted(self._station_names)
-            if self._region_of_stations[name] == region
-        ])
-
-    async def _choose_all_station(self, update: Update,
-                                  context: CallbackContext) -> int:
-        region = update.message.text
-
-        await self._send_station_keyboard(
-            update, self._get_station_names_for_region(region))
-
-        return ONE_TIME
+        return self._registry.names_for_region(region)
 
     async def _revoke_station(self, update: Update,
                               context: CallbackContext) -> int:
@@ -298,27 +505,21 @@ class PlotBot:
         # Only include stations that the user has already subscribed to
         subscription_present = await self._send_station_keyboard(
             update,
-            sorted([
-                name for name in self._station_names
-                if name in subscribed_stations
-            ]))
+            [name for name in subscribed_stations if name in self._registry])
 
         return UNSUBSCRIBE if subscription_present else ConversationHandler.END
 
-    async def _send_region_keyboard(self, update: Update,
-                                    region_names: list[str]):
-        return await self._send_keyboard(update, region_names, 'region')
+    def _keyboard_markup(self, names: list[str]) -> ReplyKeyboardMarkup:
+        return ReplyKeyboardMarkup([[name] for name in names],
+                                   one_time_keyboard=True)
 
     async def _send_keyboard(self, update: Update, names: list[str],
                              type: str):
-        reply_keyboard = [[name] for name in names]
-
-        if reply_keyboard:
+        if names:
             reply_text = f'Choose a {type}'
             await update.message.reply_text(
                 reply_text,
-                reply_markup=ReplyKeyboardMarkup(reply_keyboard,
-                                                 one_time_keyboard=True),
+                reply_markup=self._keyboard_markup(names),
             )
             return True
         else:
@@ -334,7 +535,7 @@ class PlotBot:
     async def _unsubscribe_for_station(self, update: Update,
                                        context: CallbackContext) -> int:
         user = update.message.from_user
-        msg_text = update.message.text
+        msg_text = self._filter_stations.canonical(update.message.text)
         self._db.remove_subscription(msg_text, user.id)
 
         reply_text = f'Unubscribed for Station {msg_text}'
@@ -352,20 +553,266 @@ class PlotBot:
 
         return ConversationHandler.END
 
-    async def _subscribe_for_station(self, update: Update,
-                                     context: CallbackContext) -> int:
-        user = update.message.from_user
-        msg_text = update.message.text
-        reply_text = f"You sucessfully subscribed for {msg_text}. You will receive your first plots in a minute or two..."
+    def _callback_data(self, flow, action, *indices) -> str:
+        # callback data carries indices, names may exceed its 64 bytes. The
+        # version of the station list tells keyboards of an older one apart
+        return ':'.join([flow, action, self._registry.version] +
+                        [str(index) for index in indices])
+
+    def _region_inline_keyboard(self, flow) -> InlineKeyboardMarkup:
+        return InlineKeyboardMarkup(
+            [[
+                InlineKeyboardButton(
+                    region, callback_data=self._callback_data(flow, 'r', i))
+            ] for i, region in enumerate(self._station_regions)] +
+            [[InlineKeyboardButton('Cancel', callback_data=f'{flow}:x')]])
+
+    def _station_inline_keyboard(
+        self, flow, region_index, exclude=()) -> InlineKeyboardMarkup:
+        names = self._get_station_names_for_region(
+            self._station_regions[region_index])
+        return InlineKeyboardMarkup([[
+            InlineKeyboardButton(name,
+                                 callback_data=self._callback_data(
+                                     flow, 's', region_index, i))
+        ] for i, name in enumerate(names) if name not in exclude] + [[
+            InlineKeyboardButton('« Back', callback_data=f'{flow}:b'),
+            InlineKeyboardButton('Cancel', callback_data=f'{flow}:x')
+        ]])
+
+    def _product_inline_keyboard(self,
+                                 region_index,
+                                 station_index,
+                                 selected=0) -> InlineKeyboardMarkup:
+        # the selection is a bit mask of the offered products, the callback
+        # data carries it until it is confirmed
+        def button(text, action, mask):
+            return InlineKeyboardButton(text,
+                                        callback_data=self._callback_data(
+                                            CALLBACK_SUBSCRIBE, action,
+                                            region_index, station_index, mask))
+
+        toggles = [[
+            button(f'✅ {label}' if selected >> i & 1 else label, 'p',
+                   selected ^ 1 << i)
+        ] for i, label in enumerate(self._products_by_label)]
+        # no selection stands for all products, also those offered later
+        confirm = [button(ALL_PRODUCTS, 'c', 0)]
+        if selected:
+            confirm.append(button('Confirm', 'c', selected))
+        return InlineKeyboardMarkup(toggles + [confirm] + [[
+            InlineKeyboardButton('Cancel',
+                                 callback_data=f'{CALLBACK_SUBSCRIBE}:x')
+        ]])
+
+    def _selected_products(self, selected):
+        if not 0 <= selected < 1 << len(self._products_by_label):
+            raise IndexError('No such selection {}'.format(selected))
+        return [
+            product
+            for i, product in enumerate(self._products_by_label.values())
+            if selected >> i & 1
+        ]
+
+    def _cached_subscriptions(self, context: CallbackContext, user_id):
+        # one query per interaction, kept up to date by the handlers
+        subscriptions = context.user_data.get('subscriptions')
+        if subscriptions is None:
+            subscriptions = set(self._db.get_subscriptions_by_user(user_id))
+            context.user_data['subscriptions'] = subscriptions
+        return subscriptions
+
+    async def _start_plots(self, update: Update, context: CallbackContext):
         await update.message.reply_text(
-            reply_text,
-            reply_markup=ReplyKeyboardRemove(),
+            'Choose a region',
+            reply_markup=self._inline_keyboards[CALLBACK_PLOTS])
+
+    async def _start_subscribe(self, update: Update, context: CallbackContext):
+        context.user_data['subscriptions'] = set(
+            self._db.get_subscriptions_by_user(update.message.chat_id))
+        await update.message.reply_text(
+            'Choose a region',
+            reply_markup=self._inline_keyboards[CALLBACK_SUBSCRIBE])
+
+    async def _start_history(self, update: Update, context: CallbackContext):
+        if self._archive is None:
+            await update.message.reply_text(
+                'Sorry, previous runs are not kept.')
+            return
+        await update.message.reply_text(
+            'Choose a region',
+            reply_markup=self._inline_keyboards[CALLBACK_HISTORY])
+
+    async def _handle_inline_keyboard(self, update: Update,
+                                      context: CallbackContext):
+        query = update.callback_query
+        flow, action, *indices = query.data.split(':')
+        # cancel and back need no station list
+        if indices and indices.pop(0) != self._registry.version:
+            # the positions refer to another station list since a reload
+            await query.answer('List changed, please start again')
+            await query.edit_message_text(
+                'Sorry, the list of stations changed. Please start again.')
+            return
+        await query.answer()
+        try:
+            indices = [int(index) for index in indices]
+            region = self._station_regions[indices[0]] if indices else None
+            names = self._get_station_names_for_region(region)
+            station_name = names[indices[1]] if len(indices) > 1 else None
+            products = self._selected_products(
+                indices[2]) if action in ('p', 'c') else None
+        except (ValueError, IndexError):
+            # keyboard of an outdated station list
+            await query.edit_message_text(
+                'Sorry, this selection is no longer available. Please try again.'
+            )
+            return
+
+        if action == 'x':
+            await query.edit_message_text(
+                'Bye! I hope we can talk again some day.')
+        elif action == 'b':
+            await query.edit_message_text(
+                'Choose a region', reply_markup=self._inline_keyboards[flow])
+        elif action == 'r':
+            await self._show_stations(query, context, flow, indices[0])
+        elif action == 's' and flow == CALLBACK_PLOTS:
+            await self._request_one_time_forecast_for_station(
+                query, station_name)
+        elif action == 's' and flow == CALLBACK_HISTORY:
+            await self._show_runs(query, *indices, station_name)
+        elif action == 't':
+            await self._send_history(query, station_name, indices[2])
+        elif action == 's' and len(self._products_by_label) < 2:
+            await self._add_subscription(query, context, station_name, None)
+        elif action in ('s', 'p'):
+            await query.edit_message_text(
+                f'Choose the plots for {station_name}',
+                reply_markup=self._product_inline_keyboard(*indices))
+        elif action == 'c':
+            await self._add_subscription(query, context, station_name, products
+                                         or None)
+
+    async def _show_stations(self, query, context: CallbackContext, flow,
+                             region_index):
+        if flow != CALLBACK_SUBSCRIBE:
+            markup = self._inline_keyboards[(flow, region_index)]
+        else:
+            # Only include stations that the user has not already subscribed to
+            subscribed_stations = self._cached_subscriptions(
+                context, query.from_user.id)
+            markup = self._station_inline_keyboard(flow, region_index,
+                                                   subscribed_stations)
+            if len(markup.inline_keyboard) == 1:
+                await query.edit_message_text(
+                    'Sorry, no more stations for you here')
+                return
+        await query.edit_message_text('Choose a station', reply_markup=markup)
+
+    async def _show_runs(self, query, region_index, station_index,
+                         station_name):
+        runs = await asyncio.to_thread(self._archive.runs, station_name)
+        if not runs:
+            await query.edit_message_text(
+                f'Sorry, no runs of {station_name} are kept yet.')
+            return
+        # runs are referred to by age, latest first
+        prefix = self._callback_data(CALLBACK_HISTORY, 't', region_index,
+                                     station_index)
+        markup = InlineKeyboardMarkup([[
+            InlineKeyboardButton(run_label(base_time),
+                                 callback_data=f'{prefix}:{i}')
+        ] for i, base_time in enumerate(runs)] + [[
+            InlineKeyboardButton('« Back',
+                                 callback_data=f'{CALLBACK_HISTORY}:b'),
+            InlineKeyboardButton('Cancel',
+                                 callback_data=f'{CALLBACK_HISTORY}:x')
+        ]])
+        await query.edit_message_text(f'Choose a run of {station_name}',
+                                      reply_markup=markup)
+
+    async def _send_history(self, query, station_name, age):
+        user = query.from_user
+        if not await self._allow_request(user.id, query.edit_message_text):
+            return
+        runs = await asyncio.to_thread(self._archive.runs, station_name)
+        if age >= len(runs):
+            # pruned since the keyboard was shown
+            await query.edit_message_text(
+                'Sorry, this run is no longer kept. Please try again.')
+            return
+        base_time = runs[age]
+        plots = await asyncio.to_thread(self._archive.get, station_name,
+                                        base_time)
+        await query.edit_message_text(
+            f'Here are the plots of {station_name} of the {run_label(base_time)} run.'
         )
-        self._db.add_subscription(msg_text, user.id)
+        await self._send_archived_plots(plots, station_name, base_time,
+                                        user.id)
 
-        self._schedule_process_request(f"subscription_{msg_text}_{user.id}",
-                                       data=(user.id, msg_text))
-        logger.info(f' {user.first_name} subscribed for Station {msg_text}')
+        logger.info(
+            f' {user.first_name} requested {station_name} of {base_time}')
+        self._db.log_activity(
+            activity_type="history-request",
+            user_id=user.id,
+            station=station_name,
+        )
+
+    async def _send_archived_plots(self, plots, station_name, base_time,
+                                   user_id) -> bool:
+        # in the configured order, types no longer offered last
+        products = [p for p in self._products_by_label.values() if p in plots]
+        products += sorted(set(plots) - set(products))
+        try:
+            for product in products:
+                await self.app.bot.send_photo(
+                    chat_id=user_id,
+                    photo=plots[product],
+                    filename=f'{station_name}_{product}_{base_time}.png')
+                TELEGRAM_SENDS.inc(method='sendPhoto')
+        except Exception as e:
+            logger.error('Error sending archived plots to user %s: %s',
+                         user_id,
+                         e,
+                         extra={
+                             'station': station_name,
+                             'base_time': base_time,
+                             'chat_id': user_id
+                         })
+            return False
+        return True
+
+    async def _allow_request(self, user_id, reply) -> bool:
+        if self._chat_limiter.try_acquire(user_id):
+            return True
+        SUPPRESSED_REQUESTS.inc(reason='rate_limit')
+        logger.info('Rate limited requests of user %s',
+                    user_id,
+                    extra={'chat_id': user_id})
+        await reply(
+            "That is a lot of requests in a short time. Please wait a minute "
+            "and try again.")
+        return False
+
+    async def _add_subscription(self, query, context: CallbackContext,
+                                msg_text, products):
+        user = query.from_user
+        if not await self._allow_request(user.id, query.edit_message_text):
+            return
+        reply_text = f"You sucessfully subscribed for {msg_text}. You will receive your first plots in a minute or two..."
+        await query.edit_message_text(reply_text)
+        self._db.add_subscription(msg_text, user.id, products)
+        self._cached_subscriptions(context, user.id).add(msg_text)
+
+        if self._enqueue_request(user.id, msg_text, products) is None:
+            # subscribed nevertheless, the plots come with the next run
+            await query.edit_message_text(
+                f"You sucessfully subscribed for {msg_text}. Sorry, the current plots could not be requested, you will receive the plots of the next forecast."
+            )
+        logger.info(
+            f' {user.first_name} subscribed for Station {msg_text}, products: {products or "all"}'
+        )
 
         self._db.log_activity(
             activity_type="subscription",
@@ -373,30 +820,50 @@ class PlotBot:
             station=msg_text,
         )
 
-        return ConversationHandler.END
-
-    def _schedule_process_request(self, job_name, data):
-        self.app.job_queue.run_repeating(self._process_request,
-                                         first=BOT_JOBQUEUE_DELAY,
-                                         interval=60,
-                                         last=BOT_MAX_RESCHEDULE_TIME,
-                                         name=job_name,
-                                         data=data)
-        logger.debug(f"Scheduled job {job_name} with data {data}")
-
-    async def _request_one_time_forecast_for_station(
-            self, update: Update, context: CallbackContext) -> int:
-        user = update.message.from_user
-        msg_text = update.message.text
+    def _enqueue_request(self, user_id, station_name, products):
+        # no base_time: whatever run is available first is delivered. False
+        # for a duplicate, None if the request could not be stored
+        try:
+            queued = self._db.enqueue_request(user_id, station_name, products)
+        except Exception as e:
+            logger.error('Could not queue %s for user %s: %s',
+                         station_name,
+                         user_id,
+                         e,
+                         extra={
+                             'station': station_name,
+                             'chat_id': user_id
+                         })
+            return None
+        if not queued:
+            SUPPRESSED_REQUESTS.inc(reason='duplicate')
+        logger.debug('Queued %s for user %s: %s',
+                     station_name,
+                     user_id,
+                     queued,
+                     extra={
+                         'station': station_name,
+                         'chat_id': user_id
+                     })
+        return queued
+
+    async def _request_one_time_forecast_for_station(self, query, msg_text):
+        user = query.from_user
+        if not await self._allow_request(user.id, query.edit_message_text):
+            return
+        queued = self._enqueue_request(user.id, msg_text, None)
+        if queued is None:
+            await query.edit_message_text(
+                'Sorry, your request failed. Please try again later.')
+            return
+        if not queued:
+            await query.edit_message_text(
+                f"You already requested a forecast for {msg_text}, your plots are on their way."
+            )
+            return
         reply_text = f"You sucessfully requested a forecast for {msg_text}. You will receive your first plots in a minute or two..."
-        await update.message.reply_text(
-            reply_text,
-            reply_markup=ReplyKeyboardRemove(),
-        )
+        await query.edit_message_text(reply_text)
 
-        self._schedule_process_request(
-            f"one_time_forecast_{msg_text}_{user.id}",
-            data=(user.id, msg_text))
         logger.info(
             f' {user.first_name} requested forecast for Station {msg_text}')
 
@@ -406,7 +873,111 @@ class PlotBot:
             station=msg_text,
         )
 
-        return ConversationHandler.END
+    async def _request_forecast_for_location(self, update: Update,
+                                             context: CallbackContext):
+        user = update.message.from_user
+        if not await self._allow_request(user.id, update.message.reply_text):
+            return
+        location = update.message.location
+        nearest = self._registry.nearest(location.latitude,
+                                         location.longitude,
+                                         k=BOT_NEAREST_STATIONS,
+                                         max_distance=BOT_MAX_STATION_DISTANCE)
+
+        if not nearest:
+            # no station close by, forecast for the shared point instead
+            await self._schedule_point_request(update, location.latitude,
+                                               location.longitude)
+            return
+
+        names = ', '.join(f'{Station.name} ({distance:.0f} km)'
+                          for distance, Station in nearest)
+        results = [(Station, self._enqueue_request(user.id, Station.name,
+                                                   None))
+                   for _, Station in nearest]
+        if any(result is None for _, result in results):
+            await update.message.reply_text(
+                'Sorry, your request failed. Please try again later.',
+                reply_markup=ReplyKeyboardRemove())
+            return
+        queued = [Station for Station, result in results if result]
+        if not queued:
+            await update.message.reply_text(
+                f"Nearest location: {names}. You already requested a forecast for it, your plots are on their way.",
+                reply_markup=ReplyKeyboardRemove())
+            return
+        await update.message.reply_text(
+            f"Nearest location: {names}. You will receive your first plots in a minute or two...",
+            reply_markup=ReplyKeyboardRemove())
+
+        for Station in queued:
+            logger.info(
+                f' {user.first_name} requested forecast for nearest Station {Station.name}'
+            )
+            self._db.log_activity(
+                activity_type="location-request",
+                user_id=user.id,
+                station=Station.name,
+            )
+
+    async def _request_forecast_for_point(self, update: Update,
+                                          context: CallbackContext):
+        try:
+            lat, lon = (float(arg) for arg in context.args)
+            if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+                raise ValueError
+        except ValueError:
+            await update.message.reply_text(
+                "Please type latitude and longitude in degrees, e.g. /coordinates 46.55 7.98"
+            )
+            return
+        if not await self._allow_request(update.message.from_user.id,
+                                         update.message.reply_text):
+            return
+        await self._schedule_point_request(update, lat, lon)
+
+    async def _schedule_point_request(self, update: Update, lat, lon):
+        user = update.message.from_user
+        lat, lon = self._ecmwf.snap_point(lat, lon)
+        name = f"point_forecast_{lat}_{lon}_{user.id}"
+        if self.app.job_queue.get_jobs_by_name(name):
+            SUPPRESSED_REQUESTS.inc(reason='duplicate')
+            await update.message.reply_text(
+                f"You already requested a forecast for {lat:.2f}, {lon:.2f}, your plots are on their way.",
+                reply_markup=ReplyKeyboardRemove())
+            return
+        await update.message.reply_text(
+            f"You sucessfully requested a forecast for {lat:.2f}, {lon:.2f}. You will receive your first plots in a minute or two...",
+            reply_markup=ReplyKeyboardRemove())
+
+        self.app.job_queue.run_repeating(self._callback_stats.wrap(
+            self._process_point_request, 'point_forecast'),
+                                         first=BOT_JOBQUEUE_DELAY,
+                                         interval=60,
+                                         last=BOT_MAX_RESCHEDULE_TIME,
+                                         name=name,
+                                         data=(user.id, lat, lon))
+        logger.info(
+            f' {user.first_name} requested forecast for {lat:.2f}, {lon:.2f}')
+
+        self._db.log_activity(
+            activity_type="point-request",
+            user_id=user.id,
+            station=f"{lat:.2f},{lon:.2f}",
+        )
+
+    async def _process_point_request(self, context: CallbackContext):
+        job = context.job
+        user_id, lat, lon = job.data
+
+        name, plots = await self._run_fetch(
+            self._ecmwf.download_plots_for_point, lat, lon)
+
+        if plots and len(plots) > 0:
+            await self._send_plots_to_user(plots, name, user_id)
+            job.schedule_removal()
+        else:
+            logger.info(f"Plots not available for {name}, rescheduling job.")
 
     async def _cancel(self, update: Update, context: CallbackContext) -> int:
         user = update.message.from_user
@@ -417,31 +988,219 @@ class PlotBot:
 
         return ConversationHandler.END
 
+    async def _probe_lag(self, context: CallbackContext):
+        self._job_lag.tick()
+        EVENT_LOOP_LAG_SECONDS.observe(await event_loop_lag())
+
     async def _cache_plots(self, context: CallbackContext):
-        self._ecmwf.cache_plots()
+        await self._run_fetch(self._cache_demanded_plots)
 
-    async def _send_plots_to_user(self, plots, station_name, user_id):
-        logger.debug(f'Send plots of {station_name} to user: {user_id}')
+    def _cache_demanded_plots(self):
+        # the query blocks as well, same as in the fetcher worker
+        self._ecmwf.cache_plots(self._db.get_demanded_products())
 
+    async def _send_plots_to_user(self, plots, station_name, user_id) -> bool:
+        start = time.perf_counter()
         try:
             await self.app.bot.send_message(chat_id=user_id, text=station_name)
+            TELEGRAM_SENDS.inc(method='sendMessage')
             for plot in plots:
-                logger.debug(f'Plot: {plot}')
-                await self.app.bot.send_photo(chat_id=user_id,
-                                              photo=open(plot, 'rb'))
+                # the cached bytes are shared by all recipients of a run
+                await self.app.bot.send_photo(
+                    chat_id=user_id,
+                    photo=self._ecmwf.plot_cache.get(plot),
+                    filename=os.path.basename(plot))
+                TELEGRAM_SENDS.inc(method='sendPhoto')
+        except Exception as e:
+            logger.error('Error sending plots to user %s: %s',
+                         user_id,
+                         e,
+                         extra={
+                             'station': station_name,
+                             'chat_id': user_id
+                         })
+            return False
+        duration = time.perf_counter() - start
+        logger.debug('Sent %d plots of %s to user %s in %.2fs',
+                     len(plots),
+                     station_name,
+                     user_id,
+                     duration,
+                     extra={
+                         'station': station_name,
+                         'chat_id': user_id,
+                         'duration': duration
+                     })
+        return True
+
+    async def _send_digest_to_user(self, plots_by_station, user_id) -> bool:
+        # albums of up to MEDIA_GROUP_SIZE photos, every station's first
+        # photo is captioned with its name
+        photos = [(plot, station_name if i == 0 else None)
+                  for station_name, plots in plots_by_station
+                  for i, plot in enumerate(plots)]
+        start = time.perf_counter()
+        try:
+            for i in range(0, len(photos), MEDIA_GROUP_SIZE):
+                group = photos[i:i + MEDIA_GROUP_SIZE]
+                if len(group) == 1:
+                    # albums need at least two photos
+                    plot, caption = group[0]
+                    await self.app.bot.send_photo(
+                        chat_id=user_id,
+                        photo=self._ecmwf.plot_cache.get(plot),
+                        caption=caption,
+                        filename=os.path.basename(plot))
+                    TELEGRAM_SENDS.inc(method='sendPhoto')
+                    continue
+                await self.app.bot.send_media_group(
+                    chat_id=user_id,
+                    media=[
+                        InputMediaPhoto(self._ecmwf.plot_cache.get(plot),
+                                        caption=caption,
+                                        filename=os.path.basename(plot))
+                        for plot, caption in group
+                    ])
+                TELEGRAM_SENDS.inc(method='sendMediaGroup')
         except Exception as e:
-            logger.error(f'Error sending plots to user {user_id}: {e}')
+            logger.error('Error sending digest to user %s: %s',
+                         user_id,
+                         e,
+                         extra={'chat_id': user_id})
+            return False
+        duration = time.perf_counter() - start
+        logger.debug('Sent digest of %d stations to user %s in %.2fs',
+                     len(plots_by_station),
+                     user_id,
+                     duration,
+                     extra={
+                         'chat_id': user_id,
+                         'duration': duration
+                     })
+        return True
 
     async def _broadcast(self, context: CallbackContext):
-        latest_plots = self._ecmwf.download_latest_plots(
-            self._db.stations_with_subscribers())
-        if latest_plots:
-            for station_name, plots in latest_plots.items():
-                if len(plots) == 0:
-                    continue
-                else:
-                    for user_id in self._db.get_subscriptions_by_station(
-                            station_name):
-                        await self._send_plots_to_user(plots, station_name,
-                                                       user_id)
-                    logger.info(f'Broadcasted {station_name}')
+        await self._run_fetch(queue_broadcast, self._ecmwf, self._db)
+
+    async def _poll_fetcher(self, context: CallbackContext):
+        # deliver right away once the fetcher reports new plots
+        if self._ecmwf.poll():
+            await self._deliver(context)
+
+    async def _lookup_plots(self, delivery, plots_by_request):
+        # False if a newer run is queued already, many deliveries of a
+        # batch share the same plots
+        station_name = delivery['station']
+        products = delivery['products']
+        if delivery['base_time'] not in (
+                None, self._ecmwf.station_base_time(station_name)):
+            return False
+        request = (station_name,
+                   tuple(products) if products is not None else None)
+        if request not in plots_by_request:
+            plots = await self._run_fetch(self._ecmwf.download_plots,
+                                          [station_name],
+                                          {station_name: products})
+            plots_by_request[request] = plots.get(station_name)
+        plots = plots_by_request[request]
+        if not plots:
+            logger.debug('Plots not available for %s',
+                         station_name,
+                         extra={
+                             'station': station_name,
+                             'chat_id': delivery['chat_id']
+                         })
+        return plots
+
+    async def _deliver(self, context: CallbackContext):
+        deliveries = self._db.claim_deliveries(OUTBOX_BATCH_SIZE, OUTBOX_LEASE,
+                                               BOT_MAX_RESCHEDULE_TIME)
+        if not deliveries:
+            return
+
+        start = time.perf_counter()
+        outcome = {
+            status: []
+            for status in ('sent', 'expired', 'waiting', 'failed', 'held')
+        }
+        plots_by_request = {}
+        # broadcasts of a run to digest users are sent together
+        digest_users = self._db.get_digest_users({
+            delivery['chat_id']
+            for delivery in deliveries if delivery['base_time'] is not None
+        })
+        digests = []
+        for delivery in deliveries:
+            if (delivery['chat_id'] in digest_users
+                    and delivery['base_time'] is not None):
+                digest = (delivery['chat_id'], delivery['base_time'])
+                if digest not in digests:
+                    digests.append(digest)
+                continue
+
+            plots = await self._lookup_plots(delivery, plots_by_request)
+            if plots is False:
+                outcome['expired'].append(delivery['id'])
+            elif not plots:
+                outcome['waiting'].append(delivery['id'])
+            elif await self._send_plots_to_user(plots, delivery['station'],
+                                                delivery['chat_id']):
+                outcome['sent'].append(delivery['id'])
+            else:
+                outcome['failed'].append(delivery['id'])
+
+        for chat_id, base_time in digests:
+            await self._deliver_digest(chat_id, base_time, plots_by_request,
+                                       outcome)
+
+        self._db.ack_deliveries(outcome['sent'])
+        self._db.ack_deliveries(outcome['expired'], status='expired')
+        self._db.retry_deliveries(outcome['waiting'], OUTBOX_RETRY_DELAY)
+        self._db.fail_deliveries(outcome['failed'], OUTBOX_RETRY_DELAY,
+                                 OUTBOX_MAX_ATTEMPTS)
+        self._db.hold_deliveries(outcome['held'], self._digest_deadline)
+        for status, ids in outcome.items():
+            DELIVERIES.inc(len(ids), status=status)
+        duration = time.perf_counter() - start
+        logger.info('Delivered %d of %d plot sets in %.2fs',
+                    len(outcome['sent']),
+                    sum(len(ids) for ids in outcome.values()),
+                    duration,
+                    extra={'duration': duration})
+
+    async def _deliver_digest(self, chat_id, base_time, plots_by_request,
+                              outcome):
+        deliveries = self._db.claim_digest(chat_id, base_time, OUTBOX_LEASE,
+                                           self._digest_deadline)
+        stations = {delivery['station'] for delivery in deliveries}
+        missing = set(self._db.get_subscriptions_by_user(chat_id)) - stations
+        # wait only for the stations of the chat whose plots of the run are
+        # still fetched, a station lagging behind follows on its own
+        pending = [
+            station_name for station_name in missing
+            if self._ecmwf.station_base_time(station_name) == base_time
+            and self._ecmwf.broadcast_pending(station_name)
+        ]
+        if pending and not any(delivery['overdue'] for delivery in deliveries):
+            outcome['held'].extend(delivery['id'] for delivery in deliveries)
+            return
+
+        ready = []
+        for delivery in deliveries:
+            plots = await self._lookup_plots(delivery, plots_by_request)
+            if plots is False:
+                outcome['expired'].append(delivery['id'])
+            elif not plots:
+                outcome['waiting'].append(delivery['id'])
+            else:
+                ready.append((delivery, plots))
+        if not ready:
+            return
+
+        ids = [delivery['id'] for delivery, _ in ready]
+        if await self._send_digest_to_user([(delivery['station'], plots)
+                                            for delivery, plots in ready],
+                                           chat_id):
+            outcome['sent'].extend(ids)
+        else:
+            outcome['failed'].extend(ids)
@@ -3,11 +3,95 @@ D10_EPS = 'classical_10d'
 D15_EPS = 'classical_15d'
 
 ALL_EPSGRAM = [D10_PLUME, D10_EPS, D15_EPS]
+EPSGRAM_LABELS = {
+    D10_PLUME: '10-day plume',
+    D10_EPS: '10-day meteogram',
+    D15_EPS: '15-day meteogram',
+}
+ALL_PRODUCTS = 'All products'
 TIMEOUT_IN_SEC = 60
-STATION_SELECT_ONE_TIME, STATION_SELECT_SUBSCRIBE, ONE_TIME, SUBSCRIBE, UNSUBSCRIBE = range(
-    5)
+UNSUBSCRIBE = 0
+# prefixes of the callback data of the inline keyboards
+CALLBACK_PLOTS = 'p'
+CALLBACK_SUBSCRIBE = 's'
+CALLBACK_HISTORY = 'h'
 VALID_SUMMARY_INTERVALS = ['24 HOURS', '7 DAYS', '30 DAYS', '1 YEAR']
 
 BOT_DEFAULT_USER_ID = 999
 BOT_MAX_RESCHEDULE_TIME = 600  # [s]
+# requests of a single chat, rate in requests per second
+CHAT_RATE_LIMIT_RATE = 0.1
+CHAT_RATE_LIMIT_BURST = 5
+CHAT_RATE_LIMIT_MAX_CHATS = 10000
+STATIONS_FILE = 'stations.yaml'
+STATIONS_WATCH_INTERVAL = 10  # [s] between two checks for changes
 BOT_JOBQUEUE_DELAY = 10  # [s]
+OUTBOX_INTERVAL = 5  # [s] between two delivery batches
+OUTBOX_BATCH_SIZE = 50
+OUTBOX_LEASE = 300  # [s] until a claimed delivery is handed out again
+OUTBOX_RETRY_DELAY = 60  # [s]
+OUTBOX_MAX_ATTEMPTS = 5
+# [s] a digest waits at most this long for the subscribed stations of a run
+DIGEST_DEADLINE = 3 * 3600
+MEDIA_GROUP_SIZE = 10  # photos per album, limit of the Bot API
+WORKER_SOCKET_DIR = '/tmp/ensplotbot'
+BOT_NEAREST_STATIONS = 1
+BOT_MAX_STATION_DISTANCE = 50  # [km]
+BOT_CONCURRENT_UPDATES = 8
+BOT_WEBHOOK_LISTEN = '127.0.0.1'
+BOT_WEBHOOK_PORT = 8443
+BOT_COMMANDS = [
+    '/locations', '/subscribe', '/unsubscribe', '/plots', '/help', '/cancel',
+    '/start', '/stats', '/coordinates', '/profile', '/digest', '/reload',
+    '/history'
+]
+
+PLOT_CACHE_MAX_BYTES = 64 * 1024 * 1024  # [bytes]
+IMAGE_DOWNLOAD_CHUNK_SIZE = 64 * 1024  # [bytes]
+PLOT_OPTIMIZE_LEVEL = 9  # zlib level of recompressed plots
+PLOT_OPTIMIZE_WORKERS = 2  # processes
+# previous runs kept for /history
+ARCHIVE_KEEP_RUNS = 10  # per station
+ARCHIVE_MAX_BYTES = 512 * 1024 * 1024  # [bytes]
+ARCHIVE_INDEX = 'index.sqlite'
+
+ECMWF_REQUEST_TIMEOUT = 10  # [s]
+RETRY_TRIES = 5
+RETRY_BASE_DELAY = 0.5  # [s]
+RETRY_MAX_DELAY = 8  # [s]
+RETRY_DEADLINE = 20  # [s]
+RETRYABLE_STATUS_CODES = [408, 429, 500, 502, 503, 504]
+CIRCUIT_FAILURE_THRESHOLD = 5
+CIRCUIT_RESET_TIMEOUT = 60  # [s]
+
+# client-side request budgets for the opencharts API
+RATE_LIMIT_METADATA_RATE = 10  # [requests/s]
+RATE_LIMIT_METADATA_BURST = 20
+RATE_LIMIT_IMAGE_RATE = 5  # [requests/s]
+RATE_LIMIT_IMAGE_BURST = 10
+
+# Prometheus metrics
+METRICS_LISTEN = '127.0.0.1'
+METRICS_PORT = 9464
+METRICS_PROBE_INTERVAL = 1  # [s] between two job and event loop lag probes
+METRICS_BUCKETS = [
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60
+]  # [s]
+
+# /profile admin command
+PROFILE_DEFAULT_SECONDS = 30
+PROFILE_MAX_SECONDS = 600
+PROFILE_SAMPLE_INTERVAL = 0.005  # [s]
+PROFILE_TOP_N = 15
+
+# forecasts for arbitrary coordinates
+ADHOC_GRID_SIZE = 0.1  # [deg]
+ADHOC_MAX_LOCATIONS = 100
+ADHOC_TTL = 12 * 3600  # [s]
+ADHOC_REGION = 'Ad hoc'
+
+# logging
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+# extra fields of a record written by the json format
+LOG_FIELDS = ['station', 'base_time', 'chat_id', 'duration']
+LOG_FORMATS = ['text', 'json']
@@ -4,6 +4,7 @@ from psycopg2.extras import DictCursor
 from datetime import datetime
 from logger_config import logger
 from constants import VALID_SUMMARY_INTERVALS
+from metrics import DB_QUERY_SECONDS, timed
 
 
 class Database:
@@ -46,19 +47,73 @@ class Database:
                         UNIQUE (station, user_id)
                     )
                 """)
+                # epsgram types of a subscription, NULL for all of them
+                cursor.execute(f"""
+                    ALTER TABLE subscriptions_{self._table_suffix}
+                    ADD COLUMN IF NOT EXISTS products TEXT
+                """)
+
+                # outbox of plot deliveries, base_time is NULL for
+                # requests of whatever run is available
+                cursor.execute(f"""
+                    CREATE TABLE IF NOT EXISTS outbox_{self._table_suffix} (
+                        id SERIAL PRIMARY KEY,
+                        chat_id BIGINT NOT NULL,
+                        station TEXT NOT NULL,
+                        base_time TEXT,
+                        products TEXT,
+                        status VARCHAR(20) NOT NULL DEFAULT 'pending',
+                        attempts INTEGER NOT NULL DEFAULT 0,
+                        created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+                        next_attempt_at TIMESTAMP NOT NULL DEFAULT NOW(),
+                        UNIQUE (chat_id, station, base_time)
+                    )
+                """)
+                # one open request per chat and station, duplicates from
+                # before the index existed are dropped
+                cursor.execute(f"""
+                    UPDATE outbox_{self._table_suffix} AS o
+                    SET status = 'expired'
+                    WHERE base_time IS NULL AND status IN ('pending', 'claimed')
+                    AND EXISTS (
+                        SELECT 1 FROM outbox_{self._table_suffix} AS d
+                        WHERE d.chat_id = o.chat_id AND d.station = o.station
+                        AND d.base_time IS NULL
+                        AND d.status IN ('pending', 'claimed') AND d.id < o.id
+                    )
+                """)
+                cursor.execute(f"""
+                    CREATE UNIQUE INDEX IF NOT EXISTS outbox_{self._table_suffix}_open_requests
+                    ON outbox_{self._table_suffix} (chat_id, station)
+                    WHERE base_time IS NULL AND status IN ('pending', 'claimed')
+                """)
+                # users who get all subscribed stations of a run at once
+                cursor.execute(f"""
+                    CREATE TABLE IF NOT EXISTS digest_{self._table_suffix} (
+                        user_id BIGINT PRIMARY KEY
+                    )
+                """)
+                cursor.execute(f"""
+                    CREATE INDEX IF NOT EXISTS outbox_{self._table_suffix}_due
+                    ON outbox_{self._table_suffix} (next_attempt_at)
+                    WHERE status IN ('pending', 'claimed')
+                """)
             connection.commit()
         finally:
             connection.close()
 
-    def add_subscription(self, station, user_id):
+    @timed(DB_QUERY_SECONDS)
+    def add_subscription(self, station, user_id, products=None):
         sql = f"""
-            INSERT INTO subscriptions_{self._table_suffix} (station, user_id)
-            VALUES (%s, %s)
-            ON CONFLICT (station, user_id) DO NOTHING
+            INSERT INTO subscriptions_{self._table_suffix} (station, user_id, products)
+            VALUES (%s, %s, %s)
+            ON CONFLICT (station, user_id) DO UPDATE SET products = EXCLUDED.products
         """
-        values = (station, user_id)
+        values = (station, user_id,
+                  ','.join(products) if products is not None else None)
         self._execute_query_with_value(sql, values)
 
+    @timed(DB_QUERY_SECONDS)
     def remove_subscription(self, station, user_id):
         sql = f"""
             DELETE FROM subscriptions_{self._table_suffix}
@@ -67,6 +122,7 @@ class Database:
         values = (station, user_id)
         self._execute_query_with_value(sql, values)
 
+    @timed(DB_QUERY_SECONDS)
     def get_subscriptions_by_user(self, user_id) -> list[str]:
         sql = f"""
             SELECT station
@@ -80,7 +136,11 @@ class Database:
         else:
             return []
 
+    @timed(DB_QUERY_SECONDS)
     def stations_with_subscribers(self):
+        return self._stations_with_subscribers()
+
+    def _stations_with_subscribers(self):
         sql = f"""
             SELECT DISTINCT station
             FROM subscriptions_{self._table_suffix}
@@ -88,7 +148,11 @@ class Database:
         stations = self._select(sql)
         return sorted([station['station'] for station in stations])
 
+    @timed(DB_QUERY_SECONDS)
     def get_subscriptions_by_station(self, station) -> list[int]:
+        return self._subscriptions_by_station(station)
+
+    def _subscriptions_by_station(self, station):
         sql = f"""
             SELECT user_id
             FROM subscriptions_{self._table_suffix}
@@ -101,6 +165,40 @@ class Database:
         else:
             return []
 
+    @timed(DB_QUERY_SECONDS)
+    def get_products_by_station(self, station) -> dict[int, list[str]]:
+        # None stands for all products
+        sql = f"""
+            SELECT user_id, products
+            FROM subscriptions_{self._table_suffix}
+            WHERE station = %s
+            ORDER BY user_id
+        """
+        subscriptions = self._select_with_values(sql, (station, )) or []
+        return {
+            subscription['user_id']: _split_products(subscription['products'])
+            for subscription in subscriptions
+        }
+
+    @timed(DB_QUERY_SECONDS)
+    def get_demanded_products(self) -> dict[str, list[str]]:
+        # union of the products subscribed per station, None for all
+        sql = f"""
+            SELECT station, products
+            FROM subscriptions_{self._table_suffix}
+        """
+        demand = {}
+        for subscription in self._select(sql) or []:
+            station = subscription['station']
+            products = _split_products(subscription['products'])
+            if products is None or demand.get(station, []) is None:
+                demand[station] = None
+            else:
+                demand[station] = sorted(
+                    set(demand.get(station, [])).union(products))
+        return dict(sorted(demand.items()))
+
+    @timed(DB_QUERY_SECONDS)
     def count_unique_subscribers(self) -> list[int]:
         sql = f"""
             SELECT DISTINCT user_id
@@ -109,15 +207,178 @@ class Database:
         subscribers = self._select(sql)
         return len([subscriber['user_id'] for subscriber in subscribers])
 
+    @timed(DB_QUERY_SECONDS)
     def get_subscription_summary(self) -> list[str]:
-        stations = self.stations_with_subscribers()
+        # the helpers are not timed, the summary is observed once
+        stations = self._stations_with_subscribers()
         summary = []
         for station in stations:
             summary.append(
-                f"{station}: {len(self.get_subscriptions_by_station(station))}"
-            )
+                f"{station}: {len(self._subscriptions_by_station(station))}")
         return summary
 
+    @timed(DB_QUERY_SECONDS)
+    def enqueue_deliveries(self, deliveries):
+        # deliveries are (chat_id, station, base_time, products), a run is
+        # queued only once per chat and station
+        sql = f"""
+            INSERT INTO outbox_{self._table_suffix} (chat_id, station, base_time, products)
+            VALUES (%s, %s, %s, %s)
+            ON CONFLICT (chat_id, station, base_time) DO NOTHING
+        """
+        values = [(chat_id, station, base_time,
+                   ','.join(products) if products is not None else None)
+                  for chat_id, station, base_time, products in deliveries]
+        if values:
+            self._execute_many(sql, values)
+
+    @timed(DB_QUERY_SECONDS)
+    def enqueue_request(self, chat_id, station, products=None) -> bool:
+        # whatever run is available first, False if the chat has an open
+        # request for the station already
+        sql = f"""
+            INSERT INTO outbox_{self._table_suffix} (chat_id, station, base_time, products)
+            VALUES (%s, %s, NULL, %s)
+            ON CONFLICT DO NOTHING
+            RETURNING id
+        """
+        values = (chat_id, station,
+                  ','.join(products) if products is not None else None)
+        return bool(self._execute_and_fetch([(sql, values)]))
+
+    @timed(DB_QUERY_SECONDS)
+    def claim_deliveries(self, limit, lease, max_age) -> list[dict]:
+        # claimed rows return to the queue once the lease expired, e.g.
+        # after a crash; requests without base_time give up after max_age
+        expire_sql = f"""
+            UPDATE outbox_{self._table_suffix}
+            SET status = 'expired'
+            WHERE status IN ('pending', 'claimed') AND base_time IS NULL
+            AND created_at < NOW() - %s * INTERVAL '1 second'
+        """
+        claim_sql = f"""
+            UPDATE outbox_{self._table_suffix}
+            SET status = 'claimed',
+                next_attempt_at = NOW() + %s * INTERVAL '1 second'
+            WHERE id IN (
+                SELECT id FROM outbox_{self._table_suffix}
+                WHERE status IN ('pending', 'claimed') AND next_attempt_at <= NOW()
+                ORDER BY id
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id, chat_id, station, base_time, products
+        """
+        rows = self._execute_and_fetch([(expire_sql, (max_age, )),
+                                        (claim_sql, (lease, limit))])
+        return [
+            dict(row, products=_split_products(row['products']))
+            for row in sorted(rows or [], key=lambda row: row['id'])
+        ]
+
+    @timed(DB_QUERY_SECONDS)
+    def ack_deliveries(self, ids, status='sent'):
+        sql = f"""
+            UPDATE outbox_{self._table_suffix}
+            SET status = %s
+            WHERE id = ANY(%s)
+        """
+        if ids:
+            self._execute_query_with_value(sql, (status, list(ids)))
+
+    @timed(DB_QUERY_SECONDS)
+    def retry_deliveries(self, ids, delay):
+        # plots not ready yet, try again later without counting an attempt
+        sql = f"""
+            UPDATE outbox_{self._table_suffix}
+            SET status = 'pending',
+                next_attempt_at = NOW() + %s * INTERVAL '1 second'
+            WHERE id = ANY(%s)
+        """
+        if ids:
+            self._execute_query_with_value(sql, (delay, list(ids)))
+
+    @timed(DB_QUERY_SECONDS)
+    def reschedule_deliveries(self, station):
+        # plots just became available, deliver without waiting
+        sql = f"""
+            UPDATE outbox_{self._table_suffix}
+            SET next_attempt_at = NOW()
+            WHERE station = %s AND status = 'pending'
+        """
+        self._execute_query_with_value(sql, (station, ))
+
+    @timed(DB_QUERY_SECONDS)
+    def claim_digest(self, chat_id, base_time, lease, deadline) -> list[dict]:
+        # all open deliveries of a run for a chat, overdue once the oldest
+        # waited for deadline seconds
+        sql = f"""
+            UPDATE outbox_{self._table_suffix}
+            SET status = 'claimed',
+                next_attempt_at = NOW() + %s * INTERVAL '1 second'
+            WHERE chat_id = %s AND base_time = %s
+            AND status IN ('pending', 'claimed')
+            RETURNING id, chat_id, station, base_time, products,
+                created_at < NOW() - %s * INTERVAL '1 second' AS overdue
+        """
+        rows = self._execute_and_fetch([(sql, (lease, chat_id, base_time,
+                                               deadline))])
+        return [
+            dict(row, products=_split_products(row['products']))
+            for row in sorted(rows or [], key=lambda row: row['id'])
+        ]
+
+    @timed(DB_QUERY_SECONDS)
+    def hold_deliveries(self, ids, deadline):
+        # wait for the rest of a digest, at most until deadline seconds
+        # after the delivery was queued
+        sql = f"""
+            UPDATE outbox_{self._table_suffix}
+            SET status = 'pending',
+                next_attempt_at = created_at + %s * INTERVAL '1 second'
+            WHERE id = ANY(%s)
+        """
+        if ids:
+            self._execute_query_with_value(sql, (deadline, list(ids)))
+
+    @timed(DB_QUERY_SECONDS)
+    def fail_deliveries(self, ids, delay, max_attempts):
+        sql = f"""
+            UPDATE outbox_{self._table_suffix}
+            SET attempts = attempts + 1,
+                status = CASE WHEN attempts + 1 >= %s THEN 'failed' ELSE 'pending' END,
+                next_attempt_at = NOW() + %s * INTERVAL '1 second'
+            WHERE id = ANY(%s)
+        """
+        if ids:
+            self._execute_query_with_value(sql,
+                                           (max_attempts, delay, list(ids)))
+
+    @timed(DB_QUERY_SECONDS)
+    def set_digest(self, user_id, enabled):
+        if enabled:
+            sql = f"""
+                INSERT INTO digest_{self._table_suffix} (user_id)
+                VALUES (%s)
+                ON CONFLICT (user_id) DO NOTHING
+            """
+        else:
+            sql = f"""
+                DELETE FROM digest_{self._table_suffix}
+                WHERE user_id = %s
+            """
+        self._execute_query_with_value(sql, (user_id, ))
+
+    @timed(DB_QUERY_SECONDS)
+    def get_digest_users(self, user_ids) -> set[int]:
+        sql = f"""
+            SELECT user_id
+            FROM digest_{self._table_suffix}
+            WHERE user_id = ANY(%s)
+        """
+        users = self._select_with_values(sql, (list(user_ids), )) or []
+        return {user['user_id'] for user in users}
+
     def _select_with_values(self, sql, values):
         connection = self._get_db_connection()
         try:
@@ -129,6 +390,7 @@ class Database:
         finally:
             connection.close()
 
+    @timed(DB_QUERY_SECONDS)
     def log_activity(self, activity_type, user_id, station):
         sql = f"""
             INSERT INTO activity_{self._table_suffix} (activity_type, user_id, station, timestamp)
@@ -137,6 +399,7 @@ class Database:
         values = (activity_type, user_id, station, datetime.now())
         self._execute_query_with_value(sql, values)
 
+    @timed(DB_QUERY_SECONDS)
     def get_activity_summary(self, interval: str) -> list[str]:
         if interval not in VALID_SUMMARY_INTERVALS:
             raise ValueError(
@@ -166,6 +429,38 @@ class Database:
         finally:
             connection.close()
 
+    def _execute_many(self, sql, values):
+        connection = self._get_db_connection()
+        try:
+            with connection.cursor() as cursor:
+                cursor.executemany(sql, values)
+            connection.commit()
+        except Exception as e:
+            # the caller must know whether the rows are stored
+            logger.error(f"{e} with SQL: {sql} and values: {values}")
+            connection.rollback()
+            raise
+        finally:
+            connection.close()
+
+    def _execute_and_fetch(self, statements):
+        # all statements in one transaction, rows of the last one
+        connection = self._get_db_connection()
+        try:
+            with connection.cursor() as cursor:
+                for sql, values in statements:
+                    cursor.execute(sql, values)
+                rows = cursor.fetchall()
+            connection.commit()
+            return rows
+        except Exception as e:
+            # no rows is an answer, e.g. a duplicate request
+            logger.error(f"{e} with SQL: {statements}")
+            connection.rollback()
+            raise
+        finally:
+            connection.close()
+
     def _execute_query_with_value(self, sql, values):
         connection = self._get_db_connection()
         try:
@@ -176,3 +471,7 @@ class Database:
             logger.error(f"{e} with SQL: {sql} and values: {values}")
         finally:
             connection.close()
+
+
+def _split_products(products):
+    return products.split(',') if products is not None else None
@@ -1,44 +1,230 @@
 import requests
 import json
 import datetime
-import retry
-
-import pandas as pd
-
-from constants import ALL_EPSGRAM
-from location import APILocation
+import hashlib
+import os
+import time
+from urllib.parse import urlparse
+
+from constants import (EPSGRAM_LABELS, IMAGE_DOWNLOAD_CHUNK_SIZE,
+                       ECMWF_REQUEST_TIMEOUT, RATE_LIMIT_METADATA_RATE,
+                       RATE_LIMIT_METADATA_BURST, RATE_LIMIT_IMAGE_RATE,
+                       RATE_LIMIT_IMAGE_BURST)
+from registry import StationRegistry
+from location import plot_path
+from adhoc import AdHocLocations
+from archive import PlotArchive
 from logger_config import logger
+from plot_cache import PlotCache
+from plot_optimizer import PlotOptimizer
+from pngfile import validate_png
+from state import StateStore
+from resilience import RetryPolicy, CircuitBreaker, RetryableError
+from ratelimit import TokenBucket
+from metrics import (ECMWF_REQUESTS, ECMWF_REQUEST_SECONDS, CACHED_STATIONS,
+                     RATE_LIMIT_WAIT_SECONDS)
 
 
 class EcmwfApi():
 
-    def __init__(self, station_config):
-
-        self._API_URL = "https://charts.ecmwf.int/opencharts-api/v1/"
-        self._stations = [
-            APILocation(**station_data) for station_data in station_config
-        ]
+    def __init__(self, station_config, config=None, discover_base_time=True):
+
+        self._config = config or {}
+        self._API_URL = self._config.get(
+            'api_url', "https://charts.ecmwf.int/opencharts-api/v1/")
+        self._timeout = self._config.get('timeout', ECMWF_REQUEST_TIMEOUT)
+        self._retry_policy = RetryPolicy.from_config(self._config.get('retry'))
+        self._circuit_breakers = {}
+        rate_limit_config = self._config.get('rate_limit', {})
+        self._rate_limiters = {
+            'metadata':
+            TokenBucket.from_config(rate_limit_config.get('metadata'),
+                                    RATE_LIMIT_METADATA_RATE,
+                                    RATE_LIMIT_METADATA_BURST),
+            'image':
+            TokenBucket.from_config(rate_limit_config.get('image'),
+                                    RATE_LIMIT_IMAGE_RATE,
+                                    RATE_LIMIT_IMAGE_BURST),
+        }
+        # epsgram types offered to users, name -> label
+        self.products = dict(self._config.get('products', EPSGRAM_LABELS))
+        self._epsgrams = list(self.products)
+        self._registry = StationRegistry.from_config(station_config)
+        self._adhoc = AdHocLocations(on_evict=self._remove_plots)
         self._time_format = '%Y-%m-%dT%H:%M:%SZ'
-        self._base_time = self._fetch_available_base_time(fallback=True,
-                                                          timeshift=0)
+        self.plot_cache = PlotCache()
+        self._optimizer = PlotOptimizer.from_config(
+            self._config.get('optimize'))
+        # plots downloaded since the last optimization
+        self._unoptimized = []
+        # plots are recompressed once, at download or in the archive
+        self._archive = PlotArchive.from_config(self._config.get('archive'),
+                                                optimized=self._optimizer
+                                                is not None)
+        # ETag, Last-Modified and sha256 of every plot on disk
+        self._image_validators = {}
+
+        state_file = self._config.get('state_file')
+        self._state = StateStore(state_file) if state_file else None
+        # set by every change of the snapshot, saving it stats every plot
+        self._state_dirty = True
+        state = self._state.load() if self._state is not None else {}
+
+        self.base_time_discovered = discover_base_time
+        if discover_base_time:
+            self._base_time = self._fetch_available_base_time(fallback=True,
+                                                              timeshift=0)
+        else:
+            # provisional without network access, see discover_base_time
+            self._base_time = state.get('base_time',
+                                        self._first_guess_base_time())
 
         # for performance reasons we set to base_time from API-schema, can be wrong
         # so we need to check if it is valid after the init of all stations
         logger.info('base_time set to {}'.format(self._base_time))
-        for Station in self._stations:
+        for Station in self._registry:
             Station.base_time = self._base_time
 
+        self._restored_stations = self._restore_state(state)
+        CACHED_STATIONS.set_function(self._cached_stations_by_base_time)
+
+    @property
+    def base_time(self):
+        return self._base_time
+
+    @property
+    def _stations(self):
+        return self._registry.stations
+
+    @_stations.setter
+    def _stations(self, stations):
+        self._registry = StationRegistry(stations)
+
+    def discover_base_time(self):
+        base_time = self._fetch_available_base_time(fallback=True, timeshift=0)
+        if base_time != self._base_time:
+            logger.info('base_time discovered as {}'.format(base_time))
+            self._base_time = base_time
+            for Station in self._registry:
+                # same as at init: never broadcast a run found at startup
+                if (Station.name not in self._restored_stations
+                        or Station.base_time > base_time):
+                    Station.base_time = base_time
+                    Station.has_been_broadcasted = True
+                    Station.plots_cached = False
+                    Station.cached_products = set()
+            self._state_dirty = True
+            self._save_state()
+        self.base_time_discovered = True
+
+    def reload_stations(self, station_config):
+        """Switch to a new station list, returns the names of the stations
+        added, removed and changed.
+
+        Unchanged stations keep their state and plots, plots of removed
+        stations and stations at a new place are deleted.
+        """
+        registry = StationRegistry.from_config(station_config)
+        added, removed, changed = self._registry.diff(registry)
+        stations = []
+        for Station in registry:
+            old = self._registry.get(Station.name)
+            if old is not None and Station.name not in changed:
+                stations.append(old)
+                continue
+            if old is not None and old.same_place(Station):
+                # only the region changed
+                Station.restore(old.snapshot())
+            else:
+                # like a station at startup, fetched but not broadcast
+                Station.base_time = self._base_time
+                if old is not None:
+                    self._remove_plots(old)
+            stations.append(Station)
+        for name in removed:
+            self._remove_plots(self._registry.get(name))
+
+        self._registry = StationRegistry(stations)
+        self._state_dirty = True
+        self._save_state()
+        return added, removed, changed
+
+    def _file_signature(self, file):
+        try:
+            stat = os.stat(file)
+        except FileNotFoundError:
+            return None
+        return [stat.st_size, stat.st_mtime_ns]
+
+    def _snapshot(self):
+        images = {}
+        for file, validators in self._image_validators.items():
+            signature = self._file_signature(file)
+            if signature is not None:
+                images[file] = dict(validators, signature=signature)
+        return {
+            'base_time': self._base_time,
+            'stations': {
+                S.name: S.snapshot()
+                for S in self._registry
+            },
+            'images': images,
+        }
+
+    def _restore_state(self, state):
+        # only trust images that are untouched since the snapshot
+        for file, validators in state.get('images', {}).items():
+            signature = validators.pop('signature', None)
+            if signature == self._file_signature(file):
+                self._image_validators[file] = validators
+
+        restored = set()
+        for Station in self._registry:
+            snapshot = state.get('stations', {}).get(Station.name)
+            if snapshot is None or snapshot['base_time'] > self._base_time:
+                continue
+            Station.restore(snapshot)
+            cached_products = set(Station.cached_products)
+            if Station.plots_cached:
+                cached_products.update(self._epsgrams)
+            on_disk = {
+                product
+                for product in cached_products
+                if plot_path(Station.name, product) in self._image_validators
+            }
+            if on_disk != cached_products:
+                logger.info('{}: cached plots not found on disk'.format(
+                    Station.name))
+            Station.cached_products = on_disk
+            Station.plots_cached = on_disk.issuperset(self._epsgrams)
+            restored.add(Station.name)
+        if restored:
+            logger.info('Restored state of {} stations'.format(len(restored)))
+        return restored
+
+    def _save_state(self):
+        if self._state is not None and self._state_dirty:
+            self._state.save(self._snapshot())
+        self._state_dirty = False
+
     def override_base_time_from_init(self):
-        for Station in self._stations:
+        for Station in self._registry:
+            # the confirmed run is never newer than the global base_time
+            if Station.base_time >= self._base_time:
+                continue
             latest_run = self._latest_confirmed_run(Station)
             if latest_run > Station.base_time:
                 logger.info('Overriding {} base_time from {} to {}'.format(
                     Station.name, Station.base_time, latest_run))
                 Station.upgrade_basetime(latest_run)
+                self._state_dirty = True
+        self._save_state()
 
     def _first_guess_base_time(self):
         t_now = datetime.datetime.now()
-        t_now_rounded = pd.Timestamp.now().round(freq='12h').to_pydatetime()
+        midnight = t_now.replace(hour=0, minute=0, second=0, microsecond=0)
+        half_days = round((t_now - midnight) / datetime.timedelta(hours=12))
+        t_now_rounded = midnight + datetime.timedelta(hours=12 * half_days)
 
         # rounding ends up in future
         if t_now <= t_now_rounded:
@@ -54,7 +240,9 @@ class EcmwfApi():
             new_base_time = self._fetch_available_base_time(fallback=False)
             if new_base_time != self._base_time:
                 self._base_time = new_base_time
+                self._state_dirty = True
                 logger.info('base_time updated to {}'.format(self._base_time))
+                self._adhoc.evict_stale(self._base_time)
         except ValueError:
             logger.debug('Upgrading base_time failed, keeping {}'.format(
                 self._base_time))
@@ -79,7 +267,7 @@ class EcmwfApi():
     def _latest_confirmed_run(self, station):
         # check if forecast for basetime is available for all epsgrams
         base_time = set()
-        for eps_type in ALL_EPSGRAM:
+        for eps_type in self._epsgrams:
             try:
                 self._get_API_data_for_epsgram(station,
                                                self._base_time,
@@ -110,16 +298,81 @@ class EcmwfApi():
     def _get_from_API_no_retry(self, link, raise_on_error=True):
         return self._get_with_request(link, raise_on_error)
 
-    @retry.retry(tries=10, delay=0.5, logger=None)
     def _get_from_API_retry(self, link, raise_on_error=True):
-        return self._get_with_request(link, raise_on_error)
+        return self._retry_policy.call(self._get_with_request,
+                                       link,
+                                       raise_on_error,
+                                       timeout=self._timeout)
+
+    def _circuit_breaker_for(self, host):
+        if host not in self._circuit_breakers:
+            self._circuit_breakers[host] = CircuitBreaker.from_config(
+                self._config.get('circuit_breaker'))
+        return self._circuit_breakers[host]
+
+    def rate_limit_stats(self):
+        return {
+            budget: limiter.stats()
+            for budget, limiter in self._rate_limiters.items()
+        }
+
+    def _http_get(self,
+                  url,
+                  endpoint,
+                  budget='metadata',
+                  timeout=None,
+                  **kwargs):
+        host = urlparse(url).netloc
+        breaker = self._circuit_breaker_for(host)
+        try:
+            breaker.before_call(host)
+        except ValueError:
+            ECMWF_REQUESTS.inc(endpoint=endpoint, outcome='circuit_open')
+            raise
+        # sleeps, called from the fetch thread of the bot or the fetcher
+        waited = self._rate_limiters[budget].acquire()
+        RATE_LIMIT_WAIT_SECONDS.observe(waited, budget=budget)
+        if waited > 0:
+            logger.debug('Throttled %s request for %.2fs',
+                         budget,
+                         waited,
+                         extra={'duration': waited})
+        start = time.perf_counter()
+        try:
+            result = requests.get(url,
+                                  timeout=timeout or self._timeout,
+                                  **kwargs)
+        except requests.RequestException as e:
+            self._observe_request(endpoint, 'error', start)
+            breaker.record_failure(host)
+            raise RetryableError('Request failed for {}: {}'.format(url, e))
+        self._observe_request(endpoint, str(result.status_code), start)
+
+        if self._retry_policy.is_retryable_status(result.status_code):
+            breaker.record_failure(host)
+        else:
+            # the host answered, even if the answer is an error
+            breaker.record_success()
+        return result
+
+    def _observe_request(self, endpoint, outcome, start):
+        ECMWF_REQUESTS.inc(endpoint=endpoint, outcome=outcome)
+        ECMWF_REQUEST_SECONDS.observe(time.perf_counter() - start,
+                                      endpoint=endpoint,
+                                      outcome=outcome)
 
-    def _get_with_request(self, link, raise_on_error=True):
+    def _get_with_request(self, link, raise_on_error=True, timeout=None):
         get = '{}{}'.format(self._API_URL, link)
-        logger.debug('GET {}'.format(get))
-        result = requests.get(get)
+        logger.debug('GET %s', get)
+        # schema or products/opencharts_meteogram
+        result = self._http_get(get,
+                                link.split('?')[0].strip('/'),
+                                timeout=timeout)
 
         if not result.ok and raise_on_error:
+            if self._retry_policy.is_retryable_status(result.status_code):
+                raise RetryableError('Request failed with {} for {}'.format(
+                    result.status_code, get))
             raise ValueError('Request failed for {}'.format(get))
         else:
             try:
@@ -149,24 +402,140 @@ class EcmwfApi():
         return data["data"]["link"]["href"]
 
     def _save_image_of_station(self, image_api, station, eps_type):
-        image = requests.get(image_api)
         file = "./{}_{}.png".format(station.name, eps_type)
-        with open(file, "wb") as img:
-            img.write(image.content)
-        logger.debug("image saved in {}".format(file))
+        tmp_file = "{}.part".format(file)
+
+        changed = self._retry_policy.call(self._stream_image_to_file,
+                                          image_api,
+                                          file,
+                                          tmp_file,
+                                          timeout=self._timeout)
+        if changed:
+            os.replace(tmp_file, file)
+            self.plot_cache.invalidate(file)
+            if self._optimizer is not None:
+                self._unoptimized.append(file)
+            logger.debug('image saved in %s',
+                         file,
+                         extra={
+                             'station': station.name,
+                             'base_time': station.base_time
+                         })
+        else:
+            logger.debug('image %s unchanged',
+                         file,
+                         extra={
+                             'station': station.name,
+                             'base_time': station.base_time
+                         })
         return file
 
-    def download_plots(self, requested_stations):
+    def _optimize_plots(self):
+        # once per download, all recipients of a run get the optimized plot
+        files, self._unoptimized = self._unoptimized, []
+        if files:
+            self._optimizer.optimize(files)
+            for file in files:
+                self.plot_cache.invalidate(file)
+
+    def _archive_plots(self, Station, products):
+        # previous runs of ad-hoc points are not offered
+        if self._archive is None or self._registry.get(
+                Station.name) is not Station:
+            return
+        self._archive.archive(Station.name, Station.base_time,
+                              dict(zip(products, Station.plots(products))))
+
+    def _conditional_headers(self, file):
+        if not os.path.exists(file):
+            return {}
+        validators = self._image_validators.get(file, {})
+        headers = {}
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
+        return headers
+
+    def _stored_image_hash(self, file):
+        if not os.path.exists(file):
+            return None
+        if 'sha256' not in self._image_validators.get(file, {}):
+            sha256 = hashlib.sha256()
+            with open(file, 'rb') as img:
+                sha256.update(img.read())
+            self._image_validators.setdefault(
+                file, {})['sha256'] = sha256.hexdigest()
+        return self._image_validators[file]['sha256']
+
+    def _stream_image_to_file(self, image_api, file, tmp_file, timeout=None):
+        # stream to a temporary file, so the image is never fully held in
+        # memory and readers never see a partially written plot
+        sha256 = hashlib.sha256()
+        with self._http_get(image_api,
+                            'image',
+                            budget='image',
+                            timeout=timeout,
+                            stream=True,
+                            headers=self._conditional_headers(file)) as image:
+            if image.status_code == 304:
+                return False
+            if not image.ok:
+                error = RetryableError if self._retry_policy.is_retryable_status(
+                    image.status_code) else ValueError
+                raise error('Image download failed with {} for {}'.format(
+                    image.status_code, image_api))
+            content_type = image.headers.get('Content-Type', 'image/png')
+            if not content_type.startswith('image/png'):
+                raise ValueError('Unexpected content type {} for {}'.format(
+                    content_type, image_api))
+            try:
+                with open(tmp_file, "wb") as img:
+                    for chunk in image.iter_content(
+                            chunk_size=IMAGE_DOWNLOAD_CHUNK_SIZE):
+                        img.write(chunk)
+                        sha256.update(chunk)
+            except requests.RequestException as e:
+                raise RetryableError(
+                    'Image download interrupted for {}: {}'.format(
+                        image_api, e))
+            validators = {
+                'etag': image.headers.get('ETag'),
+                'last_modified': image.headers.get('Last-Modified'),
+                'sha256': sha256.hexdigest(),
+            }
+
+        try:
+            validate_png(tmp_file)
+        except ValueError as e:
+            os.remove(tmp_file)
+            # a truncated transfer is worth another attempt
+            raise RetryableError('Invalid PNG from {}: {}'.format(
+                image_api, e))
+
+        unchanged = self._stored_image_hash(file) == validators['sha256']
+        self._image_validators[file] = validators
+        self._state_dirty = True
+        if unchanged:
+            os.remove(tmp_file)
+        return not unchanged
+
+    def download_plots(self, requested_stations, products=None):
+        # products maps station names to the epsgram types wanted, all
+        # offered types for stations not in there
+        products = products or {}
         plots_for_broadcast = {}
-        for Station in self._stations:
-            if Station.name in requested_stations:
-                plots_for_broadcast.update(self._download_plots(Station))
+        for Station in self._registry.select(requested_stations):
+            plots_for_broadcast.update(
+                self._download_plots(Station, products.get(Station.name)))
+        self._save_state()
 
         return plots_for_broadcast
 
     def upgrade_basetime_stations(self):
-        for Station in self._stations:
+        for Station in self._registry:
             self._upgrade_basetime_for_station(Station)
+        self._save_state()
 
     def _upgrade_basetime_for_station(self, station):
         if self._new_forecast_available(station):
@@ -181,56 +550,149 @@ class EcmwfApi():
                 # base_time needs update before fetch
                 # if not updated, bot sends endless plots to users
                 station.upgrade_basetime(confirmed_base_time)
+                self._state_dirty = True
             else:
                 logger.debug('base_time for {} {} and {} are the same'.format(
                     station.name, station.base_time, confirmed_base_time))
 
-    def download_latest_plots(self, requested_stations):
+    def download_latest_plots(self, requested_stations, products=None):
+        products = products or {}
         plots_for_broadcast = {}
-        for Station in self._stations:
-            if Station.name in requested_stations and not Station.has_been_broadcasted:
-                plots = self._download_plots(Station)
-                if plots:
-                    Station.has_been_broadcasted = True
-                    plots_for_broadcast.update(plots)
+        for Station in self._registry.select(requested_stations):
+            if not Station.has_been_broadcasted:
+                plots = self._download_plots(Station,
+                                             products.get(Station.name))
+                plots_for_broadcast.update(plots)
+        self._save_state()
 
         return plots_for_broadcast
 
-    def _download_plots(self, Station):
+    def mark_broadcasted(self, station_names):
+        # once the deliveries are queued, not before
+        for Station in self._registry.select(station_names):
+            if not Station.has_been_broadcasted:
+                Station.has_been_broadcasted = True
+                self._state_dirty = True
+        self._save_state()
+
+    def _selected_products(self, products):
+        # keep the configured order, ignore types no longer offered
+        if products is None:
+            return self._epsgrams
+        return [product for product in self._epsgrams if product in products]
+
+    def _download_plots(self, Station, products=None):
         plots = {}
-        eps = []
-        if Station.plots_cached:
-            plots[Station.name] = Station.all_plots
-            logger.info(f'{Station.name}: Plots cached')
+        products = self._selected_products(products)
+        fields = {'station': Station.name, 'base_time': Station.base_time}
+        missing = [
+            product for product in products
+            if product not in Station.cached_products
+        ]
+        if Station.plots_cached or not missing:
+            plots[Station.name] = Station.plots(products)
+            # once per station and delivery batch
+            logger.debug('%s: Plots cached', Station.name, extra=fields)
+        elif not self.base_time_discovered:
+            logger.info('%s: Waiting for base_time before fetching',
+                        Station.name,
+                        extra=fields)
         else:
-            logger.info(f'{Station.name}: Fetching plots')
+            logger.info('%s: Fetching %s',
+                        Station.name,
+                        ', '.join(missing),
+                        extra=fields)
+            start = time.perf_counter()
             try:
-                for type in ALL_EPSGRAM:
+                for type in missing:
                     image_api = self._request_epsgram_link_for_station(
                         Station, type)
-                    eps.append(
-                        self._save_image_of_station(image_api, Station, type))
-                plots[Station.name] = eps
-                Station.plots_cached = True
+                    self._save_image_of_station(image_api, Station, type)
+                    Station.cached_products.add(type)
+                    self._state_dirty = True
+                self._optimize_plots()
+                self._archive_plots(Station, missing)
+                plots[Station.name] = Station.plots(products)
+                Station.plots_cached = Station.cached_products.issuperset(
+                    self._epsgrams)
+                duration = time.perf_counter() - start
+                logger.debug('%s: Fetched %d plots in %.2fs',
+                             Station.name,
+                             len(missing),
+                             duration,
+                             extra=dict(fields, duration=duration))
             except ValueError as e:
-                logger.warning('Could not fetch plots for {}'.format(
-                    Station.name))
+                logger.warning('Could not fetch plots for %s',
+                               Station.name,
+                               extra=fields)
                 plots.clear()
 
         return plots
 
+    def _next_to_cache(self, demanded_products):
+        for Station in self._registry:
+            if demanded_products is None:
+                products = None
+            elif Station.name in demanded_products:
+                products = demanded_products[Station.name]
+            else:
+                continue
+            if not Station.cached_products.issuperset(
+                    self._selected_products(products)):
+                return Station, products
+        return None, None
+
+    def _cached_stations_by_base_time(self):
+        cached = {}
+        for Station in self._registry:
+            if Station.plots_cached:
+                key = (Station.base_time, )
+                cached[key] = cached.get(key, 0) + 1
+        return cached
+
     def _new_forecast_available(self, Station):
         return Station.base_time != self._base_time
 
-    def cache_plots(self):
-        uncached = set()
-        for S in self._stations:
-            if not S.plots_cached:
-                uncached.add(S)
-        if uncached:
-            # only pick one element to not block the main thread
-            s = uncached.pop()
-            logger.info(f'Start caching for {s.name}')
-            self._download_plots(s)
+    def station_base_time(self, station_name):
+        Station = self._registry.get(station_name)
+        return Station.base_time if Station is not None else None
+
+    def broadcast_pending(self, station_name):
+        # the plots of the current run are still to be queued
+        Station = self._registry.get(station_name)
+        return Station is not None and not Station.has_been_broadcasted
+
+    def snap_point(self, lat, lon):
+        return self._adhoc.snap(lat, lon)
+
+    def download_plots_for_point(self, lat, lon):
+        Location = self._adhoc.get(lat, lon, self._base_time)
+        if Location.base_time != self._base_time:
+            # created before the base_time was discovered at startup
+            Location.upgrade_basetime(self._base_time)
+        return Location.name, self._download_plots(Location).get(
+            Location.name, None)
+
+    def _remove_plots(self, Location):
+        for plot in Location.plots(self._epsgrams):
+            self.plot_cache.invalidate(plot)
+            self._image_validators.pop(plot, None)
+            self._state_dirty = True
+            if os.path.exists(plot):
+                os.remove(plot)
+
+    def cache_plots(self, demanded_products=None):
+        # demanded_products as of get_demanded_products of the db, stations
+        # nobody subscribed to are skipped, None caches everything
+        self._adhoc.evict_expired()
+
+        # only pick one element to not block the main thread
+        s, products = self._next_to_cache(demanded_products)
+        if s is not None:
+            logger.info('Start caching for %s',
+                        s.name,
+                        extra={'station': s.name})
+            self._download_plots(s, products)
+            self._save_state()
         else:
-            logger.debug(f'All plots cached')
+            logger.debug('All plots cached')
@@ -0,0 +1,113 @@
+import heapq
+import math
+
+EARTH_RADIUS_KM = 6371.0
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    d_lat = math.sin((lat2 - lat1) / 2)
+    d_lon = math.sin((lon2 - lon1) / 2)
+    a = d_lat**2 + math.cos(lat1) * math.cos(lat2) * d_lon**2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+class SpatialIndex():
+    """Uniform lat/lon grid for nearest neighbour lookups.
+
+    Only the cells around the query point are visited, ring by ring, until
+    no unvisited cell can contain a closer point. Lookup cost depends on the
+    local point density, not on the total number of points. Queries far
+    away from all points fall back to a linear scan.
+    """
+
+    def __init__(self, points, cell_size=None):
+        # points is an iterable of (key, lat, lon)
+        self._points = list(points)
+        self.cell_size = cell_size or self._auto_cell_size(self._points)
+        self._lon_cells = math.ceil(360 / self.cell_size)
+        self._max_abs_lat = max((abs(lat) for _, lat, _ in self._points),
+                                default=0.0)
+        self._cells = {}
+        for key, lat, lon in self._points:
+            self._cells.setdefault(self._cell(lat, lon), []).append(
+                (key, lat, lon))
+
+    @staticmethod
+    def _auto_cell_size(points, points_per_cell=4):
+        if len(points) < 2:
+            return 1.0
+        lats = [lat for _, lat, _ in points]
+        lons = [lon for _, _, lon in points]
+        area = max(max(lats) - min(lats), 0.01) * max(
+            max(lons) - min(lons), 0.01)
+        return min(5.0,
+                   max(0.01, math.sqrt(area * points_per_cell / len(points))))
+
+    def __len__(self):
+        return len(self._points)
+
+    def _cell(self, lat, lon):
+        return (math.floor(lat / self.cell_size),
+                math.floor(lon / self.cell_size) % self._lon_cells)
+
+    def _ring(self, row, col, radius):
+        if radius == 0:
+            yield row, col
+            return
+        for dr in range(-radius, radius + 1):
+            step = 1 if abs(dr) == radius else 2 * radius
+            for dc in range(-radius, radius + 1, step):
+                yield row + dr, (col + dc) % self._lon_cells
+
+    def _lower_bound(self, lat, radius):
+        # every point outside the visited rings is at least this far away,
+        # the longitude gap shrinks towards the poles, so the highest
+        # latitude involved gives the bound
+        if radius == 0:
+            return 0.0
+        gap = min(180.0, (radius - 1) * self.cell_size)
+        polar_lat = max(abs(lat), self._max_abs_lat)
+        return 2 * EARTH_RADIUS_KM * math.cos(
+            math.radians(polar_lat)) * math.sin(math.radians(gap) / 2)
+
+    def nearest(self, lat, lon, k=1, max_distance=None):
+        """Return up to k (distance_km, key) pairs sorted by distance."""
+        if not self._cells or k < 1:
+            return []
+
+        row, col = self._cell(lat, lon)
+        # max-heap of the best k candidates as (-distance, counter, key)
+        best = []
+        counter = 0
+        radius = 0
+        visited = 0
+        while True:
+            if visited > len(self._cells):
+                return self._linear_scan(lat, lon, k, max_distance)
+            bound = self._lower_bound(lat, radius)
+            if max_distance is not None and bound > max_distance:
+                break
+            if len(best) == k and -best[0][0] <= bound:
+                break
+            for cell in self._ring(row, col, radius):
+                visited += 1
+                for key, p_lat, p_lon in self._cells.get(cell, ()):
+                    distance = haversine(lat, lon, p_lat, p_lon)
+                    if max_distance is not None and distance > max_distance:
+                        continue
+                    counter += 1
+                    if len(best) < k:
+                        heapq.heappush(best, (-distance, counter, key))
+                    elif distance < -best[0][0]:
+                        heapq.heapreplace(best, (-distance, counter, key))
+            radius += 1
+
+        return sorted((-distance, key) for distance, _, key in best)
+
+    def _linear_scan(self, lat, lon, k, max_distance):
+        distances = ((haversine(lat, lon, p_lat, p_lon), key)
+                     for key, p_lat, p_lon in self._points)
+        if max_distance is not None:
+            distances = (item for item in distances if item[0] <= max_distance)
+        return heapq.nsmallest(k, distances, key=lambda item: item[0])
@@ -0,0 +1,66 @@
+import json
+import os
+import select
+import socket
+
+from logger_config import logger
+
+FETCHER_SOCKET = 'fetcher.sock'
+FRONTEND_SOCKET = 'frontend.sock'
+
+
+class Channel():
+    """Local notification channel between worker processes.
+
+    Every worker binds a Unix datagram socket in a shared directory and
+    sends small JSON messages to the socket of its peer. Delivery is best
+    effort: messages to a worker that is not running are dropped, durable
+    data lives in the database and the state file.
+    """
+
+    def __init__(self, socket_dir, name):
+        os.makedirs(socket_dir, exist_ok=True)
+        self._socket_dir = socket_dir
+        self.path = os.path.join(socket_dir, name)
+        # left over from a worker that did not shut down cleanly
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._socket.bind(self.path)
+        self._socket.setblocking(False)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._socket.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def send(self, peer, message: dict) -> bool:
+        try:
+            self._socket.sendto(
+                json.dumps(message).encode(),
+                os.path.join(self._socket_dir, peer))
+        except (FileNotFoundError, ConnectionRefusedError, BlockingIOError):
+            logger.debug('{} not listening, dropped {}'.format(peer, message))
+            return False
+        return True
+
+    def receive(self, timeout=0) -> list[dict]:
+        """Return all pending messages, wait up to timeout for the first."""
+        messages = []
+        if timeout and not select.select([self._socket], [], [], timeout)[0]:
+            return messages
+        while True:
+            try:
+                data = self._socket.recv(65536)
+            except BlockingIOError:
+                return messages
+            try:
+                messages.append(json.loads(data))
+            except ValueError:
+                logger.warning('Ignoring malformed message {!r}'.format(data))
@@ -1,8 +1,12 @@
-from constants import ALL_EPSGRAM
+def plot_path(name, product):
+    return f'./{name}_{product}.png'
 
 
 class APILocation():
 
+    __slots__ = ('name', 'api_name', 'lat', 'lon', 'region', 'base_time',
+                 'has_been_broadcasted', 'plots_cached', 'cached_products')
+
     def __init__(self, name, lat, lon, region, api_name=None):
         self.name = name
         self.api_name = name if api_name is None else api_name
@@ -13,9 +17,33 @@ class APILocation():
         # set to true, otherwise bot sends plots to users after startup
         self.has_been_broadcasted = True
         self.plots_cached = False
-        self.all_plots = [f'./{name}_{i}.png' for i in ALL_EPSGRAM]
+        # products on disk for base_time, plots_cached once all are there
+        self.cached_products = set()
+
+    def same_place(self, other):
+        # same request to ECMWF, so the same plots
+        return (self.api_name, self.lat, self.lon) == (other.api_name,
+                                                       other.lat, other.lon)
+
+    def plots(self, products):
+        return [plot_path(self.name, product) for product in products]
+
+    def snapshot(self):
+        return {
+            'base_time': self.base_time,
+            'plots_cached': self.plots_cached,
+            'has_been_broadcasted': self.has_been_broadcasted,
+            'cached_products': sorted(self.cached_products),
+        }
+
+    def restore(self, snapshot):
+        self.base_time = snapshot['base_time']
+        self.plots_cached = snapshot['plots_cached']
+        self.has_been_broadcasted = snapshot['has_been_broadcasted']
+        self.cached_products = set(snapshot.get('cached_products', []))
 
     def upgrade_basetime(self, basetime):
         self.base_time = basetime
         self.has_been_broadcasted = False
         self.plots_cached = False
+        self.cached_products = set()
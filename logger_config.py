@@ -1,14 +1,120 @@
+import atexit
+import json
 import logging
+import queue
+import threading
+from logging.handlers import QueueHandler, QueueListener
 
-# Configure the logger
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO,  # Default level, can be overridden
-)
+from constants import LOG_FORMAT, LOG_FIELDS, LOG_FORMATS
+
+
+class _DeferredQueueHandler(QueueHandler):
+    """Puts records on a queue, formatting is left to the listener thread.
+
+    QueueHandler formats the message on the calling thread, which is the
+    event loop for most of our log calls.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record, with the extra fields of LOG_FIELDS.
+
+        logger.debug('Sent %s', name, extra={'station': name, 'chat_id': 1})
+    """
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for field in LOG_FIELDS:
+            if hasattr(record, field):
+                entry[field] = getattr(record, field)
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """Passes 1 of every n records of a logger and message template.
+
+    Only records up to level are sampled. Rates apply to a logger and its
+    children like logger levels do, e.g. {'ensplotbot': 10, 'httpx': 100}.
+    Records are counted per template, so messages need lazy %-formatting.
+    """
+
+    def __init__(self, rates, level=logging.DEBUG):
+        super().__init__()
+        for name, rate in rates.items():
+            if not isinstance(rate, int) or rate < 1:
+                raise ValueError(
+                    'Sampling rate of {} must be a positive integer, got {}'.
+                    format(name, rate))
+        self._rates = dict(rates)
+        self._level = level
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def _rate(self, name):
+        while name:
+            if name in self._rates:
+                return self._rates[name]
+            name = name.rpartition('.')[0]
+        return 1
+
+    def filter(self, record):
+        if record.levelno > self._level:
+            return True
+        rate = self._rate(record.name)
+        if rate == 1:
+            return True
+        key = (record.name, record.msg)
+        with self._lock:
+            count = self._counts.get(key, 0)
+            self._counts[key] = count + 1
+        return count % rate == 0
+
+
+def configure_logging(config=None):
+    """Apply the logging section of config.yml."""
+    config = config or {}
+    format = config.get('format', 'text')
+    if format not in LOG_FORMATS:
+        raise ValueError('Log format must be one of {}, got {}'.format(
+            LOG_FORMATS, format))
+    _stream_handler.setFormatter(JsonFormatter() if format ==
+                                 'json' else logging.Formatter(LOG_FORMAT))
+
+    for filter in list(_queue_handler.filters):
+        _queue_handler.removeFilter(filter)
+    if config.get('sample'):
+        _queue_handler.addFilter(SamplingFilter(config['sample']))
+
+
+# Log calls only enqueue the record, a background thread formats and
+# writes it to stderr
+_stream_handler = logging.StreamHandler()
+_stream_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+_queue_handler = _DeferredQueueHandler(queue.SimpleQueue())
+_listener = QueueListener(_queue_handler.queue,
+                          _stream_handler,
+                          respect_handler_level=True)
+
+_root = logging.getLogger()
+_root.addHandler(_queue_handler)
+_root.setLevel(logging.INFO)  # Default level, can be overridden
+_listener.start()
+# write what is still queued on exit
+atexit.register(_listener.stop)
 
 # Create a named logger
 logger = logging.getLogger("ensplotbot")
 
 logging.getLogger("httpx").setLevel(logging.WARNING)
 logging.getLogger("apscheduler").setLevel(logging.WARNING)
-logging.getLogger("telegram.ext.Application").setLevel(logging.WARNING)
\ No newline at end of file
+logging.getLogger("telegram.ext.Application").setLevel(logging.WARNING)
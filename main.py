@@ -5,8 +5,14 @@ import sys
 
 from ecmwf import EcmwfApi
 from bot import PlotBot
-from logger_config import logger
+from logger_config import logger, configure_logging
 from db import Database
+from ipc import Channel, FETCHER_SOCKET, FRONTEND_SOCKET
+from workers import Fetcher, PlotStore
+from metrics import REGISTRY, MetricsServer
+from registry import load_station_config
+from constants import (WORKER_SOCKET_DIR, METRICS_LISTEN, METRICS_PORT,
+                       STATIONS_FILE)
 
 
 def main():
@@ -22,21 +28,78 @@ def main():
         help=
         f'set the logging level ({logging.DEBUG}: DEBUG, {logging.INFO}: INFO')
 
+    parser.add_argument(
+        '--fast_start',
+        dest='fast_start',
+        action='store_true',
+        help='start polling right away and discover the ECMWF base_time '
+        'in the background')
+
+    parser.add_argument(
+        '--mode',
+        dest='mode',
+        default='all',
+        choices=['all', 'fetcher', 'frontend'],
+        help='run everything in one process (all) or as one of two '
+        'separate workers: fetcher talks to ECMWF, frontend to Telegram')
+
     args = parser.parse_args()
 
     logger.setLevel(args.log_level)
 
-    with open('stations.yaml', 'r') as file:
-        station_config = yaml.safe_load(file)
-
-    ecmwf = EcmwfApi(station_config)
+    station_config = load_station_config(STATIONS_FILE)
 
     config_file = 'config.yml'
 
+    with open(config_file, 'r') as file:
+        config = yaml.safe_load(file)
+
+    configure_logging(config.get('logging'))
+
+    ecmwf_config = config.get('ecmwf') or {}
+    socket_dir = (config.get('workers') or {}).get('socket_dir',
+                                                   WORKER_SOCKET_DIR)
+    if args.mode != 'all' and not ecmwf_config.get('state_file'):
+        raise ValueError('Separate workers share plots through the state '
+                         'file, set ecmwf: state_file in config.yml')
+
+    metrics_config = config.get('metrics')
+    if metrics_config:
+        port = metrics_config.get('port', METRICS_PORT)
+        if args.mode == 'fetcher':
+            # the front-end worker serves its metrics on port
+            port = metrics_config.get('fetcher_port', port + 1)
+        MetricsServer(REGISTRY, metrics_config.get('listen', METRICS_LISTEN),
+                      port).start()
+
     db = Database(config_file)
 
-    bot = PlotBot(config_file, station_config, db=db, ecmwf=ecmwf)
-    bot.start()
+    if args.mode == 'frontend':
+        with Channel(socket_dir, FRONTEND_SOCKET) as channel:
+            store = PlotStore(ecmwf_config['state_file'], channel,
+                              ecmwf_config.get('products'))
+            bot = PlotBot(config_file,
+                          station_config,
+                          db=db,
+                          ecmwf=store,
+                          fetch=False,
+                          stations_file=STATIONS_FILE)
+            bot.start()
+    else:
+        ecmwf = EcmwfApi(station_config,
+                         ecmwf_config,
+                         discover_base_time=not args.fast_start)
+
+        if args.mode == 'fetcher':
+            with Channel(socket_dir, FETCHER_SOCKET) as channel:
+                Fetcher(ecmwf, db, channel, stations_file=STATIONS_FILE).run()
+        else:
+            bot = PlotBot(config_file,
+                          station_config,
+                          db=db,
+                          ecmwf=ecmwf,
+                          stations_file=STATIONS_FILE)
+            bot.start()
 
     # we only end up here if the bot had an error
     sys.exit(1)
@@ -0,0 +1,34 @@
+import unicodedata
+
+from telegram import Message
+from telegram.ext.filters import MessageFilter
+
+
+def normalize(text: str) -> str:
+    # same composed form, single spaces and case for every spelling
+    return unicodedata.normalize('NFC', ' '.join(text.split())).casefold()
+
+
+class NameFilter(MessageFilter):
+    """Matches messages whose text is exactly one of the given names.
+
+    Replaces a "^(a|b|...)$" regex by a hash lookup over normalized names,
+    names are never interpreted as patterns.
+    """
+
+    __slots__ = ('_names', )
+
+    def __init__(self, names, name=None):
+        super().__init__(name=name)
+        self.set_names(names)
+
+    def set_names(self, names):
+        # swap in one assignment, handlers never see a half built set
+        self._names = {normalize(name): name for name in names}
+
+    def canonical(self, text):
+        return self._names.get(normalize(text)) if text else None
+
+    def filter(self, message: Message) -> bool:
+        return message.text is not None and normalize(
+            message.text) in self._names
@@ -0,0 +1,309 @@
+import asyncio
+import functools
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from constants import METRICS_BUCKETS
+from logger_config import logger
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"',
+                                                   r'\"').replace('\n', r'\n')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"'
+                          for name, value in pairs) + '}'
+
+
+class _Metric():
+    type = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        # label values -> value
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError('{} expects labels {}, got {}'.format(
+                self.name, self.labelnames, sorted(labels)))
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0.0)
+
+    def _samples(self):
+        with self._lock:
+            return [(self.name, key, value)
+                    for key, value in sorted(self._values.items())]
+
+    def render(self):
+        lines = [
+            f'# HELP {self.name} {self.help}',
+            f'# TYPE {self.name} {self.type}'
+        ]
+        for name, key, value, *extra in self._samples():
+            labels = _format_labels(self.labelnames, key, *extra)
+            lines.append(f'{name}{labels} {value:g}')
+        return '\n'.join(lines)
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+
+class Gauge(_Metric):
+    type = 'gauge'
+
+    def __init__(self, name, help, labelnames=()):
+        super().__init__(name, help, labelnames)
+        self._function = None
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def set_function(self, function):
+        # evaluated on every scrape, returns {label values: value}
+        self._function = function
+
+    def _samples(self):
+        if self._function is None:
+            return super()._samples()
+        return [(self.name, tuple(str(v) for v in key), value)
+                for key, value in sorted(self._function().items())]
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=METRICS_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            # [observations per bucket, sum, count]
+            entry = self._values.setdefault(key,
+                                            [[0] * len(self.buckets), 0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def value(self, **labels):
+        # number of observations
+        with self._lock:
+            entry = self._values.get(self._key(labels))
+            return entry[2] if entry is not None else 0
+
+    def _samples(self):
+        samples = []
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, observations in zip(self.buckets, counts):
+                    cumulative += observations
+                    samples.append((f'{self.name}_bucket', key, cumulative,
+                                    [('le', f'{bound:g}')]))
+                samples.append(
+                    (f'{self.name}_bucket', key, count, [('le', '+Inf')]))
+                samples.append((f'{self.name}_sum', key, total))
+                samples.append((f'{self.name}_count', key, count))
+        return samples
+
+
+class Registry():
+
+    def __init__(self):
+        self._metrics = {}
+
+    def _register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError('Metric {} already registered'.format(
+                metric.name))
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labelnames=()) -> Counter:
+        return self._register(Counter(name, help, labelnames))
+
+    def gauge(self, name, help, labelnames=()) -> Gauge:
+        return self._register(Gauge(name, help, labelnames))
+
+    def histogram(self,
+                  name,
+                  help,
+                  labelnames=(),
+                  buckets=METRICS_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help, labelnames, buckets))
+
+    def render(self) -> str:
+        """All metrics in the Prometheus text exposition format."""
+        return '\n'.join(metric.render()
+                         for metric in self._metrics.values()) + '\n'
+
+
+def timed(histogram):
+    """Observe the duration of every call, labelled with the method name."""
+
+    def decorator(func):
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with histogram.time(method=func.__name__):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+class LagProbe():
+    """Delay of a task that should run every interval seconds."""
+
+    def __init__(self, histogram, interval, clock=time.monotonic):
+        self._histogram = histogram
+        self._interval = interval
+        self._clock = clock
+        self._due = None
+
+    def tick(self):
+        now = self._clock()
+        if self._due is None:
+            self._due = now
+        self._histogram.observe(max(0.0, now - self._due))
+        # fixed rate like the job queue, missed runs are not made up for
+        while self._due <= now:
+            self._due += self._interval
+
+
+async def event_loop_lag() -> float:
+    # time until the loop gets back to us, long with blocking callbacks
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    await asyncio.sleep(0)
+    return loop.time() - start
+
+
+class MetricsServer():
+    """Serves the metrics of a registry on /metrics."""
+
+    def __init__(self, registry, host, port):
+        self._registry = registry
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                payload = server._registry.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type',
+                                 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._httpd = ThreadingHTTPServer((host, port), Handler)
+        self._httpd.daemon_threads = True
+
+    @property
+    def port(self):
+        return self._httpd.server_address[1]
+
+    def start(self):
+        threading.Thread(target=self._httpd.serve_forever, daemon=True).start()
+        logger.info('Serving metrics on port {}'.format(self.port))
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+
+REGISTRY = Registry()
+
+ECMWF_REQUESTS = REGISTRY.counter(
+    'ensplotbot_ecmwf_requests_total',
+    'Requests to the opencharts API by endpoint and HTTP status',
+    ['endpoint', 'outcome'])
+ECMWF_REQUEST_SECONDS = REGISTRY.histogram(
+    'ensplotbot_ecmwf_request_seconds',
+    'Latency of requests to the opencharts API', ['endpoint', 'outcome'])
+RATE_LIMIT_WAIT_SECONDS = REGISTRY.histogram(
+    'ensplotbot_rate_limit_wait_seconds',
+    'Time requests to the opencharts API waited for the client-side '
+    'rate limit', ['budget'])
+RETRIES = REGISTRY.counter('ensplotbot_retries_total',
+                           'Retries of failed requests to the opencharts API')
+CACHED_STATIONS = REGISTRY.gauge(
+    'ensplotbot_cached_stations',
+    'Stations with all plots cached by base_time', ['base_time'])
+BROADCAST_SECONDS = REGISTRY.histogram(
+    'ensplotbot_broadcast_seconds',
+    'Duration of a broadcast, fetching plots and queueing deliveries')
+PLOT_BYTES_SAVED = REGISTRY.counter(
+    'ensplotbot_plot_bytes_saved_total',
+    'Bytes saved by recompressing downloaded plots')
+ARCHIVE_BYTES = REGISTRY.gauge('ensplotbot_archive_bytes',
+                               'Disk usage of the archive of previous runs')
+TELEGRAM_SENDS = REGISTRY.counter('ensplotbot_telegram_sends_total',
+                                  'Messages and photos sent to users',
+                                  ['method'])
+SUPPRESSED_REQUESTS = REGISTRY.counter(
+    'ensplotbot_suppressed_requests_total',
+    'User requests rejected by the per-chat rate limit or as duplicates',
+    ['reason'])
+DELIVERIES = REGISTRY.counter('ensplotbot_deliveries_total',
+                              'Processed outbox deliveries by result',
+                              ['status'])
+DB_QUERY_SECONDS = REGISTRY.histogram('ensplotbot_db_query_seconds',
+                                      'Latency of Database methods',
+                                      ['method'])
+CALLBACK_SECONDS = REGISTRY.histogram('ensplotbot_callback_seconds',
+                                      'Wall time of handlers and jobs',
+                                      ['callback'])
+CALLBACK_CPU_SECONDS = REGISTRY.counter(
+    'ensplotbot_callback_cpu_seconds_total',
+    'CPU time of the event loop thread during handlers and jobs', ['callback'])
+JOB_LAG_SECONDS = REGISTRY.histogram(
+    'ensplotbot_job_lag_seconds',
+    'Delay of periodic jobs behind their schedule')
+EVENT_LOOP_LAG_SECONDS = REGISTRY.histogram(
+    'ensplotbot_event_loop_lag_seconds',
+    'Time until the event loop resumes a task that yielded')
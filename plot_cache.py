@@ -0,0 +1,83 @@
+import threading
+from collections import OrderedDict
+
+from constants import PLOT_CACHE_MAX_BYTES
+from logger_config import logger
+
+
+class PlotCache():
+
+    def __init__(self, max_bytes=PLOT_CACHE_MAX_BYTES):
+        self._max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        # path -> token of the read in flight, withdrawn by invalidate
+        self._loading = {}
+        # the cache is shared between the event loop and the fetch thread
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, path):
+        return path in self._entries
+
+    @property
+    def size(self):
+        return self._size
+
+    def get(self, path) -> bytes:
+        with self._lock:
+            data = self._entries.get(path)
+            if data is not None:
+                self._entries.move_to_end(path)
+                return data
+            token = object()
+            self._loading[path] = token
+
+        # read outside of the lock, the file handle is closed right away
+        data = None
+        try:
+            with open(path, 'rb') as file:
+                data = file.read()
+        finally:
+            with self._lock:
+                current = self._loading.get(path) is token
+                if current:
+                    del self._loading[path]
+                # invalidated during the read, the data may be of the
+                # previous run and is not kept
+                if current and data is not None:
+                    self._store(path, data)
+        logger.debug('{} loaded into plot cache'.format(path))
+        return data
+
+    def put(self, path, data):
+        with self._lock:
+            self._store(path, data)
+
+    def invalidate(self, path):
+        with self._lock:
+            self._discard(path)
+            self._loading.pop(path, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._loading.clear()
+            self._size = 0
+
+    def _store(self, path, data):
+        self._discard(path)
+        if len(data) > self._max_bytes:
+            return
+        self._entries[path] = data
+        self._size += len(data)
+        while self._size > self._max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._size -= len(evicted)
+
+    def _discard(self, path):
+        data = self._entries.pop(path, None)
+        if data is not None:
+            self._size -= len(data)
@@ -0,0 +1,86 @@
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from constants import PLOT_OPTIMIZE_LEVEL, PLOT_OPTIMIZE_WORKERS
+from logger_config import logger
+from metrics import PLOT_BYTES_SAVED
+from pngfile import optimize_png_file
+
+
+class PlotOptimizer():
+    """Lossless recompression of downloaded plots in worker processes.
+
+    zlib at its highest level is CPU bound, in separate processes it
+    neither holds the GIL nor the thread that downloads the plots.
+    optimize waits for the pool, call it from the fetch thread of the bot
+    or the fetcher worker, never from the event loop.
+    """
+
+    def __init__(self,
+                 level=PLOT_OPTIMIZE_LEVEL,
+                 workers=PLOT_OPTIMIZE_WORKERS,
+                 strip_metadata=True):
+        if level not in range(10):
+            raise ValueError(
+                'zlib level must be between 0 and 9, got {}'.format(level))
+        if workers < 1:
+            raise ValueError(
+                'Number of workers must be positive, got {}'.format(workers))
+        self._level = level
+        self._workers = workers
+        self._strip_metadata = strip_metadata
+        # started on first use
+        self._executor = None
+        self.bytes_before = 0
+        self.bytes_after = 0
+
+    @classmethod
+    def from_config(cls, config):
+        # optimization is off without config
+        if not config:
+            return None
+        return cls(config.get('level', PLOT_OPTIMIZE_LEVEL),
+                   config.get('workers', PLOT_OPTIMIZE_WORKERS),
+                   config.get('strip_metadata', True))
+
+    @property
+    def bytes_saved(self):
+        return self.bytes_before - self.bytes_after
+
+    def optimize(self, files) -> int:
+        """Optimize files in place in parallel, returns the bytes saved."""
+        if not files:
+            return 0
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(self._workers)
+        futures = [(file,
+                    self._executor.submit(optimize_png_file, file, self._level,
+                                          self._strip_metadata))
+                   for file in files]
+        before = after = 0
+        for file, future in futures:
+            try:
+                size, optimized_size = future.result()
+            except BrokenProcessPool as e:
+                # a worker died, start a new pool next time
+                self._executor = None
+                logger.warning('Could not optimize %s: %s', file, e)
+                continue
+            except (OSError, ValueError) as e:
+                # the plot is kept as downloaded
+                logger.warning('Could not optimize %s: %s', file, e)
+                continue
+            before += size
+            after += optimized_size
+
+        self.bytes_before += before
+        self.bytes_after += after
+        PLOT_BYTES_SAVED.inc(before - after)
+        logger.debug('Optimized %d plots, saved %d of %d bytes', len(files),
+                     before - after, before)
+        return before - after
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
@@ -0,0 +1,85 @@
+import os
+import struct
+import zlib
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# ancillary chunks without influence on the pixels
+PNG_METADATA_CHUNKS = {b'tEXt', b'zTXt', b'iTXt', b'tIME'}
+
+
+def read_chunks(data):
+    if not data.startswith(PNG_SIGNATURE):
+        raise ValueError('Missing PNG signature')
+
+    chunks = []
+    offset = len(PNG_SIGNATURE)
+    while offset < len(data):
+        if offset + 8 > len(data):
+            raise ValueError('Truncated PNG chunk header')
+        length, chunk_type = struct.unpack('>I4s', data[offset:offset + 8])
+        end = offset + 12 + length
+        if end > len(data):
+            raise ValueError('Truncated PNG chunk {}'.format(chunk_type))
+        chunks.append((chunk_type, data[offset + 8:offset + 8 + length]))
+        offset = end
+        if chunk_type == b'IEND':
+            break
+
+    if not chunks or chunks[0][0] != b'IHDR':
+        raise ValueError('PNG does not start with IHDR')
+    if chunks[-1][0] != b'IEND':
+        raise ValueError('PNG does not end with IEND')
+    return chunks
+
+
+def validate_png(path):
+    # walks the chunk structure, catches truncated downloads and HTML pages
+    # served with status 200
+    with open(path, 'rb') as file:
+        data = file.read()
+    read_chunks(data)
+
+
+def write_chunks(chunks) -> bytes:
+    return PNG_SIGNATURE + b''.join(
+        struct.pack('>I', len(data)) + chunk_type + data +
+        struct.pack('>I', zlib.crc32(chunk_type + data))
+        for chunk_type, data in chunks)
+
+
+def optimize_png(data, level=9, strip_metadata=True) -> bytes:
+    """Lossless recompression of the image data into a single IDAT chunk.
+
+    The filtered scanlines are kept as they are, so the pixels do not
+    change. Returns data itself if the result is not smaller.
+    """
+    chunks = read_chunks(data)
+    image = zlib.decompress(b''.join(chunk_data
+                                     for chunk_type, chunk_data in chunks
+                                     if chunk_type == b'IDAT'))
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 15, 9)
+    idat = compressor.compress(image) + compressor.flush()
+
+    optimized = []
+    for chunk_type, chunk_data in chunks:
+        if chunk_type == b'IDAT':
+            if idat is not None:
+                optimized.append((b'IDAT', idat))
+                idat = None
+        elif not (strip_metadata and chunk_type in PNG_METADATA_CHUNKS):
+            optimized.append((chunk_type, chunk_data))
+    optimized = write_chunks(optimized)
+    return optimized if len(optimized) < len(data) else data
+
+
+def optimize_png_file(path, level=9, strip_metadata=True):
+    """Optimize the PNG at path in place, returns (bytes before, after)."""
+    with open(path, 'rb') as file:
+        data = file.read()
+    optimized = optimize_png(data, level, strip_metadata)
+    if optimized is not data:
+        tmp_file = '{}.opt'.format(path)
+        with open(tmp_file, 'wb') as file:
+            file.write(optimized)
+        os.replace(tmp_file, path)
+    return len(data), len(optimized)
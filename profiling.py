@@ -0,0 +1,165 @@
+import functools
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+from constants import PROFILE_SAMPLE_INTERVAL, PROFILE_TOP_N
+from logger_config import logger
+from metrics import CALLBACK_SECONDS, CALLBACK_CPU_SECONDS
+
+# innermost frames of threads that wait for work, not worth reporting
+IDLE_FRAMES = {
+    ('selectors.py', 'select'),
+    ('threading.py', 'wait'),
+    ('threading.py', '_wait_for_tstate_lock'),
+    ('thread.py', '_worker'),
+    ('socket.py', 'accept'),
+    ('socket.py', 'readinto'),
+    ('ssl.py', 'read'),
+}
+
+
+def _frame_label(frame):
+    code = frame.f_code
+    return '{}:{}'.format(os.path.basename(code.co_filename), code.co_name)
+
+
+class Sampler():
+    """Statistical profiler of all threads of the running process.
+
+    A background thread records the Python stack of every other thread
+    each interval seconds. Unlike cProfile it sees the event loop and the
+    threads of asyncio.to_thread alike and adds no cost to the code being
+    profiled. Stacks of waiting threads are counted as idle.
+    """
+
+    def __init__(self, interval=PROFILE_SAMPLE_INTERVAL):
+        self.interval = interval
+        # tuple of frame labels, outermost first -> number of samples
+        self.stacks = Counter()
+        self.idle = 0
+        self.started = None
+        self.duration = 0.0
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        self.started = time.monotonic()
+        self._thread = threading.Thread(target=self._run,
+                                        name='profile sampler',
+                                        daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.duration = time.monotonic() - self.started
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id != own:
+                    self._sample(frame)
+
+    def _sample(self, frame):
+        code = frame.f_code
+        if (os.path.basename(code.co_filename), code.co_name) in IDLE_FRAMES:
+            self.idle += 1
+            return
+        stack = []
+        while frame is not None:
+            stack.append(_frame_label(frame))
+            frame = frame.f_back
+        self.stacks[tuple(reversed(stack))] += 1
+
+    def hot_functions(self, n=PROFILE_TOP_N):
+        """Top n functions as (label, own samples, total samples)."""
+        own = Counter()
+        total = Counter()
+        for stack, count in self.stacks.items():
+            own[stack[-1]] += count
+            # recursion counts once per sample
+            for label in set(stack):
+                total[label] += count
+        return [(label, count, total[label])
+                for label, count in own.most_common(n)]
+
+    def write(self, path):
+        # collapsed stacks, the input format of flamegraph.pl and speedscope
+        with open(path, 'w') as file:
+            for stack, count in self.stacks.most_common():
+                file.write('{} {}\n'.format(';'.join(stack), count))
+        logger.info('Profile written to {}'.format(path))
+
+
+class CallbackStats():
+    """Wall and CPU time of handler and job callbacks."""
+
+    def __init__(self):
+        # name -> [calls, wall, cpu]
+        self._stats = {}
+
+    def wrap(self, callback, name):
+
+        @functools.wraps(callback)
+        async def timed_callback(*args, **kwargs):
+            wall = time.perf_counter()
+            # CPU of the event loop thread, includes other tasks that run
+            # while the callback awaits
+            cpu = time.thread_time()
+            try:
+                return await callback(*args, **kwargs)
+            finally:
+                self.record(name,
+                            time.perf_counter() - wall,
+                            time.thread_time() - cpu)
+
+        return timed_callback
+
+    def record(self, name, wall, cpu):
+        stats = self._stats.setdefault(name, [0, 0.0, 0.0])
+        stats[0] += 1
+        stats[1] += wall
+        stats[2] += cpu
+        CALLBACK_SECONDS.observe(wall, callback=name)
+        CALLBACK_CPU_SECONDS.inc(cpu, callback=name)
+
+    def snapshot(self) -> dict:
+        return {name: list(stats) for name, stats in self._stats.items()}
+
+    def since(self, snapshot, n=PROFILE_TOP_N):
+        """Top n callbacks by wall time since snapshot."""
+        rows = []
+        for name, (calls, wall, cpu) in self._stats.items():
+            before = snapshot.get(name, [0, 0.0, 0.0])
+            if calls > before[0]:
+                rows.append((name, calls - before[0], wall - before[1],
+                             cpu - before[2]))
+        return sorted(rows, key=lambda row: row[2], reverse=True)[:n]
+
+
+def format_summary(sampler, callbacks) -> str:
+    samples = sum(sampler.stacks.values())
+    lines = [
+        'Profile of {:.0f}s, {} samples, {} idle'.format(
+            sampler.duration, samples, sampler.idle), '', 'Hot functions',
+        '  own  total  function'
+    ]
+    for label, own, total in sampler.hot_functions():
+        lines.append('{:4.0f}% {:5.0f}%  {}'.format(100 * own / samples,
+                                                    100 * total / samples,
+                                                    label))
+    lines += ['', 'Callbacks', ' calls    wall     cpu  name']
+    for name, calls, wall, cpu in callbacks:
+        lines.append('{:6d} {:6.1f}s {:6.1f}s  {}'.format(
+            calls, wall, cpu, name))
+    return '\n'.join(lines)
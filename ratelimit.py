@@ -0,0 +1,108 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class TokenBucket():
+
+    def __init__(self, rate, capacity, clock=time.monotonic, sleep=time.sleep):
+        # rate in tokens per second, capacity is the allowed burst
+        self.rate = rate
+        self.capacity = capacity
+        self._clock = clock
+        self._sleep = sleep
+        self._tokens = capacity
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+        self.acquired = 0
+        self.throttled = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    @classmethod
+    def from_config(cls, config, default_rate, default_burst):
+        config = config or {}
+        rate = config.get('rate', default_rate)
+        return cls(rate=rate, capacity=config.get('burst', default_burst))
+
+    def _refill(self):
+        now = self._clock()
+        self._tokens = min(self.capacity,
+                           self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self, tokens=1) -> bool:
+        with self._lock:
+            self._refill()
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                self.acquired += 1
+                return True
+            self.throttled += 1
+            return False
+
+    def acquire(self, tokens=1) -> float:
+        with self._lock:
+            self._refill()
+            # reserve the tokens right away, callers queue up behind each
+            # other and are released at the sustained rate
+            self._tokens -= tokens
+            wait = max(0.0, -self._tokens / self.rate)
+            self.acquired += 1
+            if wait > 0:
+                self.throttled += 1
+                self.total_wait += wait
+                self.max_wait = max(self.max_wait, wait)
+
+        if wait > 0:
+            self._sleep(wait)
+        return wait
+
+    def stats(self):
+        with self._lock:
+            mean_wait = self.total_wait / self.throttled if self.throttled else 0.0
+            return {
+                'acquired': self.acquired,
+                'throttled': self.throttled,
+                'total_wait': self.total_wait,
+                'max_wait': self.max_wait,
+                'mean_wait': mean_wait,
+            }
+
+
+class ChatRateLimiter():
+    """A token bucket per chat, bounds the requests a single user makes.
+
+    Only the max_chats most recently active chats are tracked, a chat that
+    was idle long enough has a full bucket anyway.
+    """
+
+    def __init__(self, rate, burst, max_chats, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self._max_chats = max_chats
+        self._clock = clock
+        self._buckets = OrderedDict()
+
+    @classmethod
+    def from_config(cls, config, default_rate, default_burst,
+                    default_max_chats):
+        config = config or {}
+        return cls(rate=config.get('rate', default_rate),
+                   burst=config.get('burst', default_burst),
+                   max_chats=config.get('max_chats', default_max_chats))
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def try_acquire(self, chat_id) -> bool:
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            bucket = TokenBucket(self.rate, self.burst, clock=self._clock)
+            self._buckets[chat_id] = bucket
+            if len(self._buckets) > self._max_chats:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(chat_id)
+        return bucket.try_acquire()
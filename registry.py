@@ -0,0 +1,132 @@
+import hashlib
+import json
+import os
+
+import yaml
+
+from geo import SpatialIndex
+from location import APILocation
+
+
+class StationRegistry():
+
+    def __init__(self, stations):
+        # name -> station, keeps the order of stations.yaml
+        self._by_name = {Station.name: Station for Station in stations}
+        by_region = {}
+        for Station in self._by_name.values():
+            by_region.setdefault(Station.region, []).append(Station.name)
+        self._names = sorted(self._by_name)
+        self._regions = sorted(by_region)
+        self._names_by_region = {
+            region: sorted(names)
+            for region, names in by_region.items()
+        }
+        # changes with every list the inline keyboards refer to by position
+        self._version = hashlib.sha256(
+            json.dumps([[region, self._names_by_region[region]]
+                        for region in self._regions]).encode()).hexdigest()[:8]
+        self._spatial_index = SpatialIndex(
+            (Station.name, Station.lat, Station.lon)
+            for Station in self._by_name.values())
+
+    @classmethod
+    def from_config(cls, station_config):
+        return cls(
+            [APILocation(**station_data) for station_data in station_config])
+
+    def __len__(self):
+        return len(self._by_name)
+
+    def __iter__(self):
+        return iter(self._by_name.values())
+
+    def __contains__(self, name):
+        return name in self._by_name
+
+    @property
+    def stations(self) -> list[APILocation]:
+        return list(self._by_name.values())
+
+    @property
+    def names(self) -> list[str]:
+        return self._names
+
+    @property
+    def regions(self) -> list[str]:
+        return self._regions
+
+    @property
+    def version(self) -> str:
+        return self._version
+
+    def get(self, name):
+        return self._by_name.get(name)
+
+    def region_of(self, name):
+        return self._by_name[name].region
+
+    def names_for_region(self, region) -> list[str]:
+        return self._names_by_region.get(region, [])
+
+    def select(self, names) -> list[APILocation]:
+        return [
+            self._by_name[name] for name in dict.fromkeys(names)
+            if name in self._by_name
+        ]
+
+    def nearest(self, lat, lon, k=1, max_distance=None):
+        return [(distance, self._by_name[name])
+                for distance, name in self._spatial_index.nearest(
+                    lat, lon, k=k, max_distance=max_distance)]
+
+    def diff(self, other):
+        """Names of the stations added, removed and changed in other."""
+        added = [name for name in other.names if name not in self]
+        removed = [name for name in self.names if name not in other]
+        changed = [
+            name for name in other.names
+            if name in self and not (self.get(name).same_place(other.get(
+                name)) and self.region_of(name) == other.region_of(name))
+        ]
+        return added, removed, changed
+
+
+def load_station_config(path) -> list[dict]:
+    """Read and check a station file like stations.yaml."""
+    try:
+        with open(path, 'r') as file:
+            station_config = yaml.safe_load(file)
+    except yaml.YAMLError as e:
+        raise ValueError('Invalid YAML in {}: {}'.format(path, e))
+    if not isinstance(station_config, list) or not station_config:
+        raise ValueError('{} has no stations'.format(path))
+    try:
+        registry = StationRegistry.from_config(station_config)
+    except TypeError as e:
+        raise ValueError('Invalid station in {}: {}'.format(path, e))
+    if len(registry) != len(station_config):
+        raise ValueError('Station names in {} are not unique'.format(path))
+    return station_config
+
+
+class StationFileWatcher():
+    """Notices changes of a station file by its size and mtime."""
+
+    def __init__(self, path):
+        self.path = path
+        self._signature = self._stat()
+
+    def _stat(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_size, stat.st_mtime_ns)
+
+    def changed(self) -> bool:
+        signature = self._stat()
+        if signature is None or signature == self._signature:
+            return False
+        self._signature = signature
+        return True
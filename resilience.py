@@ -0,0 +1,139 @@
+import random
+import threading
+import time
+
+from constants import (RETRY_TRIES, RETRY_BASE_DELAY, RETRY_MAX_DELAY,
+                       RETRY_DEADLINE, RETRYABLE_STATUS_CODES,
+                       CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_TIMEOUT)
+from logger_config import logger
+from metrics import RETRIES
+
+
+class RetryableError(ValueError):
+    """Transient failure (timeout, connection error, 429/5xx)."""
+
+
+class CircuitOpenError(ValueError):
+    """Raised instead of calling a host whose circuit is open."""
+
+
+class RetryPolicy():
+
+    def __init__(self,
+                 tries=RETRY_TRIES,
+                 base_delay=RETRY_BASE_DELAY,
+                 max_delay=RETRY_MAX_DELAY,
+                 deadline=RETRY_DEADLINE,
+                 jitter=True,
+                 retryable_status_codes=RETRYABLE_STATUS_CODES,
+                 sleep=time.sleep,
+                 clock=time.monotonic):
+        self.tries = tries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.jitter = jitter
+        self.retryable_status_codes = set(retryable_status_codes)
+        self._sleep = sleep
+        self._clock = clock
+
+    @classmethod
+    def from_config(cls, config):
+        config = config or {}
+        return cls(
+            tries=config.get('tries', RETRY_TRIES),
+            base_delay=config.get('base_delay', RETRY_BASE_DELAY),
+            max_delay=config.get('max_delay', RETRY_MAX_DELAY),
+            deadline=config.get('deadline', RETRY_DEADLINE),
+            jitter=config.get('jitter', True),
+            retryable_status_codes=config.get('retryable_status_codes',
+                                              RETRYABLE_STATUS_CODES),
+        )
+
+    def is_retryable_status(self, status_code):
+        return status_code in self.retryable_status_codes
+
+    def backoff(self, attempt):
+        # exponential backoff with "full jitter" to desynchronise callers
+        delay = min(self.max_delay, self.base_delay * 2**attempt)
+        if self.jitter:
+            delay = random.uniform(0, delay)
+        return delay
+
+    def call(self, func, *args, timeout=None, **kwargs):
+        # with a timeout, every attempt gets at most the time left until
+        # the deadline as timeout= keyword
+        deadline = self._clock() + self.deadline
+        for attempt in range(self.tries):
+            if timeout is not None:
+                kwargs['timeout'] = min(timeout, deadline - self._clock())
+            try:
+                return func(*args, **kwargs)
+            except RetryableError as e:
+                if attempt + 1 >= self.tries:
+                    raise
+                delay = self.backoff(attempt)
+                if self._clock() + delay >= deadline:
+                    logger.debug('Retry deadline of {}s reached'.format(
+                        self.deadline))
+                    raise
+                logger.debug('Retry {}/{} in {:.2f}s: {}'.format(
+                    attempt + 1, self.tries - 1, delay, e))
+                RETRIES.inc()
+                self._sleep(delay)
+
+
+class CircuitBreaker():
+
+    def __init__(self,
+                 failure_threshold=CIRCUIT_FAILURE_THRESHOLD,
+                 reset_timeout=CIRCUIT_RESET_TIMEOUT,
+                 clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+        self._failures = 0
+        self._opened_at = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        config = config or {}
+        return cls(
+            failure_threshold=config.get('failure_threshold',
+                                         CIRCUIT_FAILURE_THRESHOLD),
+            reset_timeout=config.get('reset_timeout', CIRCUIT_RESET_TIMEOUT),
+        )
+
+    @property
+    def is_open(self):
+        with self._lock:
+            return self._cooling()
+
+    def _cooling(self):
+        return (self._opened_at is not None
+                and self._clock() - self._opened_at < self.reset_timeout)
+
+    def before_call(self, host):
+        with self._lock:
+            if self._cooling():
+                raise CircuitOpenError(
+                    'Circuit for {} is open, skipping request'.format(host))
+            if self._opened_at is not None:
+                # half-open: let one probe through, a failure re-opens
+                self._opened_at = self._clock()
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+
+    def record_failure(self, host):
+        with self._lock:
+            self._failures += 1
+            if self._failures >= self.failure_threshold:
+                if self._opened_at is None:
+                    logger.warning(
+                        'Circuit for {} opened for {}s after {} failures'.
+                        format(host, self.reset_timeout, self._failures))
+                self._opened_at = self._clock()
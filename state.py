@@ -0,0 +1,44 @@
+import json
+import os
+import threading
+
+from logger_config import logger
+
+
+class StateStore():
+
+    def __init__(self, path):
+        self.path = path
+        self._last_written = None
+        # one writer of the tmp file at a time, e.g. the event loop and the
+        # fetch thread
+        self._lock = threading.Lock()
+
+    def load(self) -> dict:
+        try:
+            with open(self.path, 'r') as file:
+                state = json.load(file)
+        except FileNotFoundError:
+            logger.info('No state file found at {}'.format(self.path))
+            return {}
+        except (OSError, ValueError) as e:
+            logger.warning('Ignoring unreadable state file {}: {}'.format(
+                self.path, e))
+            return {}
+        self._last_written = json.dumps(state, sort_keys=True)
+        return state
+
+    def save(self, state: dict):
+        serialized = json.dumps(state, sort_keys=True)
+        with self._lock:
+            if serialized == self._last_written:
+                return False
+
+            # write-then-rename, a crash never leaves a half written state
+            tmp_path = '{}.tmp'.format(self.path)
+            with open(tmp_path, 'w') as file:
+                file.write(serialized)
+            os.replace(tmp_path, self.path)
+            self._last_written = serialized
+        logger.debug('State saved to {}'.format(self.path))
+        return True
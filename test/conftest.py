@@ -0,0 +1,32 @@
+import os
+import socket
+import sys
+
+import pytest
+
+# the fake Telegram Bot API and opencharts API are shared with the benchmarks
+sys.path.append(
+    os.path.abspath(os.path.join(os.path.dirname(__file__), '..',
+                                 'benchmarks')))
+
+from fake_ecmwf import FakeEcmwfServer
+from fake_telegram import FakeTelegramServer
+
+
+@pytest.fixture
+def fake_telegram():
+    with FakeTelegramServer() as server:
+        yield server
+
+
+@pytest.fixture
+def fake_ecmwf():
+    with FakeEcmwfServer(image_size=1024) as server:
+        yield server
+
+
+@pytest.fixture
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
@@ -0,0 +1,67 @@
+import sys
+import os
+
+# Add the parent directory to the sys.path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from adhoc import AdHocLocations
+from constants import ADHOC_REGION
+
+
+class FakeClock():
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_nearby_points_share_a_location():
+    adhoc = AdHocLocations(grid_size=0.1)
+    first = adhoc.get(46.5371, 7.9623, 'run')
+    second = adhoc.get(46.5012, 7.9549, 'run')
+    assert first is second
+    assert first.name == '46.50N 8.00E'
+    assert (first.lat, first.lon) == (46.5, 8.0)
+    assert first.region == ADHOC_REGION
+    assert len(adhoc) == 1
+    assert '46.50N 8.00E' in adhoc
+
+
+def test_name_for_southern_and_western_points():
+    assert AdHocLocations.name_for(-33.9, -18.4) == '33.90S 18.40W'
+
+
+def test_least_recently_used_location_is_evicted():
+    evicted = []
+    adhoc = AdHocLocations(max_locations=2, on_evict=evicted.append)
+    a = adhoc.get(1, 1, 'run')
+    adhoc.get(2, 2, 'run')
+    adhoc.get(1, 1, 'run')
+    adhoc.get(3, 3, 'run')
+    assert len(adhoc) == 2
+    assert [location.name for location in evicted] == ['2.00N 2.00E']
+    assert a.name in adhoc
+
+
+def test_expired_locations_are_evicted():
+    clock = FakeClock()
+    evicted = []
+    adhoc = AdHocLocations(ttl=10, on_evict=evicted.append, clock=clock)
+    adhoc.get(1, 1, 'run')
+    clock.now = 5
+    adhoc.get(2, 2, 'run')
+    clock.now = 12
+    adhoc.evict_expired()
+    assert [location.name for location in evicted] == ['1.00N 1.00E']
+    assert len(adhoc) == 1
+
+
+def test_stale_locations_are_evicted():
+    adhoc = AdHocLocations()
+    adhoc.get(1, 1, 'old')
+    adhoc.get(2, 2, 'new')
+    adhoc.evict_stale('new')
+    assert '1.00N 1.00E' not in adhoc
+    assert '2.00N 2.00E' in adhoc
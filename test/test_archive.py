@@ -0,0 +1,155 @@
+import pytest
+import sys
+import os
+import zlib
+
+# Add the parent directory to the sys.path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from archive import PlotArchive
+from plot_optimizer import PlotOptimizer
+from pngfile import read_chunks
+from test_plot_optimizer import uncompressed_png
+
+RUNS = [f'2025-01-0{day}T00:00:00Z' for day in range(1, 6)]
+
+
+@pytest.fixture
+def archive(tmp_path):
+    archive = PlotArchive(str(tmp_path / 'archive'), keep=3)
+    yield archive
+    archive.close()
+
+
+def write_plot(tmp_path, name, width=64):
+    path = tmp_path / name
+    path.write_bytes(uncompressed_png(width=width))
+    return str(path)
+
+
+def pixels(data):
+    return zlib.decompress(b''.join(
+        chunk_data for chunk_type, chunk_data in read_chunks(data)
+        if chunk_type == b'IDAT'))
+
+
+def test_add_and_get(archive, tmp_path):
+    plot = write_plot(tmp_path, 'Bern_classical_plume.png')
+    assert archive.add('Bern', 'classical_plume', RUNS[0], plot)
+    assert archive.runs('Bern') == [RUNS[0]]
+    assert archive.runs('Basel') == []
+
+    plots = archive.get('Bern', RUNS[0])
+    assert list(plots) == ['classical_plume']
+    with open(plot, 'rb') as file:
+        assert plots['classical_plume'] == file.read()
+    assert archive.get('Bern', RUNS[1]) == {}
+
+
+def test_new_content_is_recompressed(tmp_path):
+    archive = PlotArchive(str(tmp_path / 'archive'),
+                          optimizer=PlotOptimizer(workers=1))
+    plot = write_plot(tmp_path, 'plot.png')
+    assert archive.archive('Bern', RUNS[0], {'classical_plume': plot}) == 1
+    # already archived, not recompressed again
+    assert archive.archive('Bern', RUNS[1], {'classical_plume': plot}) == 0
+    assert archive._optimizer.bytes_before == os.path.getsize(plot)
+
+    data = archive.get('Bern', RUNS[1])['classical_plume']
+    assert len(data) < os.path.getsize(plot)
+    assert archive.size == len(data)
+    with open(plot, 'rb') as file:
+        assert pixels(data) == pixels(file.read())
+    archive.close()
+
+
+def test_same_content_is_stored_once(archive, tmp_path):
+    plot = write_plot(tmp_path, 'plot.png')
+    assert archive.add('Bern', 'classical_plume', RUNS[0], plot)
+    size = archive.size
+    assert not archive.add('Bern', 'classical_plume', RUNS[1], plot)
+    assert not archive.add('Basel', 'classical_plume', RUNS[1], plot)
+    assert archive.size == size
+    assert archive.runs('Bern') == [RUNS[1], RUNS[0]]
+    assert archive.get('Basel', RUNS[1]) == archive.get('Bern', RUNS[0])
+
+
+def test_keeps_latest_runs_per_station(archive, tmp_path):
+    for i, run in enumerate(RUNS):
+        plot = write_plot(tmp_path, 'plot.png', width=32 + i)
+        archive.archive('Bern', run, {'classical_plume': plot})
+    archive.archive('Basel', RUNS[0], {'classical_plume': plot})
+
+    assert archive.runs('Bern') == RUNS[:-4:-1]
+    # a station is pruned by its own runs
+    assert archive.runs('Basel') == [RUNS[0]]
+    blobs = [
+        name for _, _, names in os.walk(archive.directory) for name in names
+        if name.endswith('.png')
+    ]
+    assert len(blobs) == 3
+
+
+def test_prunes_oldest_runs_beyond_max_bytes(tmp_path):
+    archive = PlotArchive(str(tmp_path / 'archive'), keep=10)
+    for i, run in enumerate(RUNS[:3]):
+        plot = write_plot(tmp_path, 'plot.png', width=32 + i)
+        archive.archive('Bern', run, {'classical_plume': plot})
+    sizes = [
+        len(archive.get('Bern', run)['classical_plume']) for run in RUNS[:3]
+    ]
+
+    archive._max_bytes = sizes[1] + sizes[2]
+    assert archive.prune() == 1
+    assert archive.runs('Bern') == [RUNS[2], RUNS[1]]
+    assert archive.size == sizes[1] + sizes[2]
+
+    # too large for the archive, nothing is left
+    archive._max_bytes = 1
+    archive.prune()
+    assert archive.runs('Bern') == []
+    assert archive.size == 0
+    archive.close()
+
+
+def test_archive_logs_errors(archive, tmp_path):
+    assert archive.archive(
+        'Bern', RUNS[0],
+        {'classical_plume': str(tmp_path / 'missing.png')}) == 0
+    assert archive.runs('Bern') == []
+
+
+def test_index_is_shared(archive, tmp_path):
+    plot = write_plot(tmp_path, 'plot.png')
+    archive.add('Bern', 'classical_plume', RUNS[0], plot)
+    # e.g. the bot of --mode frontend
+    reader = PlotArchive(archive.directory)
+    assert reader.runs('Bern') == [RUNS[0]]
+    reader.close()
+
+
+def test_from_config(tmp_path):
+    assert PlotArchive.from_config(None) is None
+    with pytest.raises(ValueError):
+        PlotArchive.from_config({'keep': 3})
+    with pytest.raises(ValueError):
+        PlotArchive(str(tmp_path), keep=0)
+    archive = PlotArchive.from_config({'dir': str(tmp_path), 'keep': 2})
+    assert archive._keep == 2
+    assert archive._optimizer is not None
+    archive.close()
+    # plots optimized at download are stored as they are
+    archive = PlotArchive.from_config({'dir': str(tmp_path)}, optimized=True)
+    assert archive._optimizer is None
+    archive.close()
+
+
+def test_read_only(tmp_path):
+    archive = PlotArchive.from_config({'dir': str(tmp_path / 'archive')},
+                                      read_only=True)
+    assert archive._optimizer is None
+    with pytest.raises(ValueError):
+        archive.add('Bern', 'classical_plume', RUNS[0],
+                    write_plot(tmp_path, 'plot.png'))
+    assert archive.runs('Bern') == []
+    archive.close()
@@ -1,12 +1,17 @@
 import pytest
+import asyncio
+import contextlib
+import threading
 import sys
 import os
 import yaml
+from unittest.mock import AsyncMock, MagicMock, patch
 
 # Add the parent directory to the sys.path
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 from bot import PlotBot
+from constants import ALL_EPSGRAM
 
 
 @pytest.fixture(scope="module")
@@ -16,6 +21,10 @@ def bot(station_config):
         "bot": {
             "token": '9999999999:BBBBBBBRBBBBBBBBBBBBBBBBBBBBBBBBBBB',
             "admin_ids": [123456789, 987654321],
+            # the tests send many requests of the same chat
+            "rate_limit": {
+                "burst": 1000
+            },
         }
     }
     # Write the config to a file
@@ -54,3 +63,815 @@ def test_available_locations(bot):
         '_Available locations_', '', '*Basilea*', '- Basel', '',
         '*Canton Berne*', '- Bern', '', '*Zurich*', '- Zürich'
     ]
+
+
+def test_station_names_for_region(bot):
+    assert bot._get_station_names_for_region('Zurich') == ['Zürich']
+    assert bot._get_station_names_for_region('Unknown') == []
+
+
+def test_inline_keyboards_are_precomputed(bot):
+    markup = bot._inline_keyboards[('p', 0)]
+    assert markup is bot._inline_keyboards[('p', 0)]
+    assert markup.inline_keyboard[0][0].text == 'Basel'
+    assert markup.inline_keyboard[0][0].callback_data == bot._callback_data(
+        'p', 's', 0, 0)
+    regions = bot._inline_keyboards['s'].inline_keyboard
+    assert [row[0].callback_data for row in regions
+            ] == [bot._callback_data('s', 'r', i) for i in range(3)] + ['s:x']
+
+
+def test_regex_characters_in_station_names(bot):
+    assert bot._filter_stations.canonical('Zürich') == 'Zürich'
+    assert bot._filter_stations.canonical('Z.rich') is None
+    assert bot._filter_regions.canonical('canton berne') == 'Canton Berne'
+
+
+def location_update(lat, lon):
+    update = MagicMock()
+    update.message.from_user.id = 42
+    update.message.from_user.first_name = 'Tester'
+    update.message.location.latitude = lat
+    update.message.location.longitude = lon
+    update.message.reply_text = AsyncMock()
+    return update
+
+
+def test_request_forecast_for_location(bot):
+    bot._db = MagicMock()
+    update = location_update(47.55, 7.6)
+    asyncio.run(bot._request_forecast_for_location(update, None))
+    bot._db.enqueue_request.assert_called_once_with(42, 'Basel', None)
+    assert 'Basel' in update.message.reply_text.call_args.args[0]
+    bot._db.log_activity.assert_called_once()
+
+
+def test_request_forecast_for_location_too_far(bot):
+    bot._db = MagicMock()
+    update = location_update(40.0, 7.6)
+    with patch.object(bot, '_schedule_point_request') as point_request:
+        asyncio.run(bot._request_forecast_for_location(update, None))
+    bot._db.enqueue_request.assert_not_called()
+    point_request.assert_called_once_with(update, 40.0, 7.6)
+
+
+@pytest.mark.parametrize("args",
+                         [[], ['46.5'], ['north', '7.9'], ['95', '7.9']])
+def test_request_forecast_for_point_invalid(bot, args):
+    update = location_update(0, 0)
+    context = MagicMock()
+    context.args = args
+    with patch.object(bot, '_schedule_point_request') as point_request:
+        asyncio.run(bot._request_forecast_for_point(update, context))
+    point_request.assert_not_called()
+    assert '/coordinates' in update.message.reply_text.call_args.args[0]
+
+
+def test_request_forecast_for_point(bot):
+    bot._db = MagicMock()
+    update = location_update(0, 0)
+    context = MagicMock()
+    context.args = ['46.5371', '7.9623']
+    ecmwf = MagicMock()
+    ecmwf.snap_point.return_value = (46.5, 8.0)
+    with patch.object(bot, '_ecmwf',
+                      ecmwf), patch.object(type(bot.app.job_queue),
+                                           'run_repeating') as run_repeating:
+        asyncio.run(bot._request_forecast_for_point(update, context))
+    ecmwf.snap_point.assert_called_once_with(46.5371, 7.9623)
+    assert run_repeating.call_args.kwargs['data'] == (42, 46.5, 8.0)
+    assert '46.50, 8.00' in update.message.reply_text.call_args.args[0]
+
+
+def test_duplicate_point_request(bot):
+    bot._db = MagicMock()
+    update = location_update(0, 0)
+    context = MagicMock()
+    context.args = ['46.5371', '7.9623']
+    ecmwf = MagicMock()
+    ecmwf.snap_point.return_value = (46.5, 8.0)
+    job_queue = type(bot.app.job_queue)
+    with patch.object(bot, '_ecmwf', ecmwf), patch.object(
+            job_queue, 'run_repeating') as run_repeating, patch.object(
+                job_queue, 'get_jobs_by_name', return_value=[MagicMock()]):
+        asyncio.run(bot._request_forecast_for_point(update, context))
+    run_repeating.assert_not_called()
+    bot._db.log_activity.assert_not_called()
+    assert 'already requested' in update.message.reply_text.call_args.args[0]
+
+
+def test_duplicate_station_request(bot):
+    bot._db = MagicMock()
+    bot._db.enqueue_request.return_value = False
+    update = callback_update(bot._callback_data('p', 's', 2, 0))
+    asyncio.run(bot._handle_inline_keyboard(update, MagicMock()))
+    assert 'already requested' in update.callback_query.edit_message_text.call_args.args[
+        0]
+    bot._db.log_activity.assert_not_called()
+
+
+def test_failed_station_request(bot):
+    from metrics import SUPPRESSED_REQUESTS
+
+    bot._db = MagicMock()
+    bot._db.enqueue_request.side_effect = RuntimeError('database is down')
+    duplicates = SUPPRESSED_REQUESTS.value(reason='duplicate')
+    update = callback_update(bot._callback_data('p', 's', 2, 0))
+    asyncio.run(bot._handle_inline_keyboard(update, MagicMock()))
+    assert 'request failed' in update.callback_query.edit_message_text.call_args.args[
+        0]
+    assert SUPPRESSED_REQUESTS.value(reason='duplicate') == duplicates
+    bot._db.log_activity.assert_not_called()
+
+    update = location_update(47.55, 7.6)
+    asyncio.run(bot._request_forecast_for_location(update, None))
+    assert 'request failed' in update.message.reply_text.call_args.args[0]
+    assert SUPPRESSED_REQUESTS.value(reason='duplicate') == duplicates
+
+
+def test_requests_are_rate_limited_per_chat(bot):
+    from ratelimit import ChatRateLimiter
+
+    bot._db = MagicMock()
+    limiter = ChatRateLimiter(rate=0.001, burst=2, max_chats=10)
+    with patch.object(bot, '_chat_limiter', limiter):
+        for _ in range(3):
+            update = callback_update(bot._callback_data('p', 's', 2, 0))
+            asyncio.run(bot._handle_inline_keyboard(update, MagicMock()))
+        assert bot._db.enqueue_request.call_count == 2
+        assert 'Please wait' in update.callback_query.edit_message_text.call_args.args[
+            0]
+
+        # other chats are not affected
+        update = location_update(47.55, 7.6)
+        update.message.from_user.id = 43
+        asyncio.run(bot._request_forecast_for_location(update, None))
+        assert bot._db.enqueue_request.call_count == 3
+
+
+def test_broadcast_queues_subscribers(bot):
+    plots = [f'./Basel_{i}.png' for i in ALL_EPSGRAM]
+    bot._db = MagicMock()
+    bot._db.get_demanded_products.return_value = {'Basel': None}
+    bot._db.get_products_by_station.return_value = {
+        1: ['classical_plume'],
+        2: None
+    }
+    ecmwf = MagicMock()
+    ecmwf.download_latest_plots.return_value = {'Basel': plots}
+    ecmwf.station_base_time.return_value = 'run'
+    with patch.object(bot, '_ecmwf', ecmwf):
+        asyncio.run(bot._broadcast(None))
+    ecmwf.download_latest_plots.assert_called_once_with(['Basel'],
+                                                        {'Basel': None})
+    bot._db.enqueue_deliveries.assert_called_once_with([
+        (1, 'Basel', 'run', ['classical_plume']),
+        (2, 'Basel', 'run', None),
+    ])
+    ecmwf.mark_broadcasted.assert_called_once_with(['Basel'])
+
+
+def test_fetch_jobs_run_off_the_event_loop(bot):
+    threads = []
+    ecmwf = MagicMock()
+    ecmwf.cache_plots.side_effect = lambda *args: threads.append(
+        threading.current_thread())
+    ecmwf.upgrade_basetime_global.side_effect = ecmwf.cache_plots.side_effect
+    bot._db = MagicMock()
+    # the query of the demanded products blocks as well
+    bot._db.get_demanded_products.side_effect = lambda: threads.append(
+        threading.current_thread()) or {
+            'Basel': None
+        }
+    with patch.object(bot, '_ecmwf', ecmwf):
+        asyncio.run(bot._cache_plots(None))
+        asyncio.run(bot._update_basetime(None))
+    ecmwf.cache_plots.assert_called_once_with({'Basel': None})
+    assert len(threads) == 3
+    assert threading.current_thread() not in threads
+    # one after the other on the same thread
+    assert len(set(threads)) == 1
+
+
+def test_delivery_downloads_off_the_event_loop(bot):
+    # the download optimizes the plots and waits for the process pool
+    threads = []
+    bot._db = MagicMock()
+    bot._db.claim_deliveries.return_value = [
+        dict(id=1, chat_id=1, station='Basel', base_time=None, products=None)
+    ]
+    bot._db.get_digest_users.return_value = set()
+    ecmwf = MagicMock()
+    ecmwf.download_plots.side_effect = lambda *args: threads.append(
+        threading.current_thread()) or {}
+    with patch.object(bot, '_ecmwf', ecmwf):
+        asyncio.run(bot._deliver(None))
+    assert len(threads) == 1
+    assert threads[0] is not threading.current_thread()
+    assert bot._db.retry_deliveries.call_args.args[0] == [1]
+
+
+def test_deliver(bot):
+    plots = ['./Basel_classical_plume.png']
+    bot._db = MagicMock()
+    bot._db.claim_deliveries.return_value = [
+        dict(id=1, chat_id=1, station='Basel', base_time='run', products=None),
+        dict(id=2, chat_id=2, station='Basel', base_time='old', products=None),
+        dict(id=3, chat_id=3, station='Basel', base_time=None, products=None),
+        dict(id=4, chat_id=4, station='Bern', base_time=None, products=None),
+        dict(id=5, chat_id=5, station='Basel', base_time=None, products=None),
+    ]
+    ecmwf = MagicMock()
+    ecmwf.station_base_time.return_value = 'run'
+    ecmwf.download_plots.side_effect = lambda names, products: {
+        'Basel': plots
+    } if names == ['Basel'] else {}
+    with patch.object(bot, '_ecmwf',
+                      ecmwf), patch.object(bot,
+                                           '_send_plots_to_user',
+                                           new_callable=AsyncMock) as send:
+        send.side_effect = [True, True, False]
+        asyncio.run(bot._deliver(None))
+
+    # plots are looked up once per station and products
+    assert ecmwf.download_plots.call_count == 2
+    assert [call.args[2] for call in send.call_args_list] == [1, 3, 5]
+    bot._db.ack_deliveries.assert_any_call([1, 3])
+    bot._db.ack_deliveries.assert_any_call([2], status='expired')
+    assert bot._db.retry_deliveries.call_args.args[0] == [4]
+    assert bot._db.fail_deliveries.call_args.args[0] == [5]
+
+
+def test_deliver_digest(bot):
+    bot._db = MagicMock()
+    bot._db.claim_deliveries.return_value = [
+        dict(id=1, chat_id=1, station='Basel', base_time='run', products=None),
+        dict(id=2, chat_id=2, station='Basel', base_time='run', products=None),
+        dict(id=3, chat_id=2, station='Bern', base_time='run', products=None),
+    ]
+    bot._db.get_digest_users.return_value = {1, 2}
+    bot._db.get_subscriptions_by_user.return_value = ['Basel', 'Bern']
+    bot._db.claim_digest.side_effect = [
+        [
+            dict(id=1,
+                 chat_id=1,
+                 station='Basel',
+                 base_time='run',
+                 products=None,
+                 overdue=False)
+        ],
+        [
+            dict(id=2,
+                 chat_id=2,
+                 station='Basel',
+                 base_time='run',
+                 products=None,
+                 overdue=False),
+            dict(id=3,
+                 chat_id=2,
+                 station='Bern',
+                 base_time='run',
+                 products=None,
+                 overdue=False),
+        ],
+    ]
+    ecmwf = MagicMock()
+    ecmwf.station_base_time.return_value = 'run'
+    ecmwf.download_plots.side_effect = lambda names, products: {
+        names[0]: [f'./{names[0]}_classical_plume.png']
+    }
+    with patch.object(bot, '_ecmwf', ecmwf), patch.object(
+            bot, '_send_plots_to_user',
+            new_callable=AsyncMock) as send, patch.object(
+                bot,
+                '_send_digest_to_user',
+                new_callable=AsyncMock,
+                return_value=True) as send_digest:
+        asyncio.run(bot._deliver(None))
+
+    send.assert_not_called()
+    # chat 1 waits for Bern, chat 2 gets both stations at once
+    send_digest.assert_called_once_with(
+        [('Basel', ['./Basel_classical_plume.png']),
+         ('Bern', ['./Bern_classical_plume.png'])], 2)
+    assert bot._db.hold_deliveries.call_args.args[0] == [1]
+    bot._db.ack_deliveries.assert_any_call([2, 3])
+
+
+def test_digest_does_not_wait_for_lagging_station(bot):
+    bot._db = MagicMock()
+    delivery = dict(id=1,
+                    chat_id=1,
+                    station='Basel',
+                    base_time='run',
+                    products=None)
+    bot._db.claim_deliveries.return_value = [delivery]
+    bot._db.get_digest_users.return_value = {1}
+    bot._db.get_subscriptions_by_user.return_value = ['Basel', 'Bern', 'Thun']
+    bot._db.claim_digest.return_value = [dict(delivery, overdue=False)]
+    ecmwf = MagicMock()
+    # Bern is still at the previous run, Thun got its plots of the run
+    # to the chat already
+    ecmwf.station_base_time.side_effect = lambda name: {
+        'Bern': 'previous'
+    }.get(name, 'run')
+    ecmwf.broadcast_pending.side_effect = lambda name: name != 'Thun'
+    ecmwf.download_plots.side_effect = lambda names, products: {
+        names[0]: [f'./{names[0]}_classical_plume.png']
+    }
+    with patch.object(bot, '_ecmwf',
+                      ecmwf), patch.object(bot,
+                                           '_send_digest_to_user',
+                                           new_callable=AsyncMock,
+                                           return_value=True) as send_digest:
+        asyncio.run(bot._deliver(None))
+
+    send_digest.assert_called_once_with(
+        [('Basel', ['./Basel_classical_plume.png'])], 1)
+    assert bot._db.hold_deliveries.call_args.args[0] == []
+    bot._db.ack_deliveries.assert_any_call([1])
+
+
+def test_digest_command(bot):
+    update = MagicMock()
+    update.message.chat_id = 42
+    update.message.reply_text = AsyncMock()
+    context = MagicMock()
+    bot._db = MagicMock()
+
+    context.args = ['on']
+    asyncio.run(bot._digest(update, context))
+    bot._db.set_digest.assert_called_once_with(42, True)
+    assert 'Digest is on' in update.message.reply_text.call_args.args[0]
+
+    context.args = ['maybe']
+    asyncio.run(bot._digest(update, context))
+    assert 'Usage' in update.message.reply_text.call_args.args[0]
+
+    context.args = []
+    bot._db.get_digest_users.return_value = set()
+    asyncio.run(bot._digest(update, context))
+    assert 'Digest is off' in update.message.reply_text.call_args.args[0]
+
+
+def test_stats_rate_limits(bot):
+    update = MagicMock()
+    update.message.chat_id = 123456789
+    update.message.reply_markdown = AsyncMock()
+    bot._db = MagicMock()
+    bot._db.get_activity_summary.return_value = []
+    bot._db.get_subscription_summary.return_value = []
+    bot._db.count_unique_subscribers.return_value = 0
+    ecmwf = MagicMock()
+    ecmwf.rate_limit_stats.return_value = {
+        'image': dict(acquired=3, throttled=1, max_wait=0.5)
+    }
+    with patch.object(bot, '_ecmwf', ecmwf):
+        asyncio.run(bot._stats(update, MagicMock()))
+    assert ('*ECMWF rate limits*\n- image: 3 requests, 1 throttled, '
+            'max wait 0.5s') in update.message.reply_markdown.call_args.args[0]
+
+    # the front-end leaves the limits to the fetcher
+    ecmwf.rate_limit_stats.return_value = {}
+    with patch.object(bot, '_ecmwf', ecmwf):
+        asyncio.run(bot._stats(update, MagicMock()))
+    assert 'rate limits' not in update.message.reply_markdown.call_args.args[0]
+
+
+def callback_update(data):
+    update = MagicMock()
+    update.callback_query.data = data
+    update.callback_query.from_user.id = 42
+    update.callback_query.from_user.first_name = 'Tester'
+    update.callback_query.answer = AsyncMock()
+    update.callback_query.edit_message_text = AsyncMock()
+    return update
+
+
+def test_inline_plots_flow(bot):
+    bot._db = MagicMock()
+    context = MagicMock()
+    context.user_data = {}
+
+    update = callback_update(bot._callback_data('p', 'r', 2))
+    asyncio.run(bot._handle_inline_keyboard(update, context))
+    edit = update.callback_query.edit_message_text
+    assert edit.call_args.kwargs['reply_markup'] is bot._inline_keyboards[('p',
+                                                                           2)]
+
+    update = callback_update(bot._callback_data('p', 's', 2, 0))
+    asyncio.run(bot._handle_inline_keyboard(update, context))
+    bot._db.enqueue_request.assert_called_once_with(42, 'Zürich', None)
+    assert 'Zürich' in update.callback_query.edit_message_text.call_args.args[
+        0]
+    bot._db.get_subscriptions_by_user.assert_not_called()
+
+
+def test_inline_subscribe_flow(bot):
+    bot._db = MagicMock()
+    bot._db.get_subscriptions_by_user.return_value = ['Basel']
+    context = MagicMock()
+    context.user_data = {}
+
+    update = location_update(0, 0)
+    update.message.chat_id = 42
+    asyncio.run(bot._start_subscribe(update, context))
+
+    # subscribed stations are left out of the keyboard
+    update = callback_update(bot._callback_data('s', 'r', 0))
+    asyncio.run(bot._handle_inline_keyboard(update, context))
+    assert update.callback_query.edit_message_text.call_args.args[
+        0] == 'Sorry, no more stations for you here'
+
+    update = callback_update(bot._callback_data('s', 'r', 1))
+    asyncio.run(bot._handle_inline_keyboard(update, context))
+    markup = update.callback_query.edit_message_text.call_args.kwargs[
+        'reply_markup']
+    assert markup.inline_keyboard[0][0].callback_data == bot._callback_data(
+        's', 's', 1, 0)
+
+    update = callback_update(bot._callback_data('s', 's', 1, 0))
+    asyncio.run(bot._handle_inline_keyboard(update, context))
+    markup = update.callback_query.edit_message_text.call_args.kwargs[
+        'reply_markup']
+    assert markup.inline_keyboard[0][0].text == '10-day plume'
+    assert [button.text
+            for button in markup.inline_keyboard[-2]] == ['All products']
+
+    # plume and 15-day meteogram, toggled one after the other
+    update = callback_update(markup.inline_keyboard[0][0].callback_data)
+    asyncio.run(bot._handle_inline_keyboard(update, context))
+    markup = update.callback_query.edit_message_text.call_args.kwargs[
+        'reply_markup']
+    update = callback_update(markup.inline_keyboard[2][0].callback_data)
+    asyncio.run(bot._handle_inline_keyboard(update, context))
+    markup = update.callback_query.edit_message_text.call_args.kwargs[
+        'reply_markup']
+    assert [row[0].text for row in markup.inline_keyboard[:3]
+            ] == ['✅ 10-day plume', '10-day meteogram', '✅ 15-day meteogram']
+    bot._db.add_subscription.assert_not_called()
+
+    confirm = markup.inline_keyboard[-2][1]
+    assert confirm.text == 'Confirm'
+    update = callback_update(confirm.callback_data)
+    asyncio.run(bot._handle_inline_keyboard(update, context))
+    bot._db.add_subscription.assert_called_once_with(
+        'Bern', 42, ['classical_plume', 'classical_15d'])
+    bot._db.enqueue_request.assert_called_once_with(
+        42, 'Bern', ['classical_plume', 'classical_15d'])
+    assert context.user_data['subscriptions'] == {'Basel', 'Bern'}
+    # one query for the whole conversation
+    bot._db.get_subscriptions_by_user.assert_called_once()
+
+
+def test_history_flow(bot, tmp_path):
+    from archive import PlotArchive
+    from test_plot_optimizer import uncompressed_png
+
+    bot._db = MagicMock()
+    context = MagicMock()
+    archive = PlotArchive(str(tmp_path / 'archive'))
+    runs = ['2025-01-01T00:00:00Z', '2025-01-01T12:00:00Z']
+    for i, run in enumerate(runs):
+        for product in reversed(ALL_EPSGRAM):
+            plot = tmp_path / f'Zürich_{product}.png'
+            plot.write_bytes(uncompressed_png(width=32 + i))
+            archive.add('Zürich', product, run, str(plot))
+
+    with patch.object(bot, '_archive',
+                      archive), patch.object(
+                          type(bot.app.bot),
+                          'send_photo',
+                          new_callable=AsyncMock) as send_photo:
+        update = callback_update(bot._callback_data('h', 'r', 2))
+        asyncio.run(bot._handle_inline_keyboard(update, context))
+        edit = update.callback_query.edit_message_text
+        assert edit.call_args.kwargs['reply_markup'] is bot._inline_keyboards[(
+            'h', 2)]
+
+        update = callback_update(bot._callback_data('h', 's', 2, 0))
+        asyncio.run(bot._handle_inline_keyboard(update, context))
+        markup = update.callback_query.edit_message_text.call_args.kwargs[
+            'reply_markup']
+        buttons = [row[0] for row in markup.inline_keyboard[:-1]]
+        assert [button.text for button in buttons
+                ] == ['2025-01-01 12 UTC', '2025-01-01 00 UTC']
+
+        update = callback_update(buttons[1].callback_data)
+        asyncio.run(bot._handle_inline_keyboard(update, context))
+        assert '2025-01-01 00 UTC' in update.callback_query.edit_message_text.call_args.args[
+            0]
+        # in the configured order
+        assert [
+            call.kwargs['filename'] for call in send_photo.call_args_list
+        ] == [f'Zürich_{product}_{runs[0]}.png' for product in ALL_EPSGRAM]
+        assert bot._db.log_activity.call_args.kwargs[
+            'activity_type'] == 'history-request'
+
+        # no runs of other stations
+        update = callback_update(bot._callback_data('h', 's', 0, 0))
+        asyncio.run(bot._handle_inline_keyboard(update, context))
+        assert 'no runs' in update.callback_query.edit_message_text.call_args.args[
+            0]
+    archive.close()
+
+
+def test_history_without_archive(bot):
+    update = location_update(0, 0)
+    asyncio.run(bot._start_history(update, MagicMock()))
+    assert 'not kept' in update.message.reply_text.call_args.args[0]
+
+
+def test_inline_subscribe_all_products(bot):
+    bot._db = MagicMock()
+    context = MagicMock()
+    context.user_data = {'subscriptions': set()}
+    markup = bot._product_inline_keyboard(1, 0)
+    all_products = markup.inline_keyboard[-2][0]
+    assert all_products.text == 'All products'
+    update = callback_update(all_products.callback_data)
+    asyncio.run(bot._handle_inline_keyboard(update, context))
+    bot._db.add_subscription.assert_called_once_with('Bern', 42, None)
+
+    # a selection of products no longer offered
+    update = callback_update(bot._callback_data('s', 'c', 1, 0, 8))
+    asyncio.run(bot._handle_inline_keyboard(update, context))
+    assert 'no longer available' in update.callback_query.edit_message_text.call_args.args[
+        0]
+    bot._db.add_subscription.assert_called_once()
+
+
+def test_inline_keyboard_outdated_selection(bot):
+    bot._db = MagicMock()
+    update = callback_update(bot._callback_data('p', 's', 0, 99))
+    asyncio.run(bot._handle_inline_keyboard(update, MagicMock()))
+    bot._db.enqueue_request.assert_not_called()
+    assert 'no longer available' in update.callback_query.edit_message_text.call_args.args[
+        0]
+
+
+def test_callbacks_are_timed(bot):
+    for handlers in bot.app.handlers.values():
+        for handler in handlers:
+            if hasattr(handler, 'callback'):
+                assert hasattr(handler.callback, '__wrapped__')
+    assert all(
+        hasattr(job.callback, '__wrapped__')
+        for job in bot.app.job_queue.jobs())
+
+
+def profile_update(chat_id, *args):
+    update = MagicMock()
+    update.message.chat_id = chat_id
+    update.message.reply_text = AsyncMock()
+    context = MagicMock()
+    context.args = list(args)
+    return update, context
+
+
+@pytest.mark.parametrize('chat_id, args, reply', [
+    (42, ['5'], 'not authorized'),
+    (123456789, ['0'], 'Usage'),
+    (123456789, ['abc'], 'Usage'),
+])
+def test_profile_rejected(bot, chat_id, args, reply):
+    update, context = profile_update(chat_id, *args)
+    asyncio.run(bot._profile(update, context))
+    assert reply in update.message.reply_text.call_args.args[0]
+
+
+def test_profile(bot, tmp_path):
+    update, context = profile_update(123456789, '5')
+    with patch.object(bot, '_profile_dir',
+                      str(tmp_path)), patch.object(type(bot.app.job_queue),
+                                                   'run_once') as run_once:
+        asyncio.run(bot._profile(update, context))
+        assert bot._sampler.running
+        assert run_once.call_args.kwargs['when'] == 5
+
+        # a second profile has to wait
+        second, context = profile_update(123456789, '5')
+        asyncio.run(bot._profile(second, context))
+        assert 'already running' in second.message.reply_text.call_args.args[0]
+
+        job_context = MagicMock()
+        job_context.job = MagicMock(chat_id=123456789,
+                                    data=run_once.call_args.kwargs['data'])
+        job_context.bot.send_message = AsyncMock()
+        asyncio.run(run_once.call_args.args[0](job_context))
+
+    assert not bot._sampler.running
+    text = job_context.bot.send_message.call_args.kwargs['text']
+    assert 'Hot functions' in text
+    assert len(list(tmp_path.glob('profile_*.txt'))) == 1
+
+
+@contextlib.contextmanager
+def running(bot):
+    # the bot in a thread of its own, stopped when leaving the context
+    loop = asyncio.new_event_loop()
+
+    def run():
+        asyncio.set_event_loop(loop)
+        bot.start(stop_signals=None, close_loop=False)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    try:
+        yield bot
+    finally:
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join(timeout=10)
+        loop.close()
+
+
+def write_bot_config(path, fake_telegram, **bot_config):
+    with open(path, 'w') as f:
+        yaml.dump(
+            {
+                'bot':
+                dict(token='9999999999:BBBBBBBRBBBBBBBBBBBBBBBBBBBBBBBBBBB',
+                     base_url=fake_telegram.base_url,
+                     **bot_config)
+            }, f)
+    return path
+
+
+def test_reload_stations(fake_telegram, station_config, tmp_path):
+    stations_file = tmp_path / 'stations.yaml'
+    stations_file.write_text(yaml.dump(station_config))
+    config_file = write_bot_config(str(tmp_path / 'config.yml'),
+                                   fake_telegram,
+                                   admin_ids=[123456789])
+    reload_bot = PlotBot(config_file,
+                         station_config,
+                         fetch=False,
+                         stations_file=str(stations_file))
+    keyboard = reload_bot._inline_keyboards['p']
+    # Zürich on a keyboard shown before the reload
+    stale = reload_bot._callback_data('p', 's', 2, 0)
+
+    # Zürich is replaced by Thun in a new region
+    stations_file.write_text(
+        yaml.dump(station_config[1:] + [{
+            'name': 'Thun',
+            'region': 'Berner Oberland',
+            'lat': 46.75,
+            'lon': 7.63
+        }]))
+    update, context = profile_update(123456789)
+    asyncio.run(reload_bot._reload(update, context))
+    reply = update.message.reply_text.call_args.args[0]
+    assert 'Added: Thun' in reply
+    assert 'Removed: Zürich' in reply
+
+    assert reload_bot._filter_stations.canonical('thun') == 'Thun'
+    assert reload_bot._filter_stations.canonical('Zürich') is None
+    assert reload_bot._filter_regions.canonical('Zurich') is None
+    assert reload_bot._inline_keyboards['p'] is not keyboard
+    assert [
+        row[0].text
+        for row in reload_bot._inline_keyboards['p'].inline_keyboard
+    ] == ['Basilea', 'Berner Oberland', 'Canton Berne', 'Cancel']
+    # the same positions are Bern in the new list
+    reload_bot._db = MagicMock()
+    update = callback_update(stale)
+    asyncio.run(reload_bot._handle_inline_keyboard(update, MagicMock()))
+    update.callback_query.answer.assert_called_once_with(
+        'List changed, please start again')
+    reload_bot._db.enqueue_request.assert_not_called()
+    # the change was picked up by /reload already
+    assert not reload_bot._stations_watcher.changed()
+
+    # a broken file keeps the stations
+    stations_file.write_text('- name: [')
+    asyncio.run(reload_bot._watch_stations(None))
+    assert 'Thun' in reload_bot._registry
+
+    update, context = profile_update(42)
+    asyncio.run(reload_bot._reload(update, context))
+    assert 'not authorized' in update.message.reply_text.call_args.args[0]
+
+
+def test_webhook_mode(fake_telegram, free_port, station_config, tmp_path):
+    url = f'http://127.0.0.1:{free_port}/webhook'
+    config_file = write_bot_config(str(tmp_path / 'config.yml'),
+                                   fake_telegram,
+                                   concurrent_updates=4,
+                                   webhook={
+                                       'port': free_port,
+                                       'url_path': 'webhook',
+                                       'url': url,
+                                       'secret_token': 'secret',
+                                   })
+    webhook_bot = PlotBot(config_file,
+                          station_config,
+                          db=MagicMock(),
+                          ecmwf=MagicMock(),
+                          fetch=False)
+
+    with running(webhook_bot):
+        for chat_id in (1, 2):
+            fake_telegram.push_message(chat_id, '/help')
+        assert fake_telegram.wait_for(
+            lambda: len(fake_telegram.sent(method='sendMessage')) == 2)
+        assert fake_telegram.webhook_url == url
+        assert not any(call['method'] == 'getUpdates'
+                       for call in fake_telegram.calls)
+
+
+def test_inline_plots_flow_edits_one_message(fake_telegram, station_config,
+                                             tmp_path):
+    config_file = write_bot_config(str(tmp_path / 'config.yml'), fake_telegram)
+    db = MagicMock()
+    polling_bot = PlotBot(config_file,
+                          station_config,
+                          db=db,
+                          ecmwf=MagicMock(),
+                          fetch=False)
+
+    with running(polling_bot):
+        fake_telegram.push_message(7, '/plots')
+        assert fake_telegram.wait_for(lambda: fake_telegram.sent(chat_id=7))
+        message_id = fake_telegram.sent(
+            chat_id=7)[0]['params'].get('message_id')
+        fake_telegram.push_callback_query(
+            7, polling_bot._callback_data('p', 'r', 0), message_id)
+        fake_telegram.push_callback_query(
+            7, polling_bot._callback_data('p', 's', 0, 0), message_id)
+        assert fake_telegram.wait_for(
+            lambda: len(fake_telegram.sent(method='editMessageText')) == 2)
+
+    assert len(fake_telegram.sent(chat_id=7, method='sendMessage')) == 1
+    db.enqueue_request.assert_called_once_with(7, 'Basel', None)
+    db.get_subscriptions_by_user.assert_not_called()
+
+
+def test_pipeline_delivers_new_run(fake_ecmwf, fake_telegram, tmp_path,
+                                   monkeypatch):
+    import pipeline
+    from ecmwf import EcmwfApi
+    from memory_db import MemoryDatabase
+
+    monkeypatch.chdir(tmp_path)
+    stations = pipeline.make_stations(3)
+    ecmwf = EcmwfApi(stations, {'api_url': fake_ecmwf.api_url})
+    db = MemoryDatabase()
+    pipeline.subscribe(db, stations, 4, 2, ALL_EPSGRAM)
+    config_file = write_bot_config(str(tmp_path / 'config.yml'), fake_telegram)
+    pipeline_bot = PlotBot(config_file, stations, db=db, ecmwf=ecmwf)
+
+    async def run_cycle():
+        async with pipeline_bot.app:
+            return await pipeline.run_cycle(pipeline_bot, ecmwf, db,
+                                            fake_ecmwf, fake_telegram, 60)
+
+    result = asyncio.run(run_cycle())
+    assert ecmwf.base_time == fake_ecmwf.base_time
+    assert result['undelivered'] == 0
+    # 2 stations for each of the 4 subscribers, one product for every 4th
+    assert result['telegram_calls']['sendMessage'] == 8
+    assert result['telegram_calls']['sendPhoto'] == 6 * 3 + 2 * 1
+    assert result['ecmwf_calls']['image'] == 3 * len(ALL_EPSGRAM)
+
+
+def test_pipeline_delivers_digests(fake_ecmwf, fake_telegram, tmp_path,
+                                   monkeypatch):
+    import pipeline
+    from ecmwf import EcmwfApi
+    from memory_db import MemoryDatabase
+
+    monkeypatch.chdir(tmp_path)
+    stations = pipeline.make_stations(3)
+    ecmwf = EcmwfApi(stations, {'api_url': fake_ecmwf.api_url})
+    db = MemoryDatabase()
+    pipeline.subscribe(db, stations, 4, 2, ALL_EPSGRAM)
+    for user_id in range(1000, 1004):
+        db.set_digest(user_id, True)
+    config_file = write_bot_config(str(tmp_path / 'config.yml'), fake_telegram)
+    pipeline_bot = PlotBot(config_file, stations, db=db, ecmwf=ecmwf)
+
+    async def run_cycle():
+        async with pipeline_bot.app:
+            return await pipeline.run_cycle(pipeline_bot, ecmwf, db,
+                                            fake_ecmwf, fake_telegram, 60)
+
+    result = asyncio.run(run_cycle())
+    assert result['undelivered'] == 0
+    # one album per subscriber instead of a message and photos per station
+    assert result['telegram_calls'] == {'sendMediaGroup': 4}
+
+
+def test_load_walks_get_replies(tmp_path, monkeypatch):
+    import load
+
+    monkeypatch.chdir(tmp_path)
+    # answers right after the reply, the conversation state must be stored
+    # by then
+    args = load.parse_args(
+        ['--chats', '20', '--ramp', '0.2', '--think_time', '0'])
+    result = asyncio.run(load.benchmark(args, str(tmp_path)))
+    assert result['timeouts'] == 0
+    assert {'/plots', 'p:r', 'p:s'} <= set(result['latencies'])
+    assert all(latency > 0 for values in result['latencies'].values()
+               for latency in values)
@@ -1,6 +1,7 @@
 import pytest
 import sys
 import os
+import psycopg2
 import yaml
 
 # Add the parent directory to the sys.path
@@ -37,12 +38,20 @@ def setup_and_teardown(db_instance):
         f"DELETE FROM activity_{db_instance._table_suffix}", ())
     db_instance._execute_query_with_value(
         f"DELETE FROM subscriptions_{db_instance._table_suffix}", ())
+    db_instance._execute_query_with_value(
+        f"DELETE FROM outbox_{db_instance._table_suffix}", ())
+    db_instance._execute_query_with_value(
+        f"DELETE FROM digest_{db_instance._table_suffix}", ())
     yield
     # Clear the test tables after each test
     db_instance._execute_query_with_value(
         f"DELETE FROM activity_{db_instance._table_suffix}", ())
     db_instance._execute_query_with_value(
         f"DELETE FROM subscriptions_{db_instance._table_suffix}", ())
+    db_instance._execute_query_with_value(
+        f"DELETE FROM outbox_{db_instance._table_suffix}", ())
+    db_instance._execute_query_with_value(
+        f"DELETE FROM digest_{db_instance._table_suffix}", ())
 
 
 def test_add_subscription(db_instance):
@@ -120,6 +129,24 @@ def test_subscription_summary(db_instance):
     assert summary == ["station1: 2", "station2: 1"]
 
 
+def test_subscription_summary_is_timed_once(db_instance):
+    from metrics import DB_QUERY_SECONDS
+
+    db_instance.add_subscription("station1", 12345)
+    summary = DB_QUERY_SECONDS.value(method='get_subscription_summary')
+    stations = DB_QUERY_SECONDS.value(method='stations_with_subscribers')
+    users = DB_QUERY_SECONDS.value(method='get_subscriptions_by_station')
+
+    db_instance.get_subscription_summary()
+
+    assert DB_QUERY_SECONDS.value(
+        method='get_subscription_summary') == summary + 1
+    assert DB_QUERY_SECONDS.value(
+        method='stations_with_subscribers') == stations
+    assert DB_QUERY_SECONDS.value(
+        method='get_subscriptions_by_station') == users
+
+
 def test_get_unique_subscribers(db_instance):
     # Add test data
     db_instance.add_subscription("station1", 12345)
@@ -129,3 +156,129 @@ def test_get_unique_subscribers(db_instance):
     unique_subscribers = db_instance.count_unique_subscribers()
 
     assert unique_subscribers == 3
+
+
+def test_get_products_by_station(db_instance):
+    db_instance.add_subscription("station1", 12345, ["classical_plume"])
+    db_instance.add_subscription("station1", 67890)
+
+    products = db_instance.get_products_by_station("station1")
+
+    assert products == {12345: ["classical_plume"], 67890: None}
+
+    # subscribing again replaces the products
+    db_instance.add_subscription("station1", 12345,
+                                 ["classical_10d", "classical_15d"])
+    products = db_instance.get_products_by_station("station1")
+    assert products[12345] == ["classical_10d", "classical_15d"]
+
+
+def test_get_demanded_products(db_instance):
+    db_instance.add_subscription("station1", 12345, ["classical_plume"])
+    db_instance.add_subscription("station1", 67890, ["classical_10d"])
+    db_instance.add_subscription("station2", 54321, ["classical_plume"])
+    db_instance.add_subscription("station2", 12345)
+
+    demand = db_instance.get_demanded_products()
+
+    assert demand == {
+        "station1": ["classical_10d", "classical_plume"],
+        "station2": None
+    }
+
+
+def test_enqueue_and_claim_deliveries(db_instance):
+    db_instance.enqueue_deliveries([
+        (12345, "station1", "2025-01-01T00:00:00Z", ["classical_plume"]),
+        (67890, "station1", "2025-01-01T00:00:00Z", None),
+    ])
+    # the same run is queued only once
+    db_instance.enqueue_deliveries([(12345, "station1", "2025-01-01T00:00:00Z",
+                                     None)])
+
+    claimed = db_instance.claim_deliveries(limit=10, lease=60, max_age=600)
+    assert [(d['chat_id'], d['products']) for d in claimed] == [
+        (12345, ["classical_plume"]),
+        (67890, None),
+    ]
+    # claimed deliveries are not handed out twice
+    assert db_instance.claim_deliveries(limit=10, lease=60, max_age=600) == []
+
+
+def test_enqueue_deliveries_raises_on_error(db_instance):
+    with pytest.raises(psycopg2.Error):
+        db_instance.enqueue_deliveries([("not a chat", "station1",
+                                         "2025-01-01T00:00:00Z", None)])
+    assert db_instance.claim_deliveries(limit=10, lease=60, max_age=600) == []
+
+
+def test_ack_retry_and_fail_deliveries(db_instance):
+    db_instance.enqueue_deliveries([(12345, "station1", None, None),
+                                    (67890, "station1", None, None),
+                                    (54321, "station2", None, None)])
+    sent, waiting, failing = db_instance.claim_deliveries(limit=10,
+                                                          lease=60,
+                                                          max_age=600)
+    db_instance.ack_deliveries([sent['id']])
+    db_instance.retry_deliveries([waiting['id']], delay=0)
+    db_instance.fail_deliveries([failing['id']], delay=0, max_attempts=1)
+
+    claimed = db_instance.claim_deliveries(limit=10, lease=60, max_age=600)
+    assert [d['id'] for d in claimed] == [waiting['id']]
+
+
+def test_expired_lease_is_claimed_again(db_instance):
+    db_instance.enqueue_deliveries([(12345, "station1", None, None)])
+    first = db_instance.claim_deliveries(limit=10, lease=0, max_age=600)
+    # e.g. after a crash before the delivery was acknowledged
+    second = db_instance.claim_deliveries(limit=10, lease=0, max_age=600)
+    assert [d['id'] for d in first] == [d['id'] for d in second]
+
+
+def test_enqueue_request_raises_on_error(db_instance):
+    with pytest.raises(psycopg2.Error):
+        db_instance.enqueue_request("not a chat", "station1")
+    # the connection is usable afterwards
+    assert db_instance.enqueue_request(12345, "station1")
+
+
+def test_enqueue_request_once(db_instance):
+    assert db_instance.enqueue_request(12345, "station1")
+    assert not db_instance.enqueue_request(12345, "station1", ["plume"])
+    assert db_instance.enqueue_request(12345, "station2")
+    assert db_instance.enqueue_request(67890, "station1")
+
+    claimed = db_instance.claim_deliveries(limit=10, lease=60, max_age=600)
+    assert len(claimed) == 3
+    # still open until acknowledged
+    assert not db_instance.enqueue_request(12345, "station1")
+    db_instance.ack_deliveries([d['id'] for d in claimed])
+    assert db_instance.enqueue_request(12345, "station1")
+
+
+def test_digest_users(db_instance):
+    db_instance.set_digest(12345, True)
+    db_instance.set_digest(12345, True)
+    db_instance.set_digest(67890, True)
+    assert db_instance.get_digest_users([12345, 11111]) == {12345}
+    db_instance.set_digest(12345, False)
+    assert db_instance.get_digest_users([12345, 67890]) == {67890}
+
+
+def test_claim_and_hold_digest(db_instance):
+    run = "2025-01-01T00:00:00Z"
+    db_instance.enqueue_deliveries([(12345, "station1", run, None),
+                                    (12345, "station2", run, ["a"]),
+                                    (67890, "station1", run, None)])
+    digest = db_instance.claim_digest(12345, run, lease=60, deadline=600)
+    assert [d['station'] for d in digest] == ["station1", "station2"]
+    assert digest[1]['products'] == ["a"]
+    assert not any(d['overdue'] for d in digest)
+
+    # held until the deadline, then handed out by claim_deliveries again
+    db_instance.hold_deliveries([d['id'] for d in digest], deadline=0)
+    claimed = db_instance.claim_deliveries(limit=10, lease=60, max_age=600)
+    assert len(claimed) == 3
+    assert all(
+        d['overdue']
+        for d in db_instance.claim_digest(12345, run, lease=60, deadline=0))
@@ -1,4 +1,5 @@
 import pytest
+import json
 import yaml
 import sys
 import os
@@ -245,9 +246,12 @@ def test_download_latest_plots_for(ecmwf, station):
         if Station.name == station:
             ecmwf._stations = [Station]
             Station.base_time = past
+            Station.has_been_broadcasted = False
             assert ecmwf.download_latest_plots([
                 station
             ]) == expected_plots, "Plots should match expected_plots"
+            assert Station.has_been_broadcasted == False, "broadcast flag is set once queued"
+            ecmwf.mark_broadcasted([station])
             assert Station.has_been_broadcasted == True, "broadcast flag should be true"
 
 
@@ -296,3 +300,443 @@ def test_upgrade_basetime_stations_same_as_global(ecmwf):
         ecmwf.upgrade_basetime_stations()
         assert Station.base_time == ecmwf._base_time, "base time should be same as global"
         assert Station.has_been_broadcasted == True, "broadcast flag should remain untouched"
+
+
+class FakeImageResponse():
+
+    def __init__(self, status_code=200, content=b'', headers=None):
+        self.status_code = status_code
+        self.ok = status_code < 400
+        self.content = content
+        self.headers = headers or {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def iter_content(self, chunk_size):
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i:i + chunk_size]
+
+
+@pytest.fixture
+def png_bytes():
+    from test_pngfile import make_png
+    return make_png()
+
+
+def test_save_image_validates_png(ecmwf, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    Station = ecmwf._stations[0]
+    html = FakeImageResponse(content=b'<html>error</html>',
+                             headers={'Content-Type': 'text/html'})
+    with patch('ecmwf.requests.get', return_value=html):
+        with pytest.raises(ValueError):
+            ecmwf._save_image_of_station('https://img/1', Station,
+                                         ALL_EPSGRAM[0])
+    assert not os.listdir(tmp_path), "invalid image must not be stored"
+
+
+def test_save_image_rejects_truncated_png(ecmwf, tmp_path, monkeypatch,
+                                          png_bytes):
+    monkeypatch.chdir(tmp_path)
+    ecmwf._retry_policy.tries = 1
+    Station = ecmwf._stations[0]
+    truncated = FakeImageResponse(content=png_bytes[:-10])
+    with patch('ecmwf.requests.get', return_value=truncated):
+        with pytest.raises(ValueError):
+            ecmwf._save_image_of_station('https://img/1', Station,
+                                         ALL_EPSGRAM[0])
+    assert not os.listdir(tmp_path), "truncated image must not be stored"
+
+
+def test_save_image_sends_conditional_headers(ecmwf, tmp_path, monkeypatch,
+                                              png_bytes):
+    monkeypatch.chdir(tmp_path)
+    Station = ecmwf._stations[0]
+    first = FakeImageResponse(content=png_bytes,
+                              headers={
+                                  'ETag': '"abc"',
+                                  'Last-Modified':
+                                  'Mon, 01 Jan 2024 00:00:00 GMT'
+                              })
+    with patch('ecmwf.requests.get', return_value=first):
+        file = ecmwf._save_image_of_station('https://img/1', Station,
+                                            ALL_EPSGRAM[0])
+    mtime = os.stat(file).st_mtime_ns
+
+    with patch('ecmwf.requests.get',
+               return_value=FakeImageResponse(status_code=304)) as get:
+        assert ecmwf._save_image_of_station('https://img/1', Station,
+                                            ALL_EPSGRAM[0]) == file
+    headers = get.call_args.kwargs['headers']
+    assert headers['If-None-Match'] == '"abc"'
+    assert headers['If-Modified-Since'] == 'Mon, 01 Jan 2024 00:00:00 GMT'
+    assert os.stat(file).st_mtime_ns == mtime, "file should be untouched"
+
+
+def test_save_image_identical_content_is_not_rewritten(ecmwf, tmp_path,
+                                                       monkeypatch, png_bytes):
+    monkeypatch.chdir(tmp_path)
+    Station = ecmwf._stations[0]
+    file = './{}_{}.png'.format(Station.name, ALL_EPSGRAM[0])
+    with open(file, 'wb') as img:
+        img.write(png_bytes)
+    ecmwf.plot_cache.get(file)
+
+    with patch('ecmwf.requests.get',
+               return_value=FakeImageResponse(content=png_bytes)):
+        ecmwf._save_image_of_station('https://img/1', Station, ALL_EPSGRAM[0])
+    assert file in ecmwf.plot_cache, "unchanged plot should stay cached"
+    assert sorted(os.listdir(tmp_path)) == [os.path.basename(file)]
+
+
+def test_state_is_restored_after_restart(station_config, tmp_path, monkeypatch,
+                                         png_bytes):
+    monkeypatch.chdir(tmp_path)
+    config = {'state_file': str(tmp_path / 'state.json')}
+    with patch.object(EcmwfApi, '_get_from_API', side_effect=ValueError):
+        ecmwf = EcmwfApi(station_config[:2], config)
+    cached, uncached = ecmwf._stations
+    for Station in ecmwf._stations:
+        for plot in Station.plots(ALL_EPSGRAM):
+            with open(plot, 'wb') as img:
+                img.write(png_bytes)
+            ecmwf._image_validators[plot] = {'sha256': 'abc'}
+    cached.plots_cached = True
+    cached.has_been_broadcasted = False
+    uncached.plots_cached = True
+    ecmwf._save_state()
+
+    # a plot of the second station changed on disk after the snapshot
+    with open(uncached.plots(ALL_EPSGRAM)[0], 'wb') as img:
+        img.write(b'changed')
+
+    with patch.object(EcmwfApi, '_get_from_API', side_effect=ValueError):
+        restarted = EcmwfApi(station_config[:2], config)
+    cached, uncached = restarted._stations
+    assert cached.plots_cached is True
+    assert cached.has_been_broadcasted is False, "pending broadcast should resume"
+    assert uncached.plots_cached is False, "modified plots must be re-fetched"
+    assert restarted._image_validators[cached.plots(ALL_EPSGRAM)[0]] == {
+        'sha256': 'abc'
+    }
+
+
+def test_override_base_time_skips_up_to_date_stations(ecmwf):
+    with patch.object(EcmwfApi, '_latest_confirmed_run') as confirmed_run:
+        ecmwf.override_base_time_from_init()
+    confirmed_run.assert_not_called()
+
+
+def test_fast_start_does_not_call_api(station_config):
+    with patch.object(EcmwfApi, '_get_from_API') as get:
+        ecmwf = EcmwfApi(station_config, discover_base_time=False)
+        Station = ecmwf._stations[0]
+        assert ecmwf._download_plots(Station) == {}
+    get.assert_not_called()
+    assert ecmwf.base_time_discovered is False
+    datetime.strptime(ecmwf._base_time, ecmwf._time_format)
+
+
+def test_discover_base_time_after_fast_start(station_config):
+    with patch.object(EcmwfApi, '_get_from_API', side_effect=ValueError):
+        ecmwf = EcmwfApi(station_config, discover_base_time=False)
+    provisional = ecmwf._base_time
+    discovered = ecmwf._fetch_available_base_time(fallback=True, timeshift=12)
+    with patch.object(EcmwfApi,
+                      '_fetch_available_base_time',
+                      return_value=discovered):
+        ecmwf.discover_base_time()
+    assert ecmwf.base_time_discovered is True
+    assert ecmwf._base_time != provisional
+    for Station in ecmwf._stations:
+        assert Station.base_time == discovered
+        assert Station.has_been_broadcasted is True, "startup must not trigger a broadcast"
+
+
+def test_first_guess_base_time_is_a_run(ecmwf):
+    first_guess = datetime.strptime(ecmwf._first_guess_base_time(),
+                                    ecmwf._time_format)
+    assert first_guess.hour in (0, 12)
+    assert first_guess.minute == 0
+    assert first_guess < datetime.now()
+
+
+def test_download_plots_for_point(station_config, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    with patch.object(EcmwfApi, '_get_from_API', side_effect=ValueError):
+        ecmwf = EcmwfApi(station_config, discover_base_time=False)
+    ecmwf.base_time_discovered = True
+
+    def save_image(image_api, station, eps_type):
+        file = f'./{station.name}_{eps_type}.png'
+        open(file, 'wb').close()
+        return file
+
+    with patch.object(ecmwf, '_request_epsgram_link_for_station', return_value='link'), \
+            patch.object(ecmwf, '_save_image_of_station', side_effect=save_image):
+        name, plots = ecmwf.download_plots_for_point(46.5371, 7.9623)
+    assert name == '46.50N 8.00E'
+    assert plots == [f'./46.50N 8.00E_{i}.png' for i in ALL_EPSGRAM]
+    assert all(os.path.exists(plot) for plot in plots)
+
+    # a new run makes the ad hoc plots stale
+    ecmwf._adhoc.evict_stale('2000-01-01T00:00:00Z')
+    assert len(ecmwf._adhoc) == 0
+    assert not any(os.path.exists(plot) for plot in plots)
+
+
+def test_download_plots_fetches_only_requested_products(
+        station_config, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    with patch.object(EcmwfApi, '_get_from_API', side_effect=ValueError):
+        ecmwf = EcmwfApi(station_config, discover_base_time=False)
+    ecmwf.base_time_discovered = True
+    fetched = []
+
+    def save_image(image_api, station, eps_type):
+        fetched.append(eps_type)
+        return f'./{station.name}_{eps_type}.png'
+
+    with patch.object(ecmwf, '_request_epsgram_link_for_station', return_value='link'), \
+            patch.object(ecmwf, '_save_image_of_station', side_effect=save_image):
+        plots = ecmwf.download_plots(['Bern'], {'Bern': ['classical_plume']})
+        assert plots == {'Bern': ['./Bern_classical_plume.png']}
+        assert fetched == ['classical_plume']
+        Station = ecmwf._registry.get('Bern')
+        assert Station.plots_cached is False
+
+        # only the missing products are fetched afterwards
+        plots = ecmwf.download_plots(['Bern'])
+        assert plots == {'Bern': [f'./Bern_{i}.png' for i in ALL_EPSGRAM]}
+        assert fetched == ALL_EPSGRAM
+        assert Station.plots_cached is True
+
+
+def test_cache_plots_only_for_demanded_products(station_config, tmp_path,
+                                                monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    with patch.object(EcmwfApi, '_get_from_API', side_effect=ValueError):
+        ecmwf = EcmwfApi(station_config, discover_base_time=False)
+    ecmwf.base_time_discovered = True
+    fetched = []
+
+    def save_image(image_api, station, eps_type):
+        fetched.append((station.name, eps_type))
+        return f'./{station.name}_{eps_type}.png'
+
+    first, second = ecmwf._stations[:2]
+    # nobody subscribed to the first station
+    demand = {second.name: ['classical_plume']}
+    with patch.object(ecmwf, '_request_epsgram_link_for_station', return_value='link'), \
+            patch.object(ecmwf, '_save_image_of_station', side_effect=save_image):
+        ecmwf.cache_plots(demand)
+        assert fetched == [(second.name, 'classical_plume')]
+        ecmwf.cache_plots(demand)
+        assert len(fetched) == 1, "all demanded plots are cached"
+
+        ecmwf.cache_plots()
+        assert fetched[1:] == [(first.name, i) for i in ALL_EPSGRAM]
+    assert first.plots_cached is True
+    assert second.plots_cached is False
+
+
+def test_products_from_config(station_config):
+    config = {'products': {'classical_plume': '10-day plume'}}
+    with patch.object(EcmwfApi, '_get_from_API', side_effect=ValueError):
+        ecmwf = EcmwfApi(station_config, config, discover_base_time=False)
+    assert ecmwf._epsgrams == ['classical_plume']
+    assert ecmwf._selected_products(['classical_15d', 'classical_plume'
+                                     ]) == ['classical_plume']
+
+
+def test_run_flip_against_fake_api(fake_ecmwf, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    ecmwf = EcmwfApi([{
+        'name': 'Bern',
+        'region': 'Bern',
+        'lat': 46.95,
+        'lon': 7.45
+    }], {'api_url': fake_ecmwf.api_url})
+    assert ecmwf.base_time == fake_ecmwf.base_time
+    assert ecmwf.download_plots(['Bern']) == {
+        'Bern': [f'./Bern_{i}.png' for i in ALL_EPSGRAM]
+    }
+
+    new_run = fake_ecmwf.flip_run()
+    ecmwf.upgrade_basetime_global()
+    ecmwf.upgrade_basetime_stations()
+    assert ecmwf.station_base_time('Bern') == new_run
+    assert ecmwf.download_latest_plots(['Bern']) == {
+        'Bern': [f'./Bern_{i}.png' for i in ALL_EPSGRAM]
+    }
+    # pending until the deliveries are queued
+    assert ecmwf.download_latest_plots(['Bern'])
+    ecmwf.mark_broadcasted(['Bern'])
+    assert ecmwf.download_latest_plots(['Bern']) == {}
+    assert fake_ecmwf.counts['image'] == 2 * len(ALL_EPSGRAM)
+
+
+def test_state_is_saved_only_after_changes(fake_ecmwf, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    state_file = str(tmp_path / 'state.json')
+    ecmwf = EcmwfApi([{
+        'name': 'Bern',
+        'region': 'Bern',
+        'lat': 46.95,
+        'lon': 7.45
+    }], {
+        'api_url': fake_ecmwf.api_url,
+        'state_file': state_file
+    })
+    ecmwf.download_plots(['Bern'])
+
+    # the snapshot stats every plot
+    with patch.object(ecmwf, '_snapshot', wraps=ecmwf._snapshot) as snapshot:
+        ecmwf.download_plots(['Bern'])
+        ecmwf.cache_plots({'Bern': None})
+        ecmwf.download_latest_plots(['Bern'])
+        ecmwf.mark_broadcasted(['Bern'])
+        ecmwf.upgrade_basetime_stations()
+        snapshot.assert_not_called()
+
+        new_run = fake_ecmwf.flip_run()
+        ecmwf.upgrade_basetime_global()
+        ecmwf.upgrade_basetime_stations()
+        snapshot.assert_called_once()
+    with open(state_file) as file:
+        assert json.load(file)['stations']['Bern']['base_time'] == new_run
+
+
+def test_requests_are_counted(fake_ecmwf, tmp_path, monkeypatch):
+    from metrics import ECMWF_REQUESTS, RATE_LIMIT_WAIT_SECONDS, REGISTRY
+
+    monkeypatch.chdir(tmp_path)
+    before = ECMWF_REQUESTS.value(endpoint='image', outcome='200')
+    waits = RATE_LIMIT_WAIT_SECONDS.value(budget='image')
+    ecmwf = EcmwfApi([{
+        'name': 'Bern',
+        'region': 'Bern',
+        'lat': 46.95,
+        'lon': 7.45
+    }], {'api_url': fake_ecmwf.api_url})
+    ecmwf.download_plots(['Bern'])
+    assert ECMWF_REQUESTS.value(endpoint='image',
+                                outcome='200') == before + len(ALL_EPSGRAM)
+    assert ECMWF_REQUESTS.value(endpoint='schema', outcome='200') >= 1
+    assert RATE_LIMIT_WAIT_SECONDS.value(
+        budget='image') == waits + len(ALL_EPSGRAM)
+    assert (f'ensplotbot_cached_stations{{base_time="{ecmwf.base_time}"}} 1'
+            in REGISTRY.render())
+
+
+def test_plots_are_optimized(fake_ecmwf, tmp_path, monkeypatch):
+    from metrics import PLOT_BYTES_SAVED
+    from pngfile import read_chunks
+
+    monkeypatch.chdir(tmp_path)
+    before = PLOT_BYTES_SAVED.value()
+    ecmwf = EcmwfApi([{
+        'name': 'Bern',
+        'region': 'Bern',
+        'lat': 46.95,
+        'lon': 7.45
+    }], {
+        'api_url': fake_ecmwf.api_url,
+        'optimize': {
+            'workers': 1
+        }
+    })
+    plots = ecmwf.download_plots(['Bern'])['Bern']
+    assert ecmwf._optimizer.bytes_saved > 0
+    assert PLOT_BYTES_SAVED.value() == before + ecmwf._optimizer.bytes_saved
+    for plot in plots:
+        # the fake API titles every image in a tEXt chunk
+        data = ecmwf.plot_cache.get(plot)
+        assert b'tEXt' not in [
+            chunk_type for chunk_type, _ in read_chunks(data)
+        ]
+        assert len(data) == os.path.getsize(plot)
+    ecmwf._optimizer.close()
+
+
+def test_runs_are_archived(fake_ecmwf, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    ecmwf = EcmwfApi(
+        [{
+            'name': 'Bern',
+            'region': 'Bern',
+            'lat': 46.95,
+            'lon': 7.45
+        }], {
+            'api_url': fake_ecmwf.api_url,
+            'optimize': {
+                'workers': 1
+            },
+            'archive': {
+                'dir': str(tmp_path / 'archive')
+            }
+        })
+    first_run = ecmwf.base_time
+    ecmwf.download_plots(['Bern'])
+    new_run = fake_ecmwf.flip_run()
+    ecmwf.upgrade_basetime_global()
+    ecmwf.upgrade_basetime_stations()
+    ecmwf.download_latest_plots(['Bern'])
+    ecmwf.download_plots_for_point(46.5, 8.0)
+
+    assert ecmwf._archive.runs('Bern') == [new_run, first_run]
+    assert sorted(ecmwf._archive.get('Bern', first_run)) == sorted(ALL_EPSGRAM)
+    # optimized at download, archived as they are
+    assert ecmwf._archive._optimizer is None
+    for product in ALL_EPSGRAM:
+        with open(f'./Bern_{product}.png', 'rb') as file:
+            assert ecmwf._archive.get('Bern', new_run)[product] == file.read()
+    # ad-hoc points are not archived
+    assert ecmwf._archive.runs('46.50N 8.00E') == []
+    ecmwf._archive.close()
+    ecmwf._optimizer.close()
+
+
+def test_reload_stations(fake_ecmwf, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    stations = [{
+        'name': name,
+        'region': 'Bern',
+        'lat': 46.95 + i,
+        'lon': 7.45
+    } for i, name in enumerate(['Bern', 'Basel', 'Thun'])]
+    ecmwf = EcmwfApi(stations, {'api_url': fake_ecmwf.api_url})
+    ecmwf.download_plots(['Bern', 'Basel', 'Thun'])
+    bern = ecmwf._registry.get('Bern')
+
+    # Basel moves, Thun is replaced by Zürich
+    stations[1] = dict(stations[1], lat=47.56)
+    stations[2] = {
+        'name': 'Zürich',
+        'region': 'Zurich',
+        'lat': 47.4,
+        'lon': 8.5
+    }
+    assert ecmwf.reload_stations(stations) == (['Zürich'], ['Thun'], ['Basel'])
+    assert ecmwf._registry.get('Bern') is bern
+    assert bern.plots_cached
+    assert all(os.path.exists(plot) for plot in bern.plots(ALL_EPSGRAM))
+    for name in ['Basel', 'Thun']:
+        assert not any(
+            os.path.exists(f'./{name}_{product}.png')
+            for product in ALL_EPSGRAM)
+    assert not ecmwf._registry.get('Basel').plots_cached
+    assert ecmwf.station_base_time('Zürich') == ecmwf.base_time
+    assert ecmwf.station_base_time('Thun') is None
+    assert not ecmwf.broadcast_pending('Zürich')
+    assert not ecmwf.broadcast_pending('Thun')
+
+    # a new region keeps the plots
+    stations[0] = dict(stations[0], region='Mittelland')
+    assert ecmwf.reload_stations(stations) == ([], [], ['Bern'])
+    assert ecmwf._registry.get('Bern').plots_cached
+    assert all(os.path.exists(plot) for plot in bern.plots(ALL_EPSGRAM))
@@ -0,0 +1,70 @@
+import pytest
+import random
+import sys
+import os
+
+# Add the parent directory to the sys.path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from geo import SpatialIndex, haversine
+
+
+def brute_force(points, lat, lon, k, max_distance=None):
+    distances = sorted((haversine(lat, lon, p_lat, p_lon), key)
+                       for key, p_lat, p_lon in points)
+    if max_distance is not None:
+        distances = [d for d in distances if d[0] <= max_distance]
+    return [key for _, key in distances[:k]]
+
+
+def test_haversine():
+    # Zurich - Bern
+    assert haversine(47.3667, 8.55, 46.9481, 7.4474) == pytest.approx(95,
+                                                                      abs=1)
+    assert haversine(46.0, 7.0, 46.0, 7.0) == 0
+
+
+def test_nearest_in_switzerland():
+    points = [('Zürich', 47.3667, 8.55), ('Bern', 46.9481, 7.4474),
+              ('Basel', 47.5584, 7.57327)]
+    index = SpatialIndex(points)
+    distance, name = index.nearest(46.95, 7.44)[0]
+    assert name == 'Bern'
+    assert distance < 1
+    assert [name for _, name in index.nearest(47.5, 7.6, k=2)
+            ] == brute_force(points, 47.5, 7.6, 2)
+
+
+def test_max_distance():
+    index = SpatialIndex([('Bern', 46.9481, 7.4474)])
+    assert index.nearest(0.0, 0.0, max_distance=50) == []
+    assert index.nearest(46.9, 7.4, max_distance=50)[0][1] == 'Bern'
+
+
+def test_empty_index():
+    assert SpatialIndex([]).nearest(46.9, 7.4) == []
+
+
+@pytest.mark.parametrize("n", [10, 1000])
+def test_matches_brute_force(n):
+    rng = random.Random(n)
+    points = [(i, rng.uniform(-80, 80), rng.uniform(-180, 180))
+              for i in range(n)]
+    index = SpatialIndex(points)
+    for _ in range(50):
+        lat, lon = rng.uniform(-89, 89), rng.uniform(-180, 180)
+        k = rng.choice([1, 3])
+        max_distance = rng.choice([None, 1000])
+        assert [key for _, key in index.nearest(lat, lon, k, max_distance)
+                ] == brute_force(points, lat, lon, k, max_distance)
+
+
+def test_dense_catalog_matches_brute_force():
+    rng = random.Random(0)
+    points = [(i, rng.uniform(45.8, 47.8), rng.uniform(5.9, 10.5))
+              for i in range(5000)]
+    index = SpatialIndex(points)
+    for _ in range(20):
+        lat, lon = rng.uniform(45.8, 47.8), rng.uniform(5.9, 10.5)
+        assert [key for _, key in index.nearest(lat, lon, 3)
+                ] == brute_force(points, lat, lon, 3)
@@ -0,0 +1,35 @@
+import sys
+import os
+
+# Add the parent directory to the sys.path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from ipc import Channel, FETCHER_SOCKET, FRONTEND_SOCKET
+
+
+def test_send_and_receive(tmp_path):
+    with Channel(str(tmp_path), FETCHER_SOCKET) as fetcher, Channel(
+            str(tmp_path), FRONTEND_SOCKET) as frontend:
+        assert frontend.send(FETCHER_SOCKET, {'type': 'fetch', 'station': 'A'})
+        assert frontend.send(FETCHER_SOCKET, {'type': 'fetch', 'station': 'B'})
+        messages = fetcher.receive(timeout=1)
+    assert [message['station'] for message in messages] == ['A', 'B']
+
+
+def test_receive_without_messages(tmp_path):
+    with Channel(str(tmp_path), FETCHER_SOCKET) as fetcher:
+        assert fetcher.receive() == []
+        assert fetcher.receive(timeout=0.01) == []
+
+
+def test_send_to_missing_peer_is_dropped(tmp_path):
+    with Channel(str(tmp_path), FRONTEND_SOCKET) as frontend:
+        assert frontend.send(FETCHER_SOCKET, {'type': 'fetch'}) is False
+
+
+def test_stale_socket_is_replaced(tmp_path):
+    Channel(str(tmp_path), FETCHER_SOCKET)
+    # the first worker died without closing its channel
+    with Channel(str(tmp_path), FETCHER_SOCKET) as fetcher:
+        assert os.path.exists(fetcher.path)
+    assert not os.path.exists(fetcher.path)
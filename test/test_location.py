@@ -63,7 +63,7 @@ def test_init_location():
     assert location.base_time is None
     assert location.has_been_broadcasted is True
     assert location.plots_cached is False
-    assert location.all_plots == [
+    assert location.plots(ALL_EPSGRAM) == [
         f'./TestStation_{i}.png' for i in ALL_EPSGRAM
     ]
 
@@ -77,3 +77,43 @@ def test_upgrade_basetime():
     assert location.base_time == "2023-10-01 12:00"
     assert location.has_been_broadcasted is False
     assert location.plots_cached is False
+
+
+def test_snapshot_and_restore():
+    location = APILocation(name="TestStation",
+                           lat=47.0,
+                           lon=8.0,
+                           region="Zurich")
+    location.upgrade_basetime("2023-10-01 12:00")
+    location.plots_cached = True
+
+    restored = APILocation(name="TestStation",
+                           lat=47.0,
+                           lon=8.0,
+                           region="Zurich")
+    restored.restore(location.snapshot())
+    assert restored.base_time == "2023-10-01 12:00"
+    assert restored.has_been_broadcasted is False
+    assert restored.plots_cached is True
+
+
+def test_location_is_compact():
+    location = APILocation(name="TestStation",
+                           lat=47.0,
+                           lon=8.0,
+                           region="Zurich")
+    assert not hasattr(location, '__dict__')
+    with pytest.raises(AttributeError):
+        location.unknown_attribute = 1
+
+
+def test_plots_for_products():
+    location = APILocation(name="TestStation",
+                           lat=47.0,
+                           lon=8.0,
+                           region="Zurich")
+    assert location.plots(['classical_plume'
+                           ]) == ['./TestStation_classical_plume.png']
+    location.cached_products.add('classical_plume')
+    location.upgrade_basetime("2023-10-01 12:00")
+    assert location.cached_products == set()
@@ -0,0 +1,108 @@
+import io
+import json
+import logging
+import pytest
+import sys
+import os
+import threading
+
+# Add the parent directory to the sys.path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from logger_config import (JsonFormatter, SamplingFilter, configure_logging,
+                           _listener, _queue_handler, _stream_handler)
+
+
+def make_record(msg, *args, name='ensplotbot', level=logging.DEBUG, **extra):
+    record = logging.LogRecord(name, level, __file__, 1, msg, args, None)
+    record.__dict__.update(extra)
+    return record
+
+
+def test_json_formatter_extra_fields():
+    record = make_record('Sent %d plots of %s',
+                         3,
+                         'Bern',
+                         station='Bern',
+                         chat_id=42,
+                         duration=0.5)
+    entry = json.loads(JsonFormatter().format(record))
+    assert entry['message'] == 'Sent 3 plots of Bern'
+    assert entry['level'] == 'DEBUG'
+    assert entry['logger'] == 'ensplotbot'
+    assert entry['station'] == 'Bern'
+    assert entry['chat_id'] == 42
+    assert entry['duration'] == 0.5
+    assert 'base_time' not in entry
+
+
+def test_sampling_per_logger_and_message():
+    sampler = SamplingFilter({'ensplotbot': 3})
+    passed = [
+        sampler.filter(make_record('GET %s', f'url{i}')) for i in range(7)
+    ]
+    assert passed == [True, False, False, True, False, False, True]
+    # counted separately from other messages
+    assert sampler.filter(make_record('image saved in %s', 'file'))
+
+
+def test_sampling_applies_to_children_and_debug_only():
+    sampler = SamplingFilter({'ensplotbot': 2})
+    child = [
+        sampler.filter(make_record('GET %s', 'url', name='ensplotbot.ecmwf'))
+        for _ in range(4)
+    ]
+    assert child == [True, False, True, False]
+    assert all(
+        sampler.filter(make_record('Fetching', level=logging.INFO))
+        for _ in range(4))
+    assert all(
+        sampler.filter(make_record('GET %s', 'url', name='httpx'))
+        for _ in range(4))
+
+
+def test_sampling_rejects_invalid_rate():
+    with pytest.raises(ValueError):
+        SamplingFilter({'ensplotbot': 0})
+
+
+def test_configure_logging():
+    try:
+        configure_logging({'format': 'json', 'sample': {'ensplotbot': 10}})
+        assert isinstance(_stream_handler.formatter, JsonFormatter)
+        assert len(_queue_handler.filters) == 1
+        configure_logging({'format': 'json', 'sample': {'ensplotbot': 5}})
+        assert len(_queue_handler.filters) == 1
+        with pytest.raises(ValueError):
+            configure_logging({'format': 'xml'})
+    finally:
+        configure_logging()
+    assert not isinstance(_stream_handler.formatter, JsonFormatter)
+    assert not _queue_handler.filters
+
+
+def test_records_are_written_by_the_listener_thread():
+    threads = []
+
+    class Argument():
+
+        def __str__(self):
+            threads.append(threading.current_thread())
+            return 'argument'
+
+    # queued with its arguments, not formatted
+    record = make_record('value %s', Argument(), level=logging.WARNING)
+    assert _queue_handler.prepare(record) is record
+    assert not threads
+
+    stream = _stream_handler.setStream(io.StringIO())
+    try:
+        _queue_handler.handle(record)
+        # waits until the queue is processed
+        _listener.stop()
+        _listener.start()
+        written = _stream_handler.stream.getvalue()
+    finally:
+        _stream_handler.setStream(stream)
+    assert 'value argument' in written
+    assert threading.current_thread() not in threads
@@ -0,0 +1,56 @@
+import pytest
+import sys
+import os
+from unittest.mock import MagicMock
+
+# Add the parent directory to the sys.path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from message_filters import NameFilter, normalize
+
+
+def message(text):
+    msg = MagicMock()
+    msg.text = text
+    return msg
+
+
+@pytest.fixture
+def stations():
+    return NameFilter(['St. Gallen', 'Zürich', 'Biel/Bienne'])
+
+
+@pytest.mark.parametrize(
+    "text",
+    ['St. Gallen', 'st. gallen', ' St.  Gallen ', 'ZÜRICH', 'Biel/Bienne'])
+def test_filter_matches(stations, text):
+    assert stations.filter(message(text))
+
+
+@pytest.mark.parametrize("text",
+                         ['St- Gallen', 'StX Gallen', 'Zürich West', '', None])
+def test_filter_does_not_match(stations, text):
+    assert not stations.filter(message(text))
+
+
+def test_decomposed_unicode_matches(stations):
+    decomposed = 'Zu\u0308rich'
+    assert decomposed != 'Zürich'
+    assert stations.filter(message(decomposed))
+    assert stations.canonical(decomposed) == 'Zürich'
+
+
+def test_canonical(stations):
+    assert stations.canonical('st. gallen') == 'St. Gallen'
+    assert stations.canonical('Bern') is None
+    assert stations.canonical(None) is None
+
+
+def test_set_names(stations):
+    stations.set_names(['Bern'])
+    assert stations.filter(message('bern'))
+    assert not stations.filter(message('Zürich'))
+
+
+def test_normalize():
+    assert normalize('  Canton   Berne ') == 'canton berne'
@@ -0,0 +1,104 @@
+import asyncio
+import urllib.error
+import urllib.request
+import pytest
+import sys
+import os
+
+# Add the parent directory to the sys.path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from metrics import Registry, LagProbe, MetricsServer, event_loop_lag, timed
+
+
+@pytest.fixture
+def registry():
+    return Registry()
+
+
+def test_counter_render(registry):
+    counter = registry.counter('requests_total', 'Requests',
+                               ['endpoint', 'outcome'])
+    counter.inc(endpoint='schema', outcome='200')
+    counter.inc(2, endpoint='image', outcome='503')
+    assert counter.value(endpoint='image', outcome='503') == 2
+    assert registry.render() == ('# HELP requests_total Requests\n'
+                                 '# TYPE requests_total counter\n'
+                                 'requests_total{endpoint="image",'
+                                 'outcome="503"} 2\n'
+                                 'requests_total{endpoint="schema",'
+                                 'outcome="200"} 1\n')
+
+
+def test_labels_must_match(registry):
+    counter = registry.counter('requests_total', 'Requests', ['endpoint'])
+    with pytest.raises(ValueError):
+        counter.inc(outcome='200')
+    with pytest.raises(ValueError):
+        registry.counter('requests_total', 'Requests')
+
+
+def test_label_values_are_escaped(registry):
+    gauge = registry.gauge('stations', 'Stations', ['name'])
+    gauge.set(1, name='a "b"\\c')
+    assert 'stations{name="a \\"b\\"\\\\c"} 1' in registry.render()
+
+
+def test_gauge_function(registry):
+    gauge = registry.gauge('cached', 'Cached stations', ['base_time'])
+    gauge.set_function(lambda: {('2025-01-01T00:00:00Z', ): 3})
+    assert 'cached{base_time="2025-01-01T00:00:00Z"} 3' in registry.render()
+
+
+def test_histogram_buckets_are_cumulative(registry):
+    histogram = registry.histogram('latency_seconds',
+                                   'Latency', ['method'],
+                                   buckets=[0.1, 1])
+    for value in (0.05, 0.5, 5):
+        histogram.observe(value, method='get')
+    lines = registry.render().splitlines()
+    assert 'latency_seconds_bucket{method="get",le="0.1"} 1' in lines
+    assert 'latency_seconds_bucket{method="get",le="1"} 2' in lines
+    assert 'latency_seconds_bucket{method="get",le="+Inf"} 3' in lines
+    assert 'latency_seconds_sum{method="get"} 5.55' in lines
+    assert 'latency_seconds_count{method="get"} 3' in lines
+
+
+def test_timed(registry):
+    histogram = registry.histogram('query_seconds', 'Queries', ['method'])
+
+    @timed(histogram)
+    def get_subscriptions():
+        return ['Bern']
+
+    assert get_subscriptions() == ['Bern']
+    assert histogram.value(method='get_subscriptions') == 1
+
+
+def test_lag_probe(registry):
+    histogram = registry.histogram('lag_seconds', 'Lag', buckets=[0.5, 5])
+    now = [0.0]
+    probe = LagProbe(histogram, 1, clock=lambda: now[0])
+    for now[0] in (0.0, 1.0, 4.5, 5.0):
+        probe.tick()
+    # the run due at 2 is late by 2.5, the ones at 3 and 4 are skipped
+    assert histogram.value() == 4
+    assert 'lag_seconds_sum 2.5' in registry.render()
+
+
+def test_event_loop_lag():
+    assert 0 <= asyncio.run(event_loop_lag()) < 1
+
+
+def test_metrics_server(registry, free_port):
+    registry.counter('requests_total', 'Requests').inc()
+    server = MetricsServer(registry, '127.0.0.1', free_port).start()
+    try:
+        url = f'http://127.0.0.1:{free_port}'
+        with urllib.request.urlopen(url + '/metrics') as response:
+            assert response.headers['Content-Type'].startswith('text/plain')
+            assert b'requests_total 1' in response.read()
+        with pytest.raises(urllib.error.HTTPError):
+            urllib.request.urlopen(url + '/other')
+    finally:
+        server.stop()
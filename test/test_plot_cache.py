@@ -0,0 +1,94 @@
+import pytest
+import sys
+import os
+
+# Add the parent directory to the sys.path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from plot_cache import PlotCache
+
+
+@pytest.fixture
+def plot_files(tmp_path):
+    files = []
+    for i in range(3):
+        file = tmp_path / f'plot_{i}.png'
+        file.write_bytes(bytes([i]) * 10)
+        files.append(str(file))
+    return files
+
+
+def test_get_loads_file_once(plot_files):
+    cache = PlotCache()
+    data = cache.get(plot_files[0])
+    assert data == bytes([0]) * 10
+    assert plot_files[0] in cache
+    assert cache.size == 10
+
+    # same buffer is returned for every recipient
+    assert cache.get(plot_files[0]) is data
+
+
+def test_cache_is_bounded(plot_files):
+    cache = PlotCache(max_bytes=20)
+    for file in plot_files:
+        cache.get(file)
+    assert len(cache) == 2
+    assert cache.size == 20
+    assert plot_files[
+        0] not in cache, "least recently used plot should be evicted"
+
+
+def test_recently_used_plot_is_kept(plot_files):
+    cache = PlotCache(max_bytes=20)
+    cache.get(plot_files[0])
+    cache.get(plot_files[1])
+    cache.get(plot_files[0])
+    cache.get(plot_files[2])
+    assert plot_files[0] in cache
+    assert plot_files[1] not in cache
+
+
+def test_invalidate_reloads_from_disk(plot_files):
+    cache = PlotCache()
+    cache.get(plot_files[0])
+    with open(plot_files[0], 'wb') as file:
+        file.write(b'new')
+    cache.invalidate(plot_files[0])
+    assert cache.get(plot_files[0]) == b'new'
+    assert cache.size == 3
+
+
+def test_oversized_plot_is_not_cached(plot_files):
+    cache = PlotCache(max_bytes=5)
+    assert cache.get(plot_files[0]) == bytes([0]) * 10
+    assert len(cache) == 0
+
+
+def test_plot_replaced_during_read_is_not_kept(plot_files, monkeypatch):
+    import plot_cache
+
+    cache = PlotCache()
+    real_open = open
+
+    def open_and_replace(path, mode):
+        file = real_open(path, mode)
+        # the fetch thread replaces the plot while it is read
+        with real_open(f'{path}.part', 'wb') as new:
+            new.write(b'new')
+        os.replace(f'{path}.part', path)
+        cache.invalidate(path)
+        return file
+
+    monkeypatch.setattr(plot_cache, 'open', open_and_replace, raising=False)
+    assert cache.get(plot_files[0]) == bytes([0]) * 10
+    assert plot_files[0] not in cache
+    monkeypatch.undo()
+    assert cache.get(plot_files[0]) == b'new'
+
+
+def test_failed_read_is_not_kept(plot_files):
+    cache = PlotCache()
+    with pytest.raises(FileNotFoundError):
+        cache.get(plot_files[0] + '.missing')
+    assert len(cache) == 0
@@ -0,0 +1,59 @@
+import pytest
+import sys
+import os
+import zlib
+
+# Add the parent directory to the sys.path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from plot_optimizer import PlotOptimizer
+from pngfile import read_chunks, write_chunks
+from test_pngfile import make_png
+
+
+@pytest.fixture
+def optimizer():
+    optimizer = PlotOptimizer(workers=2)
+    yield optimizer
+    optimizer.close()
+
+
+def uncompressed_png(width=64, height=64):
+    chunks = read_chunks(make_png(width, height))
+    idat = zlib.compress(zlib.decompress(chunks[1][1]), 0)
+    return write_chunks([chunks[0], (b'IDAT', idat), chunks[2]])
+
+
+def test_optimize(optimizer, tmp_path):
+    files = []
+    for i in range(4):
+        files.append(tmp_path / f'plot_{i}.png')
+        files[-1].write_bytes(uncompressed_png())
+    size = len(uncompressed_png())
+
+    saved = optimizer.optimize([str(file) for file in files])
+    assert saved > 0
+    assert optimizer.bytes_saved == saved
+    assert optimizer.bytes_before == 4 * size
+    for file in files:
+        assert len(file.read_bytes()) == size - saved // 4
+
+
+def test_optimize_keeps_invalid_file(optimizer, tmp_path):
+    html = tmp_path / 'error.png'
+    html.write_bytes(b'<html>error</html>')
+    png = tmp_path / 'plot.png'
+    png.write_bytes(uncompressed_png())
+
+    assert optimizer.optimize([str(html), str(png)]) > 0
+    assert html.read_bytes() == b'<html>error</html>'
+    assert optimizer.optimize([]) == 0
+
+
+def test_from_config():
+    assert PlotOptimizer.from_config(None) is None
+    assert PlotOptimizer.from_config({}) is None
+    with pytest.raises(ValueError):
+        PlotOptimizer.from_config({'level': 10})
+    with pytest.raises(ValueError):
+        PlotOptimizer.from_config({'workers': 0})
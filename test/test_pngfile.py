@@ -0,0 +1,95 @@
+import pytest
+import struct
+import sys
+import os
+import zlib
+
+# Add the parent directory to the sys.path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from pngfile import (PNG_SIGNATURE, read_chunks, validate_png, write_chunks,
+                     optimize_png, optimize_png_file)
+
+
+def chunk(chunk_type, data):
+    return struct.pack('>I', len(data)) + chunk_type + data + struct.pack(
+        '>I', zlib.crc32(chunk_type + data))
+
+
+def make_png(width=2, height=2):
+    ihdr = struct.pack('>IIBBBBB', width, height, 8, 0, 0, 0, 0)
+    raw = b''.join(b'\x00' + b'\xff' * width for _ in range(height))
+    return (PNG_SIGNATURE + chunk(b'IHDR', ihdr) +
+            chunk(b'IDAT', zlib.compress(raw)) + chunk(b'IEND', b''))
+
+
+def test_read_chunks():
+    chunks = read_chunks(make_png())
+    assert [chunk_type
+            for chunk_type, _ in chunks] == [b'IHDR', b'IDAT', b'IEND']
+
+
+def test_validate_png(tmp_path):
+    file = tmp_path / 'plot.png'
+    file.write_bytes(make_png())
+    validate_png(str(file))
+
+
+@pytest.mark.parametrize("data", [
+    b'<html><body>502 Bad Gateway</body></html>',
+    make_png()[:-20],
+    make_png()[:-12],
+    b'',
+])
+def test_validate_png_rejects(tmp_path, data):
+    file = tmp_path / 'plot.png'
+    file.write_bytes(data)
+    with pytest.raises(ValueError):
+        validate_png(str(file))
+
+
+def image_data(data):
+    return zlib.decompress(b''.join(
+        chunk_data for chunk_type, chunk_data in read_chunks(data)
+        if chunk_type == b'IDAT'))
+
+
+def test_optimize_png_is_lossless():
+    png = make_png(64, 64)
+    chunks = read_chunks(png)
+    raw = zlib.decompress(chunks[1][1])
+    # stored without compression, split in two chunks, with metadata
+    idat = zlib.compress(raw, 0)
+    png = write_chunks([
+        chunks[0], (b'tEXt', b'Title\x00plot'), (b'IDAT', idat[:50]),
+        (b'IDAT', idat[50:]), chunks[2]
+    ])
+
+    optimized = optimize_png(png)
+    assert len(optimized) < len(png)
+    assert image_data(optimized) == raw
+    assert [chunk_type for chunk_type, _ in read_chunks(optimized)
+            ] == [b'IHDR', b'IDAT', b'IEND']
+    assert b'tEXt' in [
+        chunk_type for chunk_type, _ in read_chunks(
+            optimize_png(png, strip_metadata=False))
+    ]
+
+
+def test_optimize_png_keeps_smaller_original():
+    png = make_png(64, 64)
+    assert optimize_png(png, level=0) is png
+
+
+def test_optimize_png_file(tmp_path):
+    file = tmp_path / 'plot.png'
+    png = make_png(64, 64)
+    chunks = read_chunks(png)
+    file.write_bytes(
+        write_chunks([chunks[0], (b'tEXt', b'Title\x00plot')] + chunks[1:]))
+
+    before, after = optimize_png_file(str(file))
+    assert after < before
+    assert len(file.read_bytes()) == after
+    assert image_data(file.read_bytes()) == image_data(png)
+    assert sorted(os.listdir(tmp_path)) == ['plot.png']
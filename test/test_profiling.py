@@ -0,0 +1,76 @@
+import asyncio
+import threading
+import time
+import pytest
+import sys
+import os
+
+# Add the parent directory to the sys.path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from profiling import Sampler, CallbackStats, format_summary
+
+
+def busy_loop(stop):
+    while not stop.is_set():
+        sum(range(1000))
+
+
+def test_sampler_finds_busy_thread(tmp_path):
+    stop = threading.Event()
+    worker = threading.Thread(target=busy_loop, args=(stop, ))
+    worker.start()
+    sampler = Sampler(interval=0.001).start()
+    time.sleep(0.2)
+    sampler.stop()
+    stop.set()
+    worker.join()
+
+    hot = {label: total for label, _, total in sampler.hot_functions(50)}
+    assert hot['test_profiling.py:busy_loop'] > 0
+
+    path = tmp_path / 'profile.txt'
+    sampler.write(path)
+    line = next(line for line in path.read_text().splitlines()
+                if 'busy_loop' in line)
+    stack, count = line.rsplit(' ', 1)
+    assert stack.split(';')[-1].startswith('test_profiling.py:busy_loop')
+    assert int(count) > 0
+
+
+def test_callback_stats():
+    stats = CallbackStats()
+
+    async def handler(update, context):
+        await asyncio.sleep(0.01)
+        return 'state'
+
+    timed = stats.wrap(handler, 'handler')
+    assert timed.__name__ == 'handler'
+    snapshot = stats.snapshot()
+    assert asyncio.run(timed(None, None)) == 'state'
+    assert asyncio.run(timed(None, None)) == 'state'
+
+    (name, calls, wall, cpu), = stats.since(snapshot)
+    assert (name, calls) == ('handler', 2)
+    assert wall >= 0.02
+    assert 0 <= cpu < wall
+    assert stats.since(stats.snapshot()) == []
+
+
+def test_callback_stats_records_failures():
+    stats = CallbackStats()
+
+    async def failing(context):
+        raise ValueError('boom')
+
+    with pytest.raises(ValueError):
+        asyncio.run(stats.wrap(failing, 'failing')(None))
+    assert stats.since({})[0][:2] == ('failing', 1)
+
+
+def test_format_summary_without_samples():
+    sampler = Sampler()
+    summary = format_summary(sampler, [('_deliver', 3, 1.5, 0.5)])
+    assert '0 samples' in summary
+    assert '_deliver' in summary
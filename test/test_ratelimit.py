@@ -0,0 +1,98 @@
+import pytest
+import sys
+import os
+
+# Add the parent directory to the sys.path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from ratelimit import TokenBucket, ChatRateLimiter
+
+
+class FakeClock():
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+def test_burst_is_not_throttled(clock):
+    bucket = TokenBucket(rate=1, capacity=5, clock=clock, sleep=clock.sleep)
+    for _ in range(5):
+        assert bucket.acquire() == 0
+    assert clock.now == 0
+    assert bucket.stats()['throttled'] == 0
+
+
+def test_sustained_rate_after_burst(clock):
+    bucket = TokenBucket(rate=2, capacity=2, clock=clock, sleep=clock.sleep)
+    for _ in range(6):
+        bucket.acquire()
+    # 2 from the burst, remaining 4 at 2 requests per second
+    assert clock.now == pytest.approx(2.0)
+    stats = bucket.stats()
+    assert stats['acquired'] == 6
+    assert stats['throttled'] == 4
+    assert stats['max_wait'] == pytest.approx(0.5)
+    assert stats['total_wait'] == pytest.approx(2.0)
+
+
+def test_tokens_refill_over_time(clock):
+    bucket = TokenBucket(rate=1, capacity=2, clock=clock, sleep=clock.sleep)
+    bucket.acquire()
+    bucket.acquire()
+    clock.sleep(10)
+    # refill is capped at the capacity
+    assert bucket.acquire() == 0
+    assert bucket.acquire() == 0
+    assert bucket.acquire() == pytest.approx(1.0)
+
+
+def test_try_acquire_does_not_block(clock):
+    bucket = TokenBucket(rate=1, capacity=1, clock=clock, sleep=clock.sleep)
+    assert bucket.try_acquire()
+    assert not bucket.try_acquire()
+    assert clock.now == 0
+    clock.sleep(1)
+    assert bucket.try_acquire()
+
+
+def test_from_config_defaults():
+    bucket = TokenBucket.from_config(None, default_rate=3, default_burst=4)
+    assert bucket.rate == 3
+    assert bucket.capacity == 4
+    bucket = TokenBucket.from_config({'rate': 7}, 3, 4)
+    assert bucket.rate == 7
+    assert bucket.capacity == 4
+
+
+def test_chat_rate_limiter(clock):
+    limiter = ChatRateLimiter(rate=0.5, burst=2, max_chats=2, clock=clock)
+    assert limiter.try_acquire(1)
+    assert limiter.try_acquire(1)
+    assert not limiter.try_acquire(1)
+    assert limiter.try_acquire(2), "chats have their own budget"
+    clock.now = 2
+    assert limiter.try_acquire(1)
+    assert not limiter.try_acquire(1)
+
+
+def test_chat_rate_limiter_forgets_idle_chats(clock):
+    limiter = ChatRateLimiter(rate=0.5, burst=1, max_chats=2, clock=clock)
+    assert limiter.try_acquire(1)
+    assert limiter.try_acquire(2)
+    assert not limiter.try_acquire(1)
+    # 1 was active last, 2 makes room for 3
+    assert limiter.try_acquire(3)
+    assert len(limiter) == 2
+    assert not limiter.try_acquire(1)
+    assert limiter.try_acquire(2), "starts again with a full bucket"
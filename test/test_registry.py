@@ -0,0 +1,144 @@
+import pytest
+import sys
+import os
+import yaml
+
+# Add the parent directory to the sys.path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from registry import StationRegistry, StationFileWatcher, load_station_config
+
+
+@pytest.fixture
+def station_config():
+    stations = """
+- name: Zürich
+  region: Zurich
+  lat: 47.3667
+  lon: 8.55
+
+- name: Winterthur
+  region: Zurich
+  lat: 47.5056
+  lon: 8.72413
+
+- name: Basel
+  region: Basilea
+  lat: 47.5584
+  lon: 7.57327
+    """
+    return yaml.safe_load(stations)
+
+
+@pytest.fixture
+def registry(station_config):
+    return StationRegistry.from_config(station_config)
+
+
+def test_names_and_regions_are_sorted(registry):
+    assert registry.names == ['Basel', 'Winterthur', 'Zürich']
+    assert registry.regions == ['Basilea', 'Zurich']
+
+
+def test_iteration_keeps_config_order(registry):
+    assert [S.name for S in registry] == ['Zürich', 'Winterthur', 'Basel']
+    assert len(registry) == 3
+
+
+def test_lookup_by_name(registry):
+    assert registry.get('Basel').region == 'Basilea'
+    assert registry.get('Bern') is None
+    assert 'Basel' in registry
+    assert 'Bern' not in registry
+    assert registry.region_of('Zürich') == 'Zurich'
+
+
+def test_names_for_region(registry):
+    assert registry.names_for_region('Zurich') == ['Winterthur', 'Zürich']
+    assert registry.names_for_region('Ticino') == []
+
+
+def test_select(registry):
+    selected = registry.select(['Basel', 'Bern', 'Zürich', 'Basel'])
+    assert [S.name for S in selected] == ['Basel', 'Zürich']
+
+
+def test_version(registry, station_config):
+    assert registry.version == StationRegistry.from_config(
+        station_config).version
+    # a move keeps the lists
+    moved = [
+        dict(station, lat=station['lat'] + 1) for station in station_config
+    ]
+    assert StationRegistry.from_config(moved).version == registry.version
+    assert StationRegistry.from_config(
+        station_config[1:]).version != registry.version
+
+
+def test_registry_of_all_stations():
+    with open('stations.yaml', 'r') as file:
+        station_config = yaml.safe_load(file)
+    registry = StationRegistry.from_config(station_config)
+    assert len(registry) == len(station_config), "station names must be unique"
+
+
+def test_nearest(registry):
+    distance, Station = registry.nearest(47.5, 8.7)[0]
+    assert Station.name == 'Winterthur'
+    assert distance < 2
+    assert [S.name for _, S in registry.nearest(47.5, 8.7, k=2)
+            ] == ['Winterthur', 'Zürich']
+    assert registry.nearest(40.0, 8.7, max_distance=50) == []
+
+
+def test_diff(registry, station_config):
+    station_config = [dict(station) for station in station_config]
+    # Winterthur moves region, Basel moves, Zürich is removed, Bern is new
+    station_config[1]['region'] = 'Winterthur'
+    station_config[2]['lat'] = 47.56
+    station_config[0] = {
+        'name': 'Bern',
+        'region': 'Bern',
+        'lat': 46.95,
+        'lon': 7.45
+    }
+    added, removed, changed = registry.diff(
+        StationRegistry.from_config(station_config))
+    assert added == ['Bern']
+    assert removed == ['Zürich']
+    assert changed == ['Basel', 'Winterthur']
+    assert registry.diff(registry) == ([], [], [])
+
+
+def test_load_station_config(tmp_path, station_config):
+    file = tmp_path / 'stations.yaml'
+    file.write_text(yaml.dump(station_config))
+    assert load_station_config(str(file)) == station_config
+
+
+@pytest.mark.parametrize('content', [
+    '- name: [unclosed',
+    '',
+    '- name: Bern',
+    '- {name: Bern, region: Bern, lat: 1, lon: 2}\n'
+    '- {name: Bern, region: Bern, lat: 3, lon: 4}',
+])
+def test_load_station_config_rejects(tmp_path, content):
+    file = tmp_path / 'stations.yaml'
+    file.write_text(content)
+    with pytest.raises(ValueError):
+        load_station_config(str(file))
+
+
+def test_station_file_watcher(tmp_path):
+    file = tmp_path / 'stations.yaml'
+    file.write_text('- a')
+    watcher = StationFileWatcher(str(file))
+    assert not watcher.changed()
+
+    file.write_text('- a\n- b')
+    assert watcher.changed()
+    assert not watcher.changed()
+
+    file.unlink()
+    assert not watcher.changed()
@@ -0,0 +1,167 @@
+import pytest
+import sys
+import os
+
+# Add the parent directory to the sys.path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from resilience import (RetryPolicy, CircuitBreaker, RetryableError,
+                        CircuitOpenError)
+
+
+class FakeClock():
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+def failing(times, error=RetryableError):
+    calls = []
+
+    def func():
+        calls.append(1)
+        if len(calls) <= times:
+            raise error('failure {}'.format(len(calls)))
+        return 'ok'
+
+    return func, calls
+
+
+def test_retry_until_success(clock):
+    policy = RetryPolicy(tries=5, sleep=clock.sleep, clock=clock)
+    func, calls = failing(3)
+    assert policy.call(func) == 'ok'
+    assert len(calls) == 4
+
+
+def test_retry_gives_up_after_tries(clock):
+    policy = RetryPolicy(tries=3, sleep=clock.sleep, clock=clock)
+    func, calls = failing(10)
+    with pytest.raises(RetryableError):
+        policy.call(func)
+    assert len(calls) == 3
+
+
+def test_no_retry_for_permanent_errors(clock):
+    policy = RetryPolicy(tries=5, sleep=clock.sleep, clock=clock)
+    func, calls = failing(1, error=ValueError)
+    with pytest.raises(ValueError):
+        policy.call(func)
+    assert len(calls) == 1
+
+
+def test_retry_respects_deadline(clock):
+    policy = RetryPolicy(tries=100,
+                         base_delay=1,
+                         max_delay=4,
+                         deadline=10,
+                         jitter=False,
+                         sleep=clock.sleep,
+                         clock=clock)
+    func, calls = failing(100)
+    with pytest.raises(RetryableError):
+        policy.call(func)
+    assert clock.now <= 10
+    # delays 1, 2, 4 -> 7s, the next delay of 4s would pass the deadline
+    assert len(calls) == 4
+
+
+def test_timeout_is_capped_at_deadline(clock):
+    policy = RetryPolicy(tries=100,
+                         base_delay=1,
+                         max_delay=4,
+                         deadline=7,
+                         jitter=False,
+                         sleep=clock.sleep,
+                         clock=clock)
+    timeouts = []
+
+    def func(timeout):
+        timeouts.append(timeout)
+        # every attempt runs into its timeout
+        clock.now += timeout
+        raise RetryableError('timeout')
+
+    with pytest.raises(RetryableError):
+        policy.call(func, timeout=4)
+    # 4s attempt and 1s delay, 2s left for the second attempt
+    assert timeouts == [4, 2]
+    assert clock.now == 7
+
+
+def test_backoff_is_exponential_and_capped():
+    policy = RetryPolicy(base_delay=0.5, max_delay=3, jitter=False)
+    assert [policy.backoff(i) for i in range(5)] == [0.5, 1, 2, 3, 3]
+
+
+def test_backoff_jitter_stays_below_cap():
+    policy = RetryPolicy(base_delay=0.5, max_delay=3, jitter=True)
+    for attempt in range(10):
+        assert 0 <= policy.backoff(attempt) <= 3
+
+
+def test_retryable_status_codes():
+    policy = RetryPolicy.from_config({'retryable_status_codes': [503]})
+    assert policy.is_retryable_status(503)
+    assert not policy.is_retryable_status(404)
+
+
+def test_circuit_opens_after_threshold(clock):
+    breaker = CircuitBreaker(failure_threshold=2,
+                             reset_timeout=30,
+                             clock=clock)
+    breaker.before_call('host')
+    breaker.record_failure('host')
+    assert not breaker.is_open
+    breaker.record_failure('host')
+    assert breaker.is_open
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call('host')
+
+
+def test_circuit_half_open_probe(clock):
+    breaker = CircuitBreaker(failure_threshold=1,
+                             reset_timeout=30,
+                             clock=clock)
+    breaker.record_failure('host')
+    clock.sleep(31)
+
+    # one probe is let through, concurrent calls are still short-circuited
+    breaker.before_call('host')
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call('host')
+
+    breaker.record_success()
+    assert not breaker.is_open
+    breaker.before_call('host')
+
+
+def test_circuit_failed_probe_reopens(clock):
+    breaker = CircuitBreaker(failure_threshold=1,
+                             reset_timeout=30,
+                             clock=clock)
+    breaker.record_failure('host')
+    clock.sleep(31)
+    breaker.before_call('host')
+    breaker.record_failure('host')
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call('host')
+
+
+def test_circuit_open_error_is_not_retried(clock):
+    policy = RetryPolicy(tries=5, sleep=clock.sleep, clock=clock)
+    func, calls = failing(1, error=CircuitOpenError)
+    with pytest.raises(CircuitOpenError):
+        policy.call(func)
+    assert len(calls) == 1
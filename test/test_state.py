@@ -0,0 +1,59 @@
+import pytest
+import sys
+import os
+import threading
+
+# Add the parent directory to the sys.path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from state import StateStore
+
+
+def test_load_missing_file(tmp_path):
+    store = StateStore(str(tmp_path / 'state.json'))
+    assert store.load() == {}
+
+
+def test_save_and_load(tmp_path):
+    path = str(tmp_path / 'state.json')
+    state = {'stations': {'Bern': {'base_time': '2025-01-01T00:00:00Z'}}}
+    assert StateStore(path).save(state)
+    assert StateStore(path).load() == state
+    assert os.listdir(tmp_path) == ['state.json']
+
+
+def test_unchanged_state_is_not_written(tmp_path):
+    store = StateStore(str(tmp_path / 'state.json'))
+    assert store.save({'a': 1})
+    assert not store.save({'a': 1})
+    assert store.save({'a': 2})
+
+
+def test_load_corrupt_file(tmp_path):
+    path = tmp_path / 'state.json'
+    path.write_text('{"stations": ')
+    assert StateStore(str(path)).load() == {}
+
+
+def test_concurrent_saves(tmp_path):
+    path = str(tmp_path / 'state.json')
+    store = StateStore(path)
+    errors = []
+
+    def save(value):
+        try:
+            for i in range(50):
+                store.save({'writer': value, 'i': i})
+        except OSError as e:
+            errors.append(e)
+
+    threads = [
+        threading.Thread(target=save, args=(value, )) for value in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert StateStore(path).load()['i'] == 49
+    assert os.listdir(tmp_path) == ['state.json']
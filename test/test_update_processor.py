@@ -0,0 +1,72 @@
+import asyncio
+import pytest
+import sys
+import os
+from types import SimpleNamespace
+
+# Add the parent directory to the sys.path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from update_processor import ChatUpdateProcessor
+
+
+def update(chat_id):
+    chat = SimpleNamespace(id=chat_id) if chat_id is not None else None
+    return SimpleNamespace(effective_chat=chat)
+
+
+async def handle(log, name, delay):
+    log.append(('start', name))
+    await asyncio.sleep(delay)
+    log.append(('end', name))
+
+
+def run_updates(processor, updates):
+
+    async def run():
+        log = []
+        async with processor:
+            await asyncio.gather(*(processor.process_update(
+                update(chat_id), handle(log, name, delay))
+                                   for chat_id, name, delay in updates))
+        return log
+
+    return asyncio.run(run())
+
+
+def test_updates_of_a_chat_are_handled_in_order():
+    processor = ChatUpdateProcessor(4)
+    log = run_updates(processor, [(1, 'a', 0.05), (1, 'b', 0.0),
+                                  (1, 'c', 0.0)])
+    assert log == [('start', 'a'), ('end', 'a'), ('start', 'b'), ('end', 'b'),
+                   ('start', 'c'), ('end', 'c')]
+    assert processor.active_chats == 0
+
+
+def test_chats_are_handled_concurrently():
+    log = run_updates(ChatUpdateProcessor(4), [(1, 'a', 0.05), (2, 'b', 0.0),
+                                               (None, 'c', 0.0)])
+    # neither the other chat nor an update without chat waits for a
+    assert log.index(('end', 'b')) < log.index(('end', 'a'))
+    assert log.index(('end', 'c')) < log.index(('end', 'a'))
+
+
+def test_busy_chat_does_not_block_other_chats():
+    processor = ChatUpdateProcessor(2)
+    log = run_updates(processor, [(1, 'a0', 0.1), (1, 'a1', 0.1),
+                                  (1, 'a2', 0.1), (2, 'b', 0.0)])
+    # the updates of chat 1 waiting for their turn take no slot
+    assert log.index(('end', 'b')) < log.index(('end', 'a0'))
+    assert processor.max_concurrent_updates == 2
+    assert processor.current_concurrent_updates == 0
+
+
+def test_concurrent_updates_are_limited():
+    processor = ChatUpdateProcessor(1)
+    log = run_updates(processor, [(1, 'a', 0.05), (2, 'b', 0.0)])
+    assert log == [('start', 'a'), ('end', 'a'), ('start', 'b'), ('end', 'b')]
+
+
+def test_max_concurrent_updates_must_be_positive():
+    with pytest.raises(ValueError):
+        ChatUpdateProcessor(0)
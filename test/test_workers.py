@@ -0,0 +1,229 @@
+import json
+import sys
+import os
+from unittest.mock import MagicMock
+
+import pytest
+
+# Add the parent directory to the sys.path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from ipc import Channel, FETCHER_SOCKET, FRONTEND_SOCKET
+from workers import Fetcher, PlotStore, queue_broadcast
+from constants import ALL_EPSGRAM
+
+
+@pytest.fixture
+def channels(tmp_path):
+    with Channel(str(tmp_path), FETCHER_SOCKET) as fetcher, Channel(
+            str(tmp_path), FRONTEND_SOCKET) as frontend:
+        yield fetcher, frontend
+
+
+def write_state(path, stations, base_time='run', images=None):
+    with open(path, 'w') as file:
+        json.dump(
+            {
+                'base_time': base_time,
+                'stations': stations,
+                'images': images or {}
+            }, file)
+
+
+def station_state(base_time='run', plots_cached=False, cached_products=()):
+    return {
+        'base_time': base_time,
+        'plots_cached': plots_cached,
+        'has_been_broadcasted': True,
+        'cached_products': list(cached_products),
+    }
+
+
+def test_queue_broadcast():
+    ecmwf = MagicMock()
+    ecmwf.download_latest_plots.return_value = {'Basel': ['plot'], 'Bern': []}
+    ecmwf.station_base_time.return_value = 'run'
+    db = MagicMock()
+    db.get_demanded_products.return_value = {'Basel': None, 'Bern': None}
+    db.get_products_by_station.return_value = {1: None}
+
+    assert queue_broadcast(ecmwf, db) == ['Basel']
+    db.enqueue_deliveries.assert_called_once_with([(1, 'Basel', 'run', None)])
+    ecmwf.mark_broadcasted.assert_called_once_with(['Basel'])
+
+
+def test_queue_broadcast_keeps_stations_pending_on_db_error():
+    ecmwf = MagicMock()
+    ecmwf.download_latest_plots.return_value = {'Basel': ['plot']}
+    ecmwf.station_base_time.return_value = 'run'
+    db = MagicMock()
+    db.get_demanded_products.return_value = {'Basel': None}
+    db.get_products_by_station.return_value = {1: None}
+    db.enqueue_deliveries.side_effect = RuntimeError('database is down')
+
+    assert queue_broadcast(ecmwf, db) == []
+    ecmwf.mark_broadcasted.assert_not_called()
+
+
+def test_plot_store_answers_from_state_file(tmp_path, channels):
+    fetcher, frontend = channels
+    state_file = str(tmp_path / 'state.json')
+    write_state(
+        state_file, {
+            'Basel': station_state(plots_cached=True),
+            'Bern': station_state(cached_products=['classical_plume']),
+        })
+    store = PlotStore(state_file, frontend)
+
+    assert store.station_base_time('Basel') == 'run'
+    assert store.station_base_time('Unknown') is None
+    assert not store.broadcast_pending('Basel')
+    assert not store.broadcast_pending('Unknown')
+    assert store.download_plots(['Basel']) == {
+        'Basel': [f'./Basel_{i}.png' for i in ALL_EPSGRAM]
+    }
+    assert store.download_plots(['Bern'], {'Bern': ['classical_plume']}) == {
+        'Bern': ['./Bern_classical_plume.png']
+    }
+    assert fetcher.receive() == []
+
+    # missing plots are requested from the fetcher
+    assert store.download_plots(['Bern']) == {}
+    assert fetcher.receive(timeout=1) == [{
+        'type': 'fetch',
+        'station': 'Bern',
+        'products': None
+    }]
+
+
+def test_plot_store_invalidates_changed_plots(tmp_path, channels):
+    _, frontend = channels
+    state_file = str(tmp_path / 'state.json')
+    stations = {
+        'Basel': station_state(plots_cached=True),
+        'Bern': station_state(plots_cached=True),
+    }
+    write_state(state_file, stations)
+    store = PlotStore(state_file, frontend)
+    assert store.station_base_time('Bern') == 'run'
+    plots = [f'./{name}_{i}.png' for name in stations for i in ALL_EPSGRAM]
+    for plot in plots:
+        store.plot_cache.put(plot, b'png')
+
+    stations['Bern'] = station_state(base_time='next', plots_cached=True)
+    write_state(state_file, stations)
+    os.utime(state_file, ns=(0, 0))
+    assert store.station_base_time('Bern') == 'next'
+    # only the plots of the new run are read again
+    assert [plot in store.plot_cache for plot in plots
+            ] == [True] * len(ALL_EPSGRAM) + [False] * len(ALL_EPSGRAM)
+
+    # fetched again for the same run
+    write_state(state_file,
+                stations,
+                images={plots[0]: {
+                            'sha256': 'abc',
+                            'signature': [3, 1]
+                        }})
+    os.utime(state_file, ns=(1, 1))
+    store.station_base_time('Basel')
+    assert plots[0] not in store.plot_cache
+    assert plots[1] in store.plot_cache
+
+
+def test_fetcher_serves_requests(channels):
+    fetcher_channel, frontend = channels
+    ecmwf = MagicMock()
+    ecmwf.download_plots.return_value = {'Basel': ['./Basel_plume.png']}
+    db = MagicMock()
+    fetcher = Fetcher(ecmwf, db, fetcher_channel, clock=lambda: 0)
+
+    for _ in range(2):
+        frontend.send(FETCHER_SOCKET, {
+            'type': 'fetch',
+            'station': 'Basel',
+            'products': None
+        })
+    fetcher._handle(fetcher_channel.receive(timeout=1))
+
+    # repeated requests are fetched once
+    ecmwf.download_plots.assert_called_once_with(['Basel'], {'Basel': None})
+    db.reschedule_deliveries.assert_called_once_with('Basel')
+    assert frontend.receive(timeout=1) == [{
+        'type': 'ready',
+        'station': 'Basel'
+    }]
+
+
+def test_point_request_round_trip(tmp_path, channels):
+    fetcher_channel, frontend = channels
+    state_file = str(tmp_path / 'state.json')
+    write_state(state_file, {})
+    store = PlotStore(state_file, frontend)
+    ecmwf = MagicMock()
+    ecmwf.snap_point.side_effect = store.snap_point
+    ecmwf.base_time = 'run'
+    ecmwf.download_plots_for_point.return_value = ('46.50N 8.00E',
+                                                   ['./46.50N 8.00E_a.png'])
+    fetcher = Fetcher(ecmwf, MagicMock(), fetcher_channel, clock=lambda: 0)
+
+    assert store.download_plots_for_point(46.52,
+                                          7.98) == ('46.50N 8.00E', None)
+    fetcher._handle(fetcher_channel.receive(timeout=1))
+    assert store.poll() is True
+    assert store.download_plots_for_point(46.52,
+                                          7.98) == ('46.50N 8.00E',
+                                                    ['./46.50N 8.00E_a.png'])
+
+
+def test_fetcher_runs_periodic_tasks(channels):
+    fetcher_channel, _ = channels
+    now = [0]
+    ecmwf = MagicMock()
+    db = MagicMock()
+    db.get_demanded_products.return_value = {}
+    ecmwf.download_latest_plots.return_value = {}
+    fetcher = Fetcher(ecmwf, db, fetcher_channel, clock=lambda: now[0])
+
+    fetcher.run_once()
+    ecmwf.cache_plots.assert_called_once_with({})
+    ecmwf.upgrade_basetime_global.assert_not_called()
+
+    now[0] = 120
+    fetcher.run_once()
+    ecmwf.upgrade_basetime_global.assert_called_once()
+    assert ecmwf.cache_plots.call_count == 2
+
+
+def test_fetcher_reloads_stations(channels, tmp_path):
+    fetcher_channel, _ = channels
+    stations_file = tmp_path / 'stations.yaml'
+    stations_file.write_text('- {name: Bern, region: Bern, lat: 1, lon: 2}')
+    now = [0]
+    ecmwf = MagicMock()
+    ecmwf.reload_stations.return_value = (['Thun'], [], [])
+    db = MagicMock()
+    db.get_demanded_products.return_value = {}
+    ecmwf.download_latest_plots.return_value = {}
+    fetcher = Fetcher(ecmwf,
+                      db,
+                      fetcher_channel,
+                      clock=lambda: now[0],
+                      stations_file=str(stations_file))
+
+    fetcher.run_once()
+    ecmwf.reload_stations.assert_not_called()
+
+    stations_file.write_text('- {name: Bern, region: Bern, lat: 1, lon: 2}\n'
+                             '- {name: Thun, region: Bern, lat: 3, lon: 4}')
+    now[0] = 10
+    fetcher.run_once()
+    assert [
+        station['name'] for station in ecmwf.reload_stations.call_args.args[0]
+    ] == ['Bern', 'Thun']
+
+    # a broken file keeps the stations
+    stations_file.write_text('- name: [')
+    now[0] = 20
+    fetcher.run_once()
+    assert ecmwf.reload_stations.call_count == 1
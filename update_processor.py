@@ -0,0 +1,76 @@
+import asyncio
+import sys
+
+from telegram.ext import BaseUpdateProcessor
+
+
+class ChatUpdateProcessor(BaseUpdateProcessor):
+    """Handles the updates of different chats concurrently and the updates of
+    one chat one after the other, in the order they arrived.
+
+    A ConversationHandler stores the next state of a chat only once the
+    handler returned, the next update of the chat must not overtake it.
+    Updates without a chat are not held back.
+    """
+
+    _limit = sys.maxsize
+
+    def __init__(self, max_concurrent_updates):
+        if max_concurrent_updates < 1:
+            raise ValueError(
+                'Number of concurrent updates must be positive, got {}'.format(
+                    max_concurrent_updates))
+        # PTB takes its semaphore before do_process_update, updates waiting
+        # for their chat would hold its slots and block all other chats.
+        # The limit is taken once it is the turn of the chat instead. PTB
+        # sizes its semaphore by max_concurrent_updates, which is the
+        # unlimited class default until the limit is set below
+        super().__init__(sys.maxsize)
+        self._limit = max_concurrent_updates
+        self._running = asyncio.Semaphore(max_concurrent_updates)
+        self._current = 0
+        # chat_id -> [lock, updates holding or waiting for it]
+        self._chats = {}
+
+    @property
+    def max_concurrent_updates(self) -> int:
+        return self._limit
+
+    @property
+    def current_concurrent_updates(self) -> int:
+        return self._current
+
+    async def do_process_update(self, update, coroutine):
+        chat = getattr(update, 'effective_chat', None)
+        if chat is None:
+            await self._run(coroutine)
+            return
+        # asyncio.Lock wakes up its waiters first come, first served
+        entry = self._chats.setdefault(chat.id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await self._run(coroutine)
+        finally:
+            entry[1] -= 1
+            # idle chats must not pile up
+            if entry[1] == 0:
+                self._chats.pop(chat.id, None)
+
+    async def _run(self, coroutine):
+        async with self._running:
+            self._current += 1
+            try:
+                await coroutine
+            finally:
+                self._current -= 1
+
+    @property
+    def active_chats(self) -> int:
+        return len(self._chats)
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
@@ -0,0 +1,300 @@
+import os
+import time
+
+from adhoc import AdHocLocations
+from constants import EPSGRAM_LABELS, STATIONS_WATCH_INTERVAL
+from ipc import FETCHER_SOCKET, FRONTEND_SOCKET
+from location import plot_path
+from logger_config import logger
+from metrics import BROADCAST_SECONDS, JOB_LAG_SECONDS
+from plot_cache import PlotCache
+from registry import StationFileWatcher, load_station_config
+from state import StateStore
+
+
+def queue_broadcast(ecmwf, db):
+    with BROADCAST_SECONDS.time():
+        return _queue_broadcast(ecmwf, db)
+
+
+def _queue_broadcast(ecmwf, db):
+    # only fetch the products somebody subscribed for
+    demanded_products = db.get_demanded_products()
+    latest_plots = ecmwf.download_latest_plots(list(demanded_products),
+                                               demanded_products)
+    deliveries = []
+    broadcasted = []
+    for station_name, plots in latest_plots.items():
+        if len(plots) == 0:
+            continue
+        base_time = ecmwf.station_base_time(station_name)
+        subscribers = db.get_products_by_station(station_name)
+        deliveries.extend((user_id, station_name, base_time, products)
+                          for user_id, products in subscribers.items())
+        broadcasted.append(station_name)
+        logger.info('Queued broadcast of %s to %d chats',
+                    station_name,
+                    len(subscribers),
+                    extra={
+                        'station': station_name,
+                        'base_time': base_time
+                    })
+    try:
+        db.enqueue_deliveries(deliveries)
+    except Exception as e:
+        # the stations stay pending, queued again with the next broadcast
+        logger.error('Could not queue broadcast of %s: %s',
+                     ', '.join(broadcasted), e)
+        return []
+    if broadcasted:
+        ecmwf.mark_broadcasted(broadcasted)
+    return broadcasted
+
+
+class Fetcher():
+    """Worker owning EcmwfApi: run detection, caching and broadcasts.
+
+    Runs the same periodic tasks as the bot does in a single process and
+    fetches plots the front-end asks for over the channel.
+    """
+
+    def __init__(self,
+                 ecmwf,
+                 db,
+                 channel,
+                 clock=time.monotonic,
+                 stations_file=None):
+        self._ecmwf = ecmwf
+        self._db = db
+        self._channel = channel
+        self._clock = clock
+        now = clock()
+        # [next run, interval, task], same timing as the bot jobs
+        self._tasks = [
+            [now + 120, 60, self._update_basetime],
+            [now, 30, self._cache_plots],
+            [now, 30, self._broadcast],
+        ]
+        self._stations_watcher = None
+        if stations_file is not None:
+            self._stations_watcher = StationFileWatcher(stations_file)
+            self._tasks.append(
+                [now, STATIONS_WATCH_INTERVAL, self._watch_stations])
+
+    def run(self, stop=None):
+        logger.info('Starting fetcher')
+        self.start()
+        while stop is None or not stop.is_set():
+            self.run_once(timeout=1)
+
+    def start(self):
+        if not self._ecmwf.base_time_discovered:
+            self._ecmwf.discover_base_time()
+        self._ecmwf.override_base_time_from_init()
+
+    def run_once(self, timeout=0):
+        self._handle(self._channel.receive(timeout))
+        for task in self._tasks:
+            now = self._clock()
+            if now >= task[0]:
+                JOB_LAG_SECONDS.observe(now - task[0])
+                task[0] = now + task[1]
+                task[2]()
+
+    def _update_basetime(self):
+        self._ecmwf.upgrade_basetime_global()
+        self._ecmwf.upgrade_basetime_stations()
+
+    def _cache_plots(self):
+        self._ecmwf.cache_plots(self._db.get_demanded_products())
+
+    def _watch_stations(self):
+        if not self._stations_watcher.changed():
+            return
+        try:
+            station_config = load_station_config(self._stations_watcher.path)
+        except (OSError, ValueError) as e:
+            logger.error('Stations not reloaded: %s', e)
+            return
+        added, removed, changed = self._ecmwf.reload_stations(station_config)
+        logger.info('Stations reloaded: %d added, %d removed, %d changed',
+                    len(added), len(removed), len(changed))
+
+    def _broadcast(self):
+        if queue_broadcast(self._ecmwf, self._db):
+            self._channel.send(FRONTEND_SOCKET, {'type': 'ready'})
+
+    def _handle(self, messages):
+        # the front-end repeats requests, fetch each one once per batch
+        requests = {}
+        for message in messages:
+            if message.get('type') == 'fetch':
+                products = message.get('products')
+                key = (message['station'],
+                       tuple(products) if products is not None else None)
+            elif message.get('type') == 'fetch_point':
+                key = tuple(
+                    self._ecmwf.snap_point(message['lat'], message['lon']))
+            else:
+                logger.warning(f'Unknown message {message}')
+                continue
+            requests[key] = message
+
+        for message in requests.values():
+            if message['type'] == 'fetch':
+                self._fetch(message['station'], message.get('products'))
+            else:
+                self._fetch_point(message['lat'], message['lon'])
+
+    def _fetch(self, station_name, products):
+        plots = self._ecmwf.download_plots([station_name],
+                                           {station_name: products})
+        if plots.get(station_name):
+            self._db.reschedule_deliveries(station_name)
+            self._channel.send(FRONTEND_SOCKET, {
+                'type': 'ready',
+                'station': station_name
+            })
+
+    def _fetch_point(self, lat, lon):
+        name, plots = self._ecmwf.download_plots_for_point(lat, lon)
+        if plots:
+            self._channel.send(
+                FRONTEND_SOCKET, {
+                    'type': 'point',
+                    'lat': lat,
+                    'lon': lon,
+                    'name': name,
+                    'plots': plots,
+                    'base_time': self._ecmwf.base_time,
+                })
+
+
+class PlotStore():
+    """Read-only view of the plots of a fetcher worker for the front-end.
+
+    Answers from the state file the fetcher keeps up to date, plots that
+    are not on disk yet are requested over the channel.
+    """
+
+    def __init__(self, state_file, channel, products=None):
+        self._state = StateStore(state_file)
+        self._channel = channel
+        self._epsgrams = list(products or EPSGRAM_LABELS)
+        self._adhoc = AdHocLocations()
+        self.plot_cache = PlotCache()
+        # the fetcher owns run detection
+        self.base_time_discovered = True
+        self._snapshot = {}
+        self._signature = None
+        # snapped (lat, lon) -> reply of the fetcher
+        self._points = {}
+
+    def _load(self):
+        try:
+            stat = os.stat(self._state.path)
+        except FileNotFoundError:
+            return self._snapshot
+        signature = (stat.st_size, stat.st_mtime_ns)
+        if signature != self._signature:
+            previous = self._snapshot
+            self._snapshot = self._state.load()
+            self._signature = signature
+            # the fetcher saves the state after every download, the plots
+            # of all other stations are still valid
+            self._invalidate_changed(previous, self._snapshot)
+        return self._snapshot
+
+    def _invalidate_changed(self, previous, current):
+        stations = previous.get('stations', {})
+        new_stations = current.get('stations', {})
+        for name in stations.keys() | new_stations.keys():
+            if stations.get(name) != new_stations.get(name):
+                for product in self._epsgrams:
+                    self.plot_cache.invalidate(plot_path(name, product))
+        # files rewritten for the same run, e.g. a fetch the front-end asked
+        # for, change the signature of the image
+        images = previous.get('images', {})
+        new_images = current.get('images', {})
+        for path in images.keys() | new_images.keys():
+            if images.get(path) != new_images.get(path):
+                self.plot_cache.invalidate(path)
+
+    @property
+    def base_time(self):
+        return self._load().get('base_time')
+
+    def station_base_time(self, station_name):
+        station = self._load().get('stations', {}).get(station_name)
+        return station['base_time'] if station is not None else None
+
+    def broadcast_pending(self, station_name):
+        station = self._load().get('stations', {}).get(station_name)
+        return station is not None and not station['has_been_broadcasted']
+
+    def _cached_products(self, station):
+        cached = set(station.get('cached_products', []))
+        if station['plots_cached']:
+            cached.update(self._epsgrams)
+        return cached
+
+    def download_plots(self, requested_stations, products=None):
+        products = products or {}
+        stations = self._load().get('stations', {})
+        plots = {}
+        for station_name in requested_stations:
+            wanted = [
+                product for product in self._epsgrams
+                if products.get(station_name) is None
+                or product in products[station_name]
+            ]
+            station = stations.get(station_name)
+            if station is not None and self._cached_products(
+                    station).issuperset(wanted):
+                plots[station_name] = [
+                    plot_path(station_name, product) for product in wanted
+                ]
+            else:
+                self._channel.send(
+                    FETCHER_SOCKET, {
+                        'type': 'fetch',
+                        'station': station_name,
+                        'products': products.get(station_name),
+                    })
+        return plots
+
+    def snap_point(self, lat, lon):
+        return self._adhoc.snap(lat, lon)
+
+    def download_plots_for_point(self, lat, lon):
+        cell = self.snap_point(lat, lon)
+        point = self._points.get(cell)
+        if point is not None and point['base_time'] == self.base_time:
+            return point['name'], point['plots']
+        self._channel.send(FETCHER_SOCKET, {
+            'type': 'fetch_point',
+            'lat': lat,
+            'lon': lon
+        })
+        return self._adhoc.name_for(*cell), None
+
+    def rate_limit_stats(self):
+        # requests to ECMWF are made by the fetcher
+        return {}
+
+    def poll(self) -> bool:
+        """Process notifications, True if new plots are ready."""
+        messages = self._channel.receive()
+        base_time = self.base_time
+        self._points = {
+            cell: point
+            for cell, point in self._points.items()
+            if point['base_time'] == base_time
+        }
+        for message in messages:
+            if message.get('type') == 'point':
+                cell = self.snap_point(message['lat'], message['lon'])
+                self._points[cell] = message
+                for plot in message['plots']:
+                    self.plot_cache.invalidate(plot)
+        return bool(messages)